@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+'''
+    bench/bench_stq.py
+    ------------------
+
+    Benchmarks for the task queue, so that changes can be checked for
+    whether they actually make things faster (or slower).
+
+    For each table size and number of groups, a fresh queue (in a temp
+    dir) is filled, and then it measures:
+
+    - enqueue rate: save() one at a time, and save_many()
+    - active_groups() time
+    - dequeue rate & latency: getnexttask(), from 1 or more processes
+      at once (all on the same database)
+
+    and then an end-to-end run of run_tasks.py, with no-op commands (and
+    no-op [callables]).
+
+    Everything is written out as one JSON document, so runs can be saved
+    and compared:
+
+        python bench/bench_stq.py --sizes 1000,100000 --procs 1,4 \\
+                                  --output before.json
+'''
+
+import sys
+import os
+import json
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import multiprocessing
+from os.path import abspath, dirname, join as pathjoin
+from shutil import rmtree
+from time import time
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+
+import stq # pylint: disable=wrong-import-position
+
+CONFIG = '''
+[DIRS]
+db={dir}/db
+tmp={dir}/tmp
+log={dir}/log
+
+[FILES]
+STQ_Config={dir}/bench.ini
+
+[commands]
+noop=/bin/true
+
+[callables]
+noop_py=bench_stq:noop
+
+[runner]
+workers={workers}
+
+{groups}
+'''
+
+
+def noop(task): # pylint: disable=unused-argument
+    ''' the [callables] task for the end-to-end run '''
+    return None
+
+
+def percentiles(times):
+    ''' summary of a list of latencies (seconds) '''
+
+    if not times:
+        return {}
+    times = sorted(times)
+    pick = lambda p: times[min(len(times) - 1, int(len(times) * p))]
+    return {'min': times[0], 'p50': pick(0.5), 'p95': pick(0.95),
+            'p99': pick(0.99), 'max': times[-1],
+            'mean': sum(times) / len(times)}
+
+
+class Scratch(object):
+    ''' a temp dir with a config file for ngroups groups (which can all run
+        any number of tasks at once) '''
+
+    def __init__(self, ngroups, workers=4):
+        self.dir = tempfile.mkdtemp(prefix='stq_bench_')
+        self.groups = ['g{0}'.format(i) for i in range(ngroups)]
+        self.config = pathjoin(self.dir, 'bench.ini')
+
+        with open(self.config, 'w') as conf:
+            conf.write(CONFIG.format(
+                dir=self.dir, workers=workers,
+                groups='\n'.join('[{0}]\nlimit=1000000000\n'.format(g)
+                                 for g in self.groups)))
+
+    def tasks(self, count, command='noop', start=0):
+        ''' a generator of count tasks, spread over the groups '''
+
+        for i in xrange(start, start + count):
+            yield {'name': 'task{0}'.format(i), 'command': command,
+                   'group': self.groups[i % len(self.groups)]}
+
+    def remove(self):
+        ''' delete everything '''
+        rmtree(self.dir, ignore_errors=True)
+
+
+def bench_enqueue(scratch, size, singles):
+    ''' fill the queue to size: singles tasks with save(), the rest with
+        save_many() '''
+
+    results = []
+    singles = min(singles, size)
+
+    with stq.TaskQueue(scratch.config) as tq:
+        start = time()
+        for task in scratch.tasks(singles):
+            tq.save(task)
+        took = time() - start
+        results.append({'bench': 'save', 'ops': singles, 'seconds': took,
+                        'rate': singles / took if took else None})
+
+        many = size - singles
+        if many:
+            start = time()
+            tq.save_many(scratch.tasks(many, start=singles))
+            took = time() - start
+            results.append({'bench': 'save_many', 'ops': many,
+                            'seconds': took,
+                            'rate': many / took if took else None})
+
+    return results
+
+
+def bench_active_groups(scratch, repeats):
+    ''' how long active_groups() takes '''
+
+    times = []
+    with stq.TaskQueue(scratch.config) as tq:
+        for _ in range(repeats):
+            start = time()
+            tq.active_groups()
+            times.append(time() - start)
+
+    return [{'bench': 'active_groups', 'ops': repeats,
+             'latency': percentiles(times)}]
+
+
+def _dequeue(config, count, results):
+    ''' (in each process) getnexttask count times, and send back the
+        latencies, and how many times it failed or found nothing '''
+
+    times = []
+    errors = 0
+    empty = 0
+
+    tq = stq.TaskQueue(config).open()
+    for _ in xrange(count):
+        start = time()
+        try:
+            with tq:
+                tq.getnexttask()
+        except (stq.NoAvailableTasks, stq.TooBusy):
+            empty += 1
+        except sqlite3.OperationalError:
+            errors += 1
+        times.append(time() - start)
+    tq.close()
+
+    results.put((times, errors, empty))
+
+
+def bench_dequeue(scratch, count, procs):
+    ''' getnexttask() from procs processes at once, count times in all.
+        Afterwards the tasks are put back to 'ready' for the next run. '''
+
+    results = multiprocessing.Queue()
+    each = max(1, count // procs)
+
+    workers = [multiprocessing.Process(target=_dequeue,
+                                       args=(scratch.config, each, results))
+               for _ in range(procs)]
+
+    start = time()
+    for worker in workers:
+        worker.start()
+    got = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    took = time() - start
+
+    times = [t for latencies, _, _ in got for t in latencies]
+    errors = sum(e for _, e, _ in got)
+    empty = sum(e for _, _, e in got)
+
+    with stq.TaskQueue(scratch.config) as tq:
+        tq.update_where({'state': 'running'}, {'state': 'ready'})
+
+    return [{'bench': 'getnexttask', 'procs': procs, 'ops': len(times),
+             'seconds': took, 'rate': len(times) / took if took else None,
+             'errors': errors, 'empty': empty,
+             'latency': percentiles(times)}]
+
+
+def bench_run_tasks(count, ngroups, workers):
+    ''' end to end: run_tasks.py running count no-op tasks (both commands
+        and [callables]) '''
+
+    results = []
+
+    for command in ('noop', 'noop_py'):
+        scratch = Scratch(ngroups, workers)
+        try:
+            with stq.TaskQueue(scratch.config) as tq:
+                tq.save_many(scratch.tasks(count, command))
+
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [HERE, dirname(HERE), env.get('PYTHONPATH', '')])
+
+            start = time()
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    [sys.executable, '-c',
+                     'import run_tasks; run_tasks.main({0!r})'.format(
+                         scratch.config)],
+                    env=env, stdout=devnull, cwd=dirname(HERE))
+            took = time() - start
+
+            with stq.TaskQueue(scratch.config) as tq:
+                done = len(tq.tasks(state='finished'))
+
+            results.append({'bench': 'run_tasks', 'command': command,
+                            'workers': workers, 'groups': ngroups,
+                            'ops': count, 'finished': done,
+                            'seconds': took,
+                            'rate': count / took if took else None})
+        finally:
+            scratch.remove()
+
+    return results
+
+
+def run(sizes, group_counts, procs, dequeues, singles, repeats,
+        e2e_tasks, workers):
+    ''' run all the benchmarks, returning the results (a list of dicts) '''
+
+    results = []
+
+    for ngroups in group_counts:
+        for size in sizes:
+            scratch = Scratch(ngroups)
+            try:
+                found = bench_enqueue(scratch, size, singles)
+                found += bench_active_groups(scratch, repeats)
+                for nprocs in procs:
+                    found += bench_dequeue(scratch, min(dequeues, size),
+                                           nprocs)
+            finally:
+                scratch.remove()
+
+            for result in found:
+                result.update({'size': size, 'groups': ngroups})
+                print >> sys.stderr, json.dumps(result)
+            results += found
+
+    if e2e_tasks:
+        for ngroups in group_counts:
+            results += bench_run_tasks(e2e_tasks, ngroups, workers)
+
+    return results
+
+
+def _numbers(text, kind=int):
+    ''' '1000,1e6' -> [1000, 1000000] '''
+    return [kind(float(n)) for n in text.split(',')]
+
+
+def main(args):
+    ''' parse the command line, run, and write out the JSON '''
+
+    options = {'--sizes': '1000,10000,100000', '--groups': '1,10,100',
+               '--procs': '1,4', '--dequeues': '1000', '--singles': '1000',
+               '--repeats': '100', '--e2e': '200', '--workers': '4',
+               '--output': '-'}
+
+    while args:
+        name = args.pop(0)
+        if name not in options or not args:
+            print 'Usage:'
+            print '   bench_stq.py', ' '.join(
+                '[{0} {1}]'.format(k, v) for k, v in sorted(options.items()))
+            print '(--sizes can go up to 1e6, --e2e 0 skips run_tasks.py)'
+            exit(1)
+        options[name] = args.pop(0)
+
+    start = time()
+    results = run(_numbers(options['--sizes']),
+                  _numbers(options['--groups']),
+                  _numbers(options['--procs']),
+                  int(options['--dequeues']),
+                  int(options['--singles']),
+                  int(options['--repeats']),
+                  int(options['--e2e']),
+                  int(options['--workers']))
+
+    output = {'meta': {'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform(),
+                       'cpus': multiprocessing.cpu_count(),
+                       'started': start,
+                       'seconds': time() - start,
+                       'options': options},
+              'results': results}
+
+    if options['--output'] == '-':
+        print json.dumps(output, indent=1, sort_keys=True)
+    else:
+        with open(options['--output'], 'w') as outfile:
+            json.dump(output, outfile, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,14 +21,270 @@
 import sys
 import subprocess
 import signal
+import select
+import errno
+import fcntl
 import json
 import os
+import traceback
+from copy import copy
+from importlib import import_module
+from time import time, sleep
 from os.path import abspath, isfile, join as pathjoin, dirname
 
-from ConfigParser import ConfigParser
+import ConfigParser
 
 import stq
 
+class CallableWorker(object):
+    '''
+    A pre-forked worker process, which runs [callables] tasks (python
+    functions) one at a time, without a fork/exec per task.  Tasks are sent
+    to it as JSON lines down a pipe, and it sends back a JSON line of
+    {"returncode": ..., "result": ...} for each.
+
+    While it's running a task, it stands in for the subprocess.Popen object
+    (pid, returncode, poll, wait & terminate) so the rest of the TaskRunner
+    and WorkerPool don't need to care which sort of task it is.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.returncode = None
+        self.result = None
+        self._buffer = ''
+
+        requests, self.to_child = os.pipe()
+        self.from_child, responses = os.pipe()
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(self.to_child)
+                os.close(self.from_child)
+                for other in pool.workers:
+                    os.close(other.to_child)
+                    os.close(other.from_child)
+                self._serve(requests, responses)
+            except BaseException: # pylint: disable=broad-except
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+
+        os.close(requests)
+        os.close(responses)
+        fcntl.fcntl(self.from_child, fcntl.F_SETFL,
+                    fcntl.fcntl(self.from_child, fcntl.F_GETFL) | os.O_NONBLOCK)
+        pool.workers.add(self)
+
+    ##############################
+    # in the worker process:
+
+    def _serve(self, requests, responses):
+        ''' import all the callables, and then run each task sent, until the
+            pipe is closed. '''
+
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        saved = os.dup(1), os.dup(2)
+
+        sys.path.insert(0, self.pool.path)
+        functions = {}
+        for name, spec in self.pool.callables.items():
+            try:
+                module, function = spec.split(':')
+                functions[name] = getattr(import_module(module), function)
+            except Exception: # pylint: disable=broad-except
+                functions[name] = traceback.format_exc()
+
+        for line in iter(os.fdopen(requests, 'r', 0).readline, ''):
+            task = json.loads(line)
+
+            self._redirect(task.get('stdout'), task.get('stderr'), devnull)
+            result = None
+            try:
+                # (ConfigParser lowercases option names, so [commands]
+                # lookups ignore case, and so do these)
+                function = functions[task['command'].lower()]
+                if not callable(function):
+                    sys.stderr.write(function)
+                    returncode = stq.ERR_COULD_NOT_RUN
+                else:
+                    result = function(task)
+                    returncode = 0
+            except SystemExit as err:
+                returncode = err.code if isinstance(err.code, int) else \
+                             int(err.code is not None)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                returncode = 1
+            finally:
+                self._redirect(None, None, *saved)
+
+            try:
+                response = json.dumps({'returncode': returncode,
+                                       'result': result})
+            except (TypeError, ValueError):
+                response = json.dumps({'returncode': returncode,
+                                       'result': repr(result)})
+            os.write(responses, response + '\n')
+
+    @staticmethod
+    def _redirect(stdout, stderr, *fds):
+        ''' point stdout and stderr at those files (appending), or at fds if
+            they're not given. '''
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        if stdout:
+            with open(stdout, 'a') as outfile:
+                os.dup2(outfile.fileno(), 1)
+            if stderr and stderr != stdout:
+                with open(stderr, 'a') as errfile:
+                    os.dup2(errfile.fileno(), 2)
+            else:
+                os.dup2(1, 2)
+        else:
+            os.dup2(fds[0], 1)
+            os.dup2(fds[-1], 2)
+
+    ##############################
+    # in the WorkerPool / TaskRunner:
+
+    def send(self, task):
+        ''' start running task '''
+
+        self.returncode = None
+        self.result = None
+        os.write(self.to_child, json.dumps(task) + '\n')
+
+    def fileno(self):
+        ''' (for select) readable when the task has finished '''
+        return self.from_child
+
+    def poll(self):
+        ''' the returncode, if the task has finished, otherwise None. '''
+
+        if self.returncode is not None:
+            return self.returncode
+
+        try:
+            data = os.read(self.from_child, 4096)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+
+        if not data:
+            # the worker died:
+            self._close()
+            try:
+                self.returncode = _returncode(os.waitpid(self.pid, 0)[1])
+            except OSError:
+                self.returncode = stq.ERR_SOMETHING_UNKNOWN
+            return self.returncode
+
+        self._buffer += data
+        if '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            response = json.loads(line)
+            self.result = response['result']
+            self.returncode = response['returncode']
+            self.pool.done(self)
+
+        return self.returncode
+
+    def wait(self):
+        ''' block until the task has finished, and return the returncode '''
+
+        while self.poll() is None:
+            try:
+                select.select([self.from_child], [], [])
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        return self.returncode
+
+    def terminate(self):
+        ''' kill the worker (and so whatever it's running) '''
+
+        os.kill(self.pid, signal.SIGTERM)
+
+    def _close(self):
+        ''' this worker is finished with, so close the pipes '''
+
+        if self in self.pool.workers:
+            self.pool.workers.discard(self)
+            os.close(self.to_child)
+            os.close(self.from_child)
+
+    def stop(self):
+        ''' (when idle) tell the worker to exit, and wait for it '''
+
+        self._close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class CallablePool(object):
+    '''
+    The CallableWorkers for the [callables] section (name=module:function),
+    kept running between tasks.
+    '''
+
+    def __init__(self, callables, path):
+        self.callables = callables
+        self.path = path
+        self.workers = set()
+        self.idle = []
+        self.closed = False
+
+    def prefork(self, count):
+        ''' make sure there are at least count workers started '''
+
+        while len(self.workers) < count:
+            self.idle.append(CallableWorker(self))
+
+    def submit(self, task):
+        ''' start running task on an idle worker (starting a new one if
+            needed), and return the worker. '''
+
+        while self.idle:
+            worker = self.idle.pop()
+            try:
+                worker.send(task)
+                return worker
+            except OSError:
+                # (it died while idle)
+                worker.stop()
+
+        worker = CallableWorker(self)
+        worker.send(task)
+        return worker
+
+    def done(self, worker):
+        ''' worker has finished its task, and can have another '''
+
+        if self.closed:
+            worker.stop()
+        else:
+            self.idle.append(worker)
+
+    def close(self):
+        ''' stop all the idle workers.  Busy ones stop when they finish. '''
+
+        self.closed = True
+        while self.idle:
+            self.idle.pop().stop()
+
+
 class TaskRunner(object):
     '''
     the main 'taskrunner' object.  This keeps track of the task ID, saving,
@@ -37,12 +293,15 @@ class TaskRunner(object):
 
     task = None
     process = None
+    taskqueue = None
+    callablepool = None
+    started = None
 
     def __init__(self, configfile):
         ''' check that the config file is valid, and load data from it '''
 
         self.configfile = configfile
-        self.config = ConfigParser()
+        self.config = ConfigParser.ConfigParser()
         try:
             self.config.read(configfile)
         except:
@@ -55,14 +314,72 @@ class TaskRunner(object):
             taskqueue.save(self.task)
 
     def TQ(self):
-        ''' return the task queue object '''
+        ''' return the task queue object.  This is made (and connected) the
+            first time it's needed, and then kept open. '''
+
+        if self.taskqueue:
+            return self.taskqueue
 
         stqconfig = self.config.get('FILES', 'STQ_Config', self.configfile)
 
-        if isfile(stqconfig):
-            return stq.TaskQueue(stqconfig)
-        else:
-            return stq.TaskQueue(pathjoin(dirname(self.configfile), stqconfig))
+        if not isfile(stqconfig):
+            stqconfig = pathjoin(dirname(self.configfile), stqconfig)
+
+        self.taskqueue = stq.TaskQueue(stqconfig).open()
+        return self.taskqueue
+
+    @property
+    def metrics(self):
+        ''' the task queue's Metrics (or None, if they're not enabled) '''
+        return self.TQ().metrics
+
+    def callables(self):
+        ''' the pool of workers for [callables] tasks, made the first time
+            it's needed, and then kept.  None if there aren't any. '''
+
+        if self.callablepool is None and \
+           self.config.has_section('callables'):
+            self.callablepool = CallablePool(
+                dict(self.config.items('callables')), dirname(self.configfile))
+        return self.callablepool
+
+    def for_task(self, task):
+        ''' a new TaskRunner for task, sharing this one's config and
+            task queue connection. '''
+
+        runner = copy(self)
+        runner.task = task
+        runner.process = None
+        return runner
+
+    def renew(self):
+        ''' keep this task's lease going.  Returns False if the lease has
+            been lost (it expired, and the task went back to the queue). '''
+
+        return self.task['uid'] in self.TQ().renew([self.task['uid']])
+
+    def lose(self):
+        ''' the lease was lost, so someone else may be running this task by
+            now: stop our copy of it, without saving anything. '''
+
+        print 'Lost the lease on task', self.task['uid'], '- stopping it.'
+        try:
+            self.process.terminate()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def release(self):
+        ''' give the task back to the queue (as 'ready'), so that something
+            else can run it.  Only those fields are saved, so it doesn't keep
+            the defaults it was given when it was claimed. '''
+
+        if self.task:
+            with self.TQ() as taskqueue:
+                taskqueue.save({'uid': self.task['uid'],
+                                'group': self.task['group'],
+                                'state': 'ready', 'pid': None,
+                                'started_at': None})
 
     def fail(self, errcode):
         ''' something went wrong.  update the state, and save '''
@@ -70,13 +387,70 @@ class TaskRunner(object):
         if self.task:
             self.task['state'] = 'failed'
             self.task['errcode'] = errcode
+            self.task['finished_at'] = time()
             self.save()
 
     def run(self):
         ''' actually run a task.  Note: This DOES NOT fork and daemonise!
             running this directly will run the task and block until done. '''
 
-        cmd = self.get_command(self.task['command'])
+        if not self.start():
+            return False
+
+        # OK. It seemed to start well enough.
+        # Let's wait for it it finish, I guess.
+
+        try:
+            if not self.wait():
+                return False
+
+        except Exception as err: # pylint: disable=broad-except
+            self.task['state'] = 'failed'
+            self.task['errcode'] = stq.ERR_SOMETHING_UNKNOWN
+            self.save()
+
+            print 'Something went wrong!'
+            print err
+            return False
+
+        return self.finish(self.process.returncode)
+
+    def wait(self):
+        ''' wait for the process to end, renewing the task's lease (if it
+            was claimed with one) every third of the lease time.  If the
+            lease is lost, the process is stopped, and this returns False. '''
+
+        lease_time = self.TQ().lease_time
+        if not lease_time or not self.task.get('lease_expires'):
+            self.process.wait()
+            return True
+
+        renew_at = time() + lease_time / 3
+        while self.process.poll() is None:
+            if time() >= renew_at:
+                if not self.renew():
+                    self.lose()
+                    return False
+                renew_at = time() + lease_time / 3
+            sleep(min(1.0, lease_time / 3))
+        return True
+
+    @stq.timed('runner_start')
+    def start(self):
+        ''' start the task's process, and mark it as running.  Doesn't wait
+            for it to finish (see run, and finish).  Returns True if it
+            started OK. '''
+
+        command = self.task.get('command')
+        if not command:
+            self.fail(stq.ERR_UNDEFINED_COMMAND)
+            print 'Task', self.task['uid'], 'has no command to run!'
+            return False
+
+        if self.config.has_option('callables', command):
+            return self.start_callable()
+
+        cmd = self.get_command(command)
 
         if not cmd:
             self.fail(stq.ERR_UNDEFINED_COMMAND)
@@ -118,7 +492,8 @@ class TaskRunner(object):
                            ' output:', self.task['stdout'])
                     self.process = subprocess.Popen(cmdlist,
                                                     stdout=outfile,
-                                                    stderr=subprocess.STDOUT)
+                                                    stderr=subprocess.STDOUT,
+                                                    close_fds=True)
             else:
                 with open(self.task['stdout'],'a') as outfile:
 
@@ -129,12 +504,15 @@ class TaskRunner(object):
 
                         self.process = subprocess.Popen(cmdlist,
                                                         stdout=outfile,
-                                                        stderr=errfile)
+                                                        stderr=errfile,
+                                                        close_fds=True)
 
             # Update the db.
             self.task['state'] = 'running'
             self.task['pid'] = self.process.pid
+            self.task['started_at'] = time()
             self.save()
+            self._started()
         except OSError as err:
             self.fail(stq.ERR_COULD_NOT_RUN)
 
@@ -143,35 +521,72 @@ class TaskRunner(object):
             print ' '.join(cmdlist)
             return False
 
-        # OK. It seemed to start well enough.
-        # Let's wait for it it finish, I guess.
+        return True
 
-        try:
-            self.process.wait()
+    def start_callable(self):
+        ''' start the task on a [callables] worker, rather than running a
+            command.  Otherwise the same as start. '''
 
-        except Exception as err: # pylint: disable=broad-except
-            self.task['state'] = 'failed'
-            self.task['errcode'] = stq.ERR_SOMETHING_UNKNOWN
-            self.save()
+        try:
+            self.process = self.callables().submit(self.task)
+        except OSError as err:
+            self.fail(stq.ERR_COULD_NOT_RUN)
 
-            print 'Something went wrong!'
+            print "Couldn't start a worker for", self.task['command']
             print err
             return False
 
-        if self.process.returncode != 0:
-            self.fail(self.process.returncode)
+        print ('Running:', self.task['command'], 'in worker',
+               self.process.pid, ' output:', self.task.get('stdout'))
+
+        self.task['state'] = 'running'
+        self.task['pid'] = self.process.pid
+        self.task['started_at'] = time()
+        self.save()
+        self._started()
+        return True
+
+    def _started(self):
+        ''' (metrics) the task has just started '''
+
+        if self.metrics:
+            self.metrics.count('tasks_started')
+            self.started = stq.monotonic()
+
+    def _finished(self, how):
+        ''' (metrics) the task has just finished (how='finished'/'failed') '''
 
+        if self.metrics:
+            self.metrics.count('tasks_' + how)
+            if self.started is not None:
+                self.metrics.add('task_runtime',
+                                 stq.monotonic() - self.started)
+
+    def finish(self, returncode):
+        ''' the task's process has ended with returncode, so record how it
+            went.  Returns True if it was successful. '''
+
+        self.task['finished_at'] = time()
+
+        # ([callables] tasks can send back a result as well)
+        result = getattr(self.process, 'result', None)
+        if result is not None:
+            self.task['result'] = result
+
+        if returncode != 0:
             print 'It failed while running!'
             self.task['state'] = 'failed'
-            self.task['errcode'] = self.process.returncode
+            self.task['errcode'] = returncode
             self.task['message'] = 'Failed while running!'
             self.save()
+            self._finished('failed')
             print self.task
             return False
 
         # Apparently it finished alright!
         self.task['state'] = 'finished'
         self.save()
+        self._finished('finished')
         return True
 
     def get_command(self, cmdname):
@@ -188,74 +603,318 @@ class TaskRunner(object):
 
 
 
-def main(configfile):
+def _returncode(status):
+    ''' turn an os.wait() status into a Popen style returncode '''
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class WorkerPool(object):
     '''
-        This function should NOT be run from anything OTHER THAN this
-        module, when it's used as a stand-alone script.  It forks and
-        becomes a daemon, and then will start processing tasks, until
-        there are none left to do.
+    Runs up to [runner] workers= tasks at the same time, as child processes
+    of this one, all sharing one task queue connection.  Free slots are
+    filled (as far as the group limits allow) whenever a child finishes.
     '''
 
-    #####################################################################
-    # Loop of getting tasks and running them:
+    def __init__(self, configfile):
+        self.configfile = configfile
+        self.runner = None
+        self.running = {}
+        self.stopping = False
+        self.reloading = False
+        self.listening = None
+        self.renew_at = 0
+
+        self.load_config()
+
+        # Signals (SIGCHLD whenever a child finishes, and SIGTERM / SIGHUP)
+        # wake us up via this pipe:
+        self.wakeup, wakeup_write = os.pipe()
+        for fd in (self.wakeup, wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(wakeup_write)
+
+        signal.signal(signal.SIGCHLD, lambda num, stack: None)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGHUP, self._on_signal)
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGHUP):
+            signal.siginterrupt(signum, False)
+
+    def _on_signal(self, num, stack): # pylint: disable=unused-argument
+        ''' SIGTERM: stop (at the next chance).  SIGHUP: reload config. '''
+
+        if num == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
 
-    runner = TaskRunner(configfile)
+    def _option(self, name, default):
+        ''' a [runner] setting from the config file, as the same type as
+            default (or default if it isn't there). '''
 
-    while True:
         try:
+            return type(default)(self.runner.config.get('runner', name))
+        except (ConfigParser.Error, ValueError):
+            return default
+
+    def load_config(self):
+        ''' (re)read the config file.  Tasks which are already running keep
+            going, but are switched over to the new task queue. '''
+
+        old = self.runner
+        self.runner = TaskRunner(self.configfile)
+
+        self.workers = self._option('workers', 1)
+        self.poll_min = self._option('poll_min', 1.0)
+        self.poll_max = self._option('poll_max', 30.0)
+
+        if old and old.taskqueue:
+            for runner in self.running.values():
+                runner.taskqueue = self.runner.TQ()
+            old.taskqueue.close()
+
+        if old and old.callablepool:
+            old.callablepool.close()
+        if self.runner.callables():
+            self.runner.callables().prefork(self.workers)
+
+        # new tasks being saved wake us up via this (if it's possible):
+        if self.listening is not None:
+            os.close(self.listening)
+        self.listening = self.runner.TQ().listen()
+
+        self.reloading = False
+
+    def fill(self):
+        ''' start as many new tasks as there are free slots (and available
+            tasks).  Raises NoAvailableTasks or TooBusy if none could be
+            started, otherwise returns how many were.  If starting one
+            throws, it's failed, and the rest are given back to the queue
+            (to be tried again next time). '''
+
+        free = self.workers - len(self.running)
+        if free <= 0:
+            return 0
+
+        with self.runner.TQ() as taskqueue:
+            tasks = taskqueue.getnexttasks(free, lease=True)
+
+        if not self.running:
+            self.renew_at = time() + taskqueue.lease_time / 3
+
+        started = 0
+        for num, task in enumerate(tasks):
+            runner = self.runner.for_task(task)
+            try:
+                if runner.start():
+                    self.running[runner.process.pid] = runner
+                started += 1
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                runner.fail(stq.ERR_SOMETHING_UNKNOWN)
+                for unstarted in tasks[num + 1:]:
+                    self.runner.for_task(unstarted).release()
+                break
+
+        return started
+
+    def wait(self, timeout=None):
+        ''' sleep until a child process ends, a task is saved to the queue,
+            (or timeout seconds), and renew the running tasks' leases if
+            they're due. '''
+
+        lease_time = self.runner.TQ().lease_time
+        if self.running and lease_time:
+            until_renew = max(0, self.renew_at - time())
+            timeout = until_renew if timeout is None else min(timeout,
+                                                              until_renew)
+
+        fds = [self.wakeup]
+        if self.listening is not None:
+            fds.append(self.listening)
+
+        # [callables] workers say when their task's done down their pipe:
+        workers = [runner.process for runner in self.running.values()
+                   if isinstance(runner.process, CallableWorker)]
+
+        try:
+            select.select(fds + workers, [], [], timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+        for fd in fds:
+            try:
+                while os.read(fd, 512):
+                    pass
+            except OSError:
+                pass
+
+        if self.running and lease_time and time() >= self.renew_at:
+            self.renew()
+
+    def renew(self):
+        ''' renew the leases of every running task, and stop any whose lease
+            has been lost. '''
+
+        taskqueue = self.runner.TQ()
+        running = dict((runner.task['uid'], pid)
+                       for pid, runner in self.running.items())
+        kept = set(taskqueue.renew(running.keys()))
+
+        for uid, pid in running.items():
+            if uid not in kept:
+                self.running.pop(pid).lose()
+
+        self.renew_at = time() + taskqueue.lease_time / 3
+
+    def reap(self):
+        ''' record the result of every child process which has finished '''
+
+        for pid, runner in self.running.items():
+            if isinstance(runner.process, CallableWorker) and \
+               runner.process.poll() is not None:
+                del self.running[pid]
+                runner.finish(runner.process.returncode)
+
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+
+            runner = self.running.pop(pid, None)
+            if runner:
+                if isinstance(runner.process, CallableWorker):
+                    runner.process._close() # pylint: disable=protected-access
+                runner.process.returncode = _returncode(status)
+                runner.finish(runner.process.returncode)
+
+    def stop(self, errcode=None):
+        ''' kill all the running tasks, and either mark them as failed with
+            errcode, or (with no errcode) give them back to the queue. '''
+
+        for runner in self.running.values():
+            try:
+                runner.process.terminate()
+            except OSError:
+                pass
+        for runner in self.running.values():
+            runner.process.wait()
+            if errcode is None:
+                runner.release()
+            else:
+                runner.fail(errcode)
+        self.running = {}
+
+        if self.runner.callablepool:
+            self.runner.callablepool.close()
+
+    def run(self):
+        ''' keep all the slots full until there's nothing left to do.
+            Returns 0 if everything got done, or 1 if it's stopped because
+            the groups are too busy (or it was told to stop). '''
+
+        while not self.stopping:
+            if self.reloading:
+                self.load_config()
             try:
-                with runner.TQ() as taskqueue:
-                    runner.task = taskqueue.getnexttask()
+                self.fill()
             except stq.NoAvailableTasks:
-                # There are no tasks to run! Woot!
-                exit(0)
+                if not self.running:
+                    return 0
             except stq.TooBusy:
-                print 'Sorry! Too Busy!'
-                exit(1)
+                if not self.running:
+                    print 'Sorry! Too Busy!'
+                    return 1
 
-            if runner.task:
+            if self.running:
+                self.wait()
+                self.reap()
+            self.runner.TQ().export_metrics()
 
-                def term_handler(num, stack): # pylint: disable=unused-argument
-                    ''' This is called if the current process
-                        (the controlling process) is sent a KILL or DIE signal.
-                        Instead of just curling up in a heap and dieing, it
-                        stops the child process, and then sets the task
-                        queue status to killed by user, and then dies.'''
+        self.stop()
+        return 1
 
-                    runner.process.terminate()
-                    runner.fail(stq.ERR_USER_CANCELLED)
-                    exit(1)
+    def serve(self):
+        ''' like run, but keep going forever (until SIGTERM), checking for
+            new tasks every poll_min seconds, backing off to every poll_max
+            seconds while there's nothing to do. '''
 
-                # assign the signal handler:
+        interval = self.poll_min
 
-                signal.signal(signal.SIGTERM, term_handler)
+        while not self.stopping:
+            if self.reloading:
+                self.load_config()
+                interval = self.poll_min
 
-                # run the current task (this could take a very long time)
+            try:
+                started = self.fill()
+            except (stq.NoAvailableTasks, stq.TooBusy):
+                started = 0
 
-                runner.run()
+            if started:
+                interval = self.poll_min
+            else:
+                interval = min(interval * 2, self.poll_max)
 
-                # and set the signal handler back to the default python one.
+            self.wait(interval)
+            self.reap()
+            self.runner.TQ().export_metrics()
 
-                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.stop()
+        return 0
 
-            else:
-                # Hm. No tasks, but no exceptions. odd.
-                exit(1)
 
-        except KeyboardInterrupt:
-            if runner.task:
-                runner.fail(stq.ERR_USER_CANCELLED)
-            exit(1)
+def main(configfile, daemon=False):
+    '''
+        This function should NOT be run from anything OTHER THAN this
+        module, when it's used as a stand-alone script.  It forks and
+        becomes a daemon, and then will start processing tasks, until
+        there are none left to do (or with daemon=True, until it's sent
+        a SIGTERM).
+
+        On SIGTERM, running tasks are stopped and given back to the queue,
+        so that another runner can do them.  SIGHUP re-reads the config.
+    '''
+
+    #####################################################################
+    # Loop of getting tasks and running them:
+
+    pool = WorkerPool(configfile)
+
+    try:
+        code = pool.serve() if daemon else pool.run()
+    except KeyboardInterrupt:
+        pool.stop(stq.ERR_USER_CANCELLED)
+        code = 1
+
+    pool.runner.TQ().export_metrics(force=True)
+    pool.runner.TQ().close()
+    exit(code)
 
 ###############################################################################
 
 if __name__ == '__main__':
+    ARGS = sys.argv[1:]
+    DAEMON = '--daemon' in ARGS
+    if DAEMON:
+        ARGS.remove('--daemon')
+
     try:
-        CONFIG = abspath(sys.argv[1])
+        CONFIG = abspath(ARGS[0])
     except:
         print 'Usage:'
-        print '   run_next.py $configfile'
+        print '   run_next.py [--daemon] $configfile'
         print 'Where $configfile is the name of the config file (duh)'
+        print 'and --daemon keeps it running, waiting for new tasks.'
         exit(1)
 
     try:
@@ -274,4 +933,4 @@ if __name__ == '__main__':
     except OSError:
         exit(1)
 
-    main(CONFIG)
+    main(CONFIG, DAEMON)
@@ -27,21 +27,68 @@ reload(sys)
 sys.setdefaultencoding('utf-8') # pylint: disable=no-member
 
 
+import os
+import errno
+from glob import glob
 from os import makedirs
-from os.path import isdir, join as pathjoin, abspath
+from os.path import isdir, exists, join as pathjoin, abspath
+import socket
+from socket import gethostname
 from uuid import uuid1
+from time import time, mktime, strptime
+from functools import wraps
+from contextlib import contextmanager
+from itertools import islice, chain
 
 from ConfigParser import SafeConfigParser
 
 from flufl.lock import Lock
 
 import json
-from collections import defaultdict
-from sqlite3 import OperationalError
-
-from dictlitestore import DictLiteStore, NoJSON
-
-valid_states = ('new', 'ready', 'running', 'done', 'failed', 'tmp', None)
+import zlib
+import sqlite3
+import threading
+from Queue import Queue, Empty
+from collections import defaultdict, OrderedDict
+
+try:
+    from time import monotonic
+except ImportError:
+    # (python 2 has no monotonic clock in the standard library)
+    from time import time as monotonic
+
+# (optional, only needed for AsyncTaskQueue)
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+valid_states = ('new', 'ready', 'running', 'done', 'failed', 'cancelled',
+                'tmp', None)
+
+# Config sections which are settings, rather than task groups:
+NON_GROUP_SECTIONS = ('DIRS', 'task_defaults', 'sqlite', 'scheduler',
+                      'leases', 'retention', 'metrics', 'dependencies',
+                      'FILES', 'commands', 'callables', 'runner')
+
+# [sqlite] settings, if the config file doesn't say otherwise.  WAL means
+# readers never block writers (or the other way round), and with a busy
+# timeout concurrent writers simply wait their turn, so the file lock isn't
+# needed either.
+SQLITE_DEFAULTS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': '268435456',
+    'cache_size': '-16000',
+    'busy_timeout': '30000',
+    'file_lock': 'no',
+    }
+
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SQLITE_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
 ##########################################################
 # Errors:
@@ -50,6 +97,8 @@ ERR_USER_CANCELLED = -1
 ERR_UNDEFINED_COMMAND = -2
 ERR_COULD_NOT_RUN = -3
 ERR_SOMETHING_UNKNOWN = -4
+ERR_LEASE_EXPIRED = -5
+ERR_DEPENDENCY_FAILED = -6
 
 class InvalidConfigFile(Exception):
     ''' Invalid config file. '''
@@ -141,9 +190,1362 @@ class Config(object):
         else:
             return default
 
+    def getboolean(self, section, option, default=False):
+        ''' Either return the option (as True/False), or the default. '''
+        if self.config.has_option(section, option):
+            try:
+                return self.config.getboolean(section, option)
+            except ValueError:
+                raise InvalidConfigFile(
+                    'Config file ({0}) {1}->{2} should be yes or no'
+                    .format(self.filename, section, option))
+        else:
+            return default
+
     def groups(self):
         ''' return a list of available groups '''
-        return [group for group in self.config.sections() if group != 'DIRS']
+        return [group for group in self.config.sections()
+                if group not in NON_GROUP_SECTIONS]
+
+    def sqlite(self):
+        ''' the [sqlite] settings (with defaults filled in), checked. '''
+
+        options = dict(SQLITE_DEFAULTS)
+        if self.config.has_section('sqlite'):
+            options.update(self.config.items('sqlite'))
+
+        options['journal_mode'] = options['journal_mode'].upper()
+        options['synchronous'] = options['synchronous'].upper()
+
+        if options['journal_mode'] not in SQLITE_JOURNAL_MODES:
+            raise InvalidConfigFile(
+                'Config file ({0}) sqlite->journal_mode must be one of {1}'
+                .format(self.filename, ', '.join(SQLITE_JOURNAL_MODES)))
+
+        if options['synchronous'] not in SQLITE_SYNCHRONOUS:
+            raise InvalidConfigFile(
+                'Config file ({0}) sqlite->synchronous must be one of {1}'
+                .format(self.filename, ', '.join(SQLITE_SYNCHRONOUS)))
+
+        for option in ('mmap_size', 'cache_size', 'busy_timeout'):
+            try:
+                options[option] = int(options[option])
+            except ValueError:
+                raise InvalidConfigFile(
+                    'Config file ({0}) sqlite->{1} should be a number'
+                    .format(self.filename, option))
+
+        options['file_lock'] = self.getboolean(
+            'sqlite', 'file_lock', SQLITE_DEFAULTS['file_lock'] == 'yes')
+
+        return options
+
+
+################################################################
+# Metrics:
+
+class Metrics(object):
+    '''
+    Counters, and timers (how many calls, total & longest time) for the
+    queue's hot paths.  Only made if [metrics] enabled=yes, otherwise
+    everything which would use it sees None, and does nothing extra.
+    '''
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.longest = defaultdict(float)
+
+    def count(self, name, n=1):
+        ''' add n to counter name '''
+        self.counters[name] += n
+
+    def add(self, name, seconds):
+        ''' record one call to name, which took seconds '''
+        self.calls[name] += 1
+        self.seconds[name] += seconds
+        if seconds > self.longest[name]:
+            self.longest[name] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        ''' with metrics.timer('thing'): ... '''
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - start)
+
+    def stats(self):
+        ''' everything so far, as a dict '''
+        return {'counters': dict(self.counters),
+                'timers': dict((name, {'calls': self.calls[name],
+                                       'seconds': self.seconds[name],
+                                       'max': self.longest[name]})
+                               for name in self.calls)}
+
+    def prometheus(self, prefix='stq'):
+        ''' everything so far, in prometheus' text format '''
+
+        lines = []
+        for metric, kind, values, label in (
+                ('events_total', 'counter', self.counters, 'event'),
+                ('calls_total', 'counter', self.calls, 'op'),
+                ('seconds_total', 'counter', self.seconds, 'op'),
+                ('max_seconds', 'gauge', self.longest, 'op')):
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, metric, kind))
+            lines.extend('{0}_{1}{{{2}="{3}"}} {4!r}'.format(
+                prefix, metric, label, name, value)
+                         for name, value in sorted(values.items()))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(name):
+    ''' decorator: time every call of the method as name, in self.metrics
+        (unless that's None, when it's just one extra attribute lookup) '''
+
+    def decorate(method):
+        ''' (the actual decorator) '''
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            ''' (the timed method) '''
+            metrics = self.metrics
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            start = monotonic()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.add(name, monotonic() - start)
+
+        return wrapper
+    return decorate
+
+
+################################################################
+# Task storage:
+
+# Fields that the queue itself needs to look at get real, typed & indexed
+# columns.  Everything else in a task dict is kept as one JSON blob in 'data'.
+
+TASK_COLUMNS = ('uid', 'state', 'group', 'priority', 'run_at',
+                'queued_at', 'updated_at', 'attempts',
+                'lease_expires', 'lease_host', 'lease_pid',
+                'claimed_at', 'started_at', 'finished_at', 'dedup_key')
+
+# Tasks which haven't finished yet.  Only one of them at a time can have any
+# particular dedup_key (see TaskStore.save).  This exact SQL is both the
+# WHERE of the Tasks_dedup index and in queries which use it.
+UNFINISHED = u"state IN ('new', 'ready', 'running')"
+
+# When things happened to a task (as well as queued_at & updated_at),
+# which TaskQueue.save and TaskRunner fill in, and claim sets claimed_at:
+LIFECYCLE_COLUMNS = ('queued_at', 'claimed_at', 'started_at', 'finished_at')
+
+# (the body of the triggers for when a task has finished: its dependents
+# which were only waiting for it are made ready, and its TaskDeps rows go)
+DEPENDENCY_FINISHED = (
+    u'    UPDATE Tasks SET state = \'ready\', updated_at = NEW.updated_at'
+    u'      WHERE state = \'new\' AND id IN'
+    u'        (SELECT task_id FROM TaskDeps WHERE depends_on = NEW.uid)'
+    u'      AND NOT EXISTS (SELECT 1 FROM TaskDeps WHERE task_id = Tasks.id'
+    u'        AND depends_on != NEW.uid);'
+    u'    DELETE FROM TaskDeps WHERE depends_on = NEW.uid;')
+
+SCHEMA = (
+    u'CREATE TABLE IF NOT EXISTS Tasks ('
+    u'  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    u'  uid TEXT NOT NULL UNIQUE,'
+    u'  state TEXT,'
+    u'  "group" TEXT NOT NULL DEFAULT \'none\','
+    u'  priority INTEGER NOT NULL DEFAULT 0,'
+    u'  run_at REAL,'
+    u'  queued_at REAL,'
+    u'  updated_at REAL,'
+    u'  attempts INTEGER NOT NULL DEFAULT 0,'
+    u'  lease_expires REAL,'
+    u'  lease_host TEXT,'
+    u'  lease_pid INTEGER,'
+    u'  claimed_at REAL,'
+    u'  started_at REAL,'
+    u'  finished_at REAL,'
+    u'  dedup_key TEXT,'
+    u'  data TEXT NOT NULL DEFAULT \'{}\')',
+    u'CREATE INDEX IF NOT EXISTS Tasks_state_group'
+    u'  ON Tasks(state, "group", id)',
+    u'DROP INDEX IF EXISTS Tasks_group_state',
+    # (listing by state, in id order, a page at a time: see iterate)
+    u'CREATE INDEX IF NOT EXISTS Tasks_state ON Tasks(state)',
+    # (so finding expired leases doesn't scan every task)
+    u'CREATE INDEX IF NOT EXISTS Tasks_lease ON Tasks(lease_expires)',
+    # (for latency stats over a time window, which is always of when tasks
+    # finished.  Nothing looks tasks up by the other times.)
+    u'DROP INDEX IF EXISTS Tasks_claimed',
+    u'CREATE INDEX IF NOT EXISTS Tasks_finished'
+    u'  ON Tasks(finished_at, "group")',
+    u'CREATE UNIQUE INDEX IF NOT EXISTS Tasks_dedup ON Tasks(dedup_key)'
+    u'  WHERE dedup_key IS NOT NULL AND ' + UNFINISHED,
+
+    # Which groups each task is in.  One row per (task, group), so that
+    # tasks with a list of groups are found by an index lookup too.  The
+    # task's state, priority & run_at are copied here (kept in sync by
+    # trigger) so that "the next ready task in group X" is one index seek,
+    # and never has to touch the Tasks table.
+    u'CREATE TABLE IF NOT EXISTS TaskGroups ('
+    u'  task_id INTEGER NOT NULL,'
+    u'  "group" TEXT NOT NULL,'
+    u'  state TEXT,'
+    u'  priority INTEGER NOT NULL DEFAULT 0,'
+    u'  run_at REAL,'
+    u'  PRIMARY KEY (task_id, "group"))',
+    u'DROP INDEX IF EXISTS TaskGroups_group_state',
+    u'CREATE INDEX IF NOT EXISTS TaskGroups_next'
+    u'  ON TaskGroups("group", state, priority DESC, task_id)',
+    # (for listing a group's tasks a page at a time, see iterate)
+    u'CREATE INDEX IF NOT EXISTS TaskGroups_list'
+    u'  ON TaskGroups("group", task_id)',
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_state_to_groups'
+    u'  AFTER UPDATE OF state ON Tasks BEGIN'
+    u'    UPDATE TaskGroups SET state = NEW.state WHERE task_id = NEW.id;'
+    u'  END',
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_order_to_groups'
+    u'  AFTER UPDATE OF priority, run_at ON Tasks BEGIN'
+    u'    UPDATE TaskGroups SET priority = NEW.priority, run_at = NEW.run_at'
+    u'      WHERE task_id = NEW.id;'
+    u'  END',
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_delete_groups'
+    u'  AFTER DELETE ON Tasks BEGIN'
+    u'    DELETE FROM TaskGroups WHERE task_id = OLD.id;'
+    u'  END',
+
+    # How many tasks each group has in each state.  Kept up to date by
+    # triggers on TaskGroups, so it changes in the same transaction as
+    # whatever changed the tasks.  (NULL states are counted as '')
+    u'CREATE TABLE IF NOT EXISTS GroupCounts ('
+    u'  "group" TEXT NOT NULL,'
+    u'  state TEXT NOT NULL,'
+    u'  count INTEGER NOT NULL DEFAULT 0,'
+    u'  PRIMARY KEY ("group", state))',
+    u'CREATE TRIGGER IF NOT EXISTS TaskGroups_count_insert'
+    u'  AFTER INSERT ON TaskGroups BEGIN'
+    u'    INSERT OR IGNORE INTO GroupCounts("group", state)'
+    u'      VALUES (NEW."group", IFNULL(NEW.state, \'\'));'
+    u'    UPDATE GroupCounts SET count = count + 1'
+    u'      WHERE "group" = NEW."group" AND state = IFNULL(NEW.state, \'\');'
+    u'  END',
+    u'CREATE TRIGGER IF NOT EXISTS TaskGroups_count_delete'
+    u'  AFTER DELETE ON TaskGroups BEGIN'
+    u'    UPDATE GroupCounts SET count = count - 1'
+    u'      WHERE "group" = OLD."group" AND state = IFNULL(OLD.state, \'\');'
+    u'    DELETE FROM GroupCounts'
+    u'      WHERE "group" = OLD."group" AND state = IFNULL(OLD.state, \'\')'
+    u'      AND count <= 0;'
+    u'  END',
+    u'CREATE TRIGGER IF NOT EXISTS TaskGroups_count_update'
+    u'  AFTER UPDATE OF state ON TaskGroups'
+    u'  WHEN OLD.state IS NOT NEW.state BEGIN'
+    u'    UPDATE GroupCounts SET count = count - 1'
+    u'      WHERE "group" = OLD."group" AND state = IFNULL(OLD.state, \'\');'
+    u'    DELETE FROM GroupCounts'
+    u'      WHERE "group" = OLD."group" AND state = IFNULL(OLD.state, \'\')'
+    u'      AND count <= 0;'
+    u'    INSERT OR IGNORE INTO GroupCounts("group", state)'
+    u'      VALUES (NEW."group", IFNULL(NEW.state, \'\'));'
+    u'    UPDATE GroupCounts SET count = count + 1'
+    u'      WHERE "group" = NEW."group" AND state = IFNULL(NEW.state, \'\');'
+    u'  END',
+
+    # When each group last had a task handed out, for the scheduler.
+    # 'pass' goes up by 1/weight each time (for the weighted scheduler).
+    u'CREATE TABLE IF NOT EXISTS GroupServed ('
+    u'  "group" TEXT PRIMARY KEY,'
+    u'  served_at REAL,'
+    u'  pass REAL NOT NULL DEFAULT 0)',
+
+    # What each 'new' task is still waiting for: one row per (task, task it
+    # depends on which hasn't finished yet).  By uid, as a pipeline's tasks
+    # can be saved in any order.  When a task finishes, its dependents which
+    # were only waiting for it are made ready, and its rows go, in the same
+    # transaction (and no other tasks are looked at).
+    u'CREATE TABLE IF NOT EXISTS TaskDeps ('
+    u'  depends_on TEXT NOT NULL,'
+    u'  task_id INTEGER NOT NULL,'
+    u'  PRIMARY KEY (depends_on, task_id))',
+    u'CREATE INDEX IF NOT EXISTS TaskDeps_task ON TaskDeps(task_id)',
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_finished_deps'
+    u'  AFTER UPDATE OF state ON Tasks'
+    u'  WHEN NEW.state = \'finished\' AND OLD.state IS NOT \'finished\' BEGIN'
+    + DEPENDENCY_FINISHED +
+    u'  END',
+    # (and the same for a task which is saved as finished to begin with)
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_inserted_deps'
+    u'  AFTER INSERT ON Tasks WHEN NEW.state = \'finished\' BEGIN'
+    + DEPENDENCY_FINISHED +
+    u'  END',
+    u'CREATE TRIGGER IF NOT EXISTS Tasks_delete_deps'
+    u'  AFTER DELETE ON Tasks BEGIN'
+    u'    DELETE FROM TaskDeps WHERE task_id = OLD.id;'
+    u'  END',
+
+    # The uids of finished tasks which have been archived (see
+    # TaskStore.archive), so that tasks saved later depending on them don't
+    # wait for ever.  (Just the uid, so it stays small.)
+    u'CREATE TABLE IF NOT EXISTS ArchivedFinished ('
+    u'  uid TEXT PRIMARY KEY)',
+    )
+
+# With [dependencies] cascade_failures=yes, a task which fails (or is
+# cancelled) takes everything still waiting for it down with it, and
+# (with recursive_triggers) everything waiting for those...  It's a TEMP
+# trigger, made by each connection which wants it, since it needs our
+# json_merge function.
+CASCADE_TRIGGER = (
+    u'CREATE TEMP TRIGGER IF NOT EXISTS Tasks_cascade_failures'
+    u'  AFTER UPDATE OF state ON main.Tasks'
+    u'  WHEN NEW.state IN (\'failed\', \'cancelled\')'
+    u'  AND OLD.state IS NOT NEW.state BEGIN'
+    u'    UPDATE Tasks SET state = NEW.state, updated_at = NEW.updated_at,'
+    u'      finished_at = NEW.updated_at,'
+    u'      data = json_merge(data, \'{{"errcode": {0}}}\')'
+    u'      WHERE state = \'new\' AND id IN'
+    u'        (SELECT task_id FROM TaskDeps WHERE depends_on = NEW.uid);'
+    u'  END').format(ERR_DEPENDENCY_FAILED)
+
+
+# The archive database (see TaskStore.archive) is attached as 'archive'.
+# It keeps the same columns as Tasks (apart from the lease), with the data
+# zlib compressed, and when each task was archived.
+ARCHIVE_COLUMNS = ('id', 'uid', 'state', 'group', 'priority', 'run_at',
+                   'queued_at', 'updated_at', 'attempts',
+                   'claimed_at', 'started_at', 'finished_at', 'dedup_key',
+                   'data')
+
+ARCHIVE_SCHEMA = (
+    u'CREATE TABLE IF NOT EXISTS archive.Tasks ('
+    u'  id INTEGER PRIMARY KEY,'
+    u'  uid TEXT NOT NULL UNIQUE,'
+    u'  state TEXT,'
+    u'  "group" TEXT NOT NULL,'
+    u'  priority INTEGER NOT NULL DEFAULT 0,'
+    u'  run_at REAL,'
+    u'  queued_at REAL,'
+    u'  updated_at REAL,'
+    u'  attempts INTEGER NOT NULL DEFAULT 0,'
+    u'  claimed_at REAL,'
+    u'  started_at REAL,'
+    u'  finished_at REAL,'
+    u'  dedup_key TEXT,'
+    u'  data BLOB NOT NULL,'
+    u'  archived_at REAL)',
+    u'CREATE INDEX IF NOT EXISTS archive.Tasks_group'
+    u'  ON Tasks("group", id)',
+    )
+
+# Columns added since the tables were first made, which older databases
+# need adding: (table, column, definition)
+SCHEMA_UPGRADES = (
+    ('Tasks', 'run_at', u'REAL'),
+    ('Tasks', 'attempts', u'INTEGER NOT NULL DEFAULT 0'),
+    ('Tasks', 'lease_expires', u'REAL'),
+    ('Tasks', 'lease_host', u'TEXT'),
+    ('Tasks', 'lease_pid', u'INTEGER'),
+    ('Tasks', 'claimed_at', u'REAL'),
+    ('Tasks', 'started_at', u'REAL'),
+    ('Tasks', 'finished_at', u'REAL'),
+    ('Tasks', 'dedup_key', u'TEXT'),
+    ('TaskGroups', 'priority', u'INTEGER NOT NULL DEFAULT 0'),
+    ('TaskGroups', 'run_at', u'REAL'),
+    )
+
+# (the same, for the archive database)
+ARCHIVE_UPGRADES = (
+    ('archive.Tasks', 'claimed_at', u'REAL'),
+    ('archive.Tasks', 'started_at', u'REAL'),
+    ('archive.Tasks', 'finished_at', u'REAL'),
+    ('archive.Tasks', 'dedup_key', u'TEXT'),
+    )
+
+
+def _encode_group(group):
+    ''' single groups are stored as plain text, lists of groups as JSON '''
+    if isinstance(group, list):
+        return json.dumps(group)
+    return unicode(group)
+
+def _json_merge(data, changes):
+    ''' (SQL function) the JSON object data, with changes (also JSON) added '''
+    merged = json.loads(data)
+    merged.update(json.loads(changes))
+    return json.dumps(merged, default=unicode)
+
+def _decode_group(raw):
+    ''' opposite of _encode_group '''
+    if raw.startswith(u'['):
+        return json.loads(raw)
+    return raw
+
+def _group_list(group):
+    ''' every group a task is in, as a list without repeats '''
+    if not isinstance(group, list):
+        return [group]
+    groups = []
+    for g in group:
+        if g not in groups:
+            groups.append(g)
+    return groups
+
+
+class TaskStore(object):
+    '''
+    The SQLite storage underneath TaskQueue.  Runs with autocommit, and
+    every write is wrapped in an explicit (BEGIN IMMEDIATE) transaction.
+    '''
+
+    def __init__(self, filename, options=None, metrics=None, cascade=False):
+        ''' options are the [sqlite] config settings (see Config.sqlite),
+            metrics a Metrics object (or None) to time queries with, and
+            cascade whether failures cascade to dependent tasks. '''
+        self.filename = filename
+        self.options = options or {}
+        self.metrics = metrics
+        self.cascade = cascade
+        self.db = None
+        self.cur = None
+        self._depth = 0
+
+    def open(self):
+        ''' connect to the database, creating (or migrating) the schema '''
+        self.db = sqlite3.connect(
+            self.filename, isolation_level=None,
+            timeout=self.options.get('busy_timeout', 5000) / 1000.0)
+        self.db.row_factory = sqlite3.Row
+        self.cur = self.db.cursor()
+
+        for pragma in ('journal_mode', 'synchronous',
+                       'mmap_size', 'cache_size'):
+            if pragma in self.options:
+                self.cur.execute(u'PRAGMA {0} = {1}'.format(
+                    pragma, self.options[pragma])).fetchall()
+
+        self.db.create_function('compress', 1,
+                                lambda text: buffer(zlib.compress(text)))
+        self.db.create_function('json_merge', 2, _json_merge)
+
+        with self.transaction():
+            had_groups = self._columns('TaskGroups')
+            had_counts = self._columns('GroupCounts')
+
+            if self._is_dictlitestore():
+                self._migrate_dictlitestore()
+            else:
+                upgraded = self._upgrade()
+                for sql in SCHEMA:
+                    self.cur.execute(sql)
+                if not had_groups or 'TaskGroups' in upgraded:
+                    self.rebuild_groups()
+                if not (had_groups and had_counts):
+                    self.rebuild_counts()
+
+        if self.cascade:
+            self.cur.execute(u'PRAGMA recursive_triggers = ON')
+            self.cur.execute(CASCADE_TRIGGER)
+
+    def close(self):
+        ''' close the database connection '''
+        self.db.close()
+        self.db = None
+        self.cur = None
+
+    @contextmanager
+    def transaction(self):
+        ''' with store.transaction(): ... is one write transaction.  Nested
+            blocks simply become part of the outermost one. '''
+        if self._depth:
+            self._depth += 1
+            try:
+                yield self.cur
+            finally:
+                self._depth -= 1
+            return
+
+        self.cur.execute(u'BEGIN IMMEDIATE')
+        self._depth = 1
+        try:
+            yield self.cur
+        except:
+            self._depth = 0
+            self.cur.execute(u'ROLLBACK')
+            raise
+        self._depth = 0
+        self.cur.execute(u'COMMIT')
+
+    def _columns(self, table):
+        ''' list of column names in table (empty if it doesn't exist).
+            table can be 'database.table' for attached databases. '''
+        schema, _, table = table.rpartition('.')
+        return [row[1] for row in self.cur.execute(
+            u'PRAGMA {0}table_info("{1}")'.format(
+                schema + '.' if schema else '', table))]
+
+    def _is_dictlitestore(self):
+        ''' is Tasks an old DictLiteStore table?  Those start with an 'Id
+            INT' column which isn't the primary key (and the rest are
+            whatever fields the tasks had, so can't be told apart from ours
+            by name). '''
+
+        columns = self.cur.execute(u'PRAGMA table_info("Tasks")').fetchall()
+        return bool(columns) and not columns[0]['pk']
+
+    def _upgrade(self, upgrades=SCHEMA_UPGRADES):
+        ''' add any SCHEMA_UPGRADES columns missing from existing tables.
+            returns the set of tables which were changed. '''
+
+        upgraded = set()
+        for table, column, definition in upgrades:
+            columns = self._columns(table)
+            if columns and column not in columns:
+                self.cur.execute(u'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    table, column, definition))
+                upgraded.add(table)
+        return upgraded
+
+    def _migrate_dictlitestore(self):
+        ''' one-shot conversion of an old DictLiteStore 'Tasks' table (every
+            value a JSON encoded column) into the current schema. '''
+
+        self.cur.execute(u'ALTER TABLE Tasks RENAME TO Tasks_dictlitestore')
+        for sql in SCHEMA:
+            self.cur.execute(sql)
+
+        rows = self.cur.execute(
+            u'SELECT * FROM Tasks_dictlitestore ORDER BY rowid').fetchall()
+
+        for row in rows:
+            task = {}
+            for key in row.keys():
+                if key != 'Id' and row[key] is not None:
+                    task[key] = json.loads(row[key])
+            if not 'uid' in task:
+                task['uid'] = uuid1().hex
+            if not 'group' in task:
+                task['group'] = 'none'
+            self.save(task)
+
+        self.cur.execute(u'DROP TABLE Tasks_dictlitestore')
+
+    def rebuild_groups(self):
+        ''' throw away TaskGroups, and fill it again from Tasks '''
+
+        with self.transaction():
+            self.cur.execute(u'DELETE FROM TaskGroups')
+            rows = self.cur.execute(
+                u'SELECT id, "group", state, priority, run_at FROM Tasks'
+                ).fetchall()
+            for task_id, group, state, priority, run_at in rows:
+                self._set_groups(task_id, _decode_group(group), state,
+                                 priority, run_at)
+
+    def rebuild_counts(self):
+        ''' throw away GroupCounts, and count everything again '''
+
+        with self.transaction():
+            self.cur.execute(u'DELETE FROM GroupCounts')
+            self.cur.execute(
+                u'INSERT INTO GroupCounts("group", state, count)'
+                u' SELECT "group", IFNULL(state, \'\'), Count(*)'
+                u' FROM TaskGroups GROUP BY "group", IFNULL(state, \'\')')
+
+    def check(self):
+        ''' integrity check: rebuild TaskGroups and GroupCounts from the
+            Tasks table.  Returns a list of the (group, state, was, is)
+            counts that were wrong. '''
+
+        with self.transaction():
+            before = dict(((g, s), c) for g, s, c in self.cur.execute(
+                u'SELECT "group", state, count FROM GroupCounts'))
+
+            self.rebuild_groups()
+            self.rebuild_counts()
+
+            after = dict(((g, s), c) for g, s, c in self.cur.execute(
+                u'SELECT "group", state, count FROM GroupCounts'))
+
+        return sorted((g, s, before.get((g, s), 0), after.get((g, s), 0))
+                      for g, s in set(before) | set(after)
+                      if before.get((g, s), 0) != after.get((g, s), 0))
+
+    _INSERT_GROUP = (u'INSERT INTO TaskGroups(task_id, "group", state,'
+                     u'                       priority, run_at)'
+                     u' VALUES (?, ?, ?, ?, ?)')
+
+    def _set_groups(self, task_id, group, state, priority, run_at):
+        ''' (re)write the TaskGroups rows for one task '''
+
+        self.cur.execute(u'DELETE FROM TaskGroups WHERE task_id = ?',
+                         (task_id,))
+        self.cur.executemany(
+            self._INSERT_GROUP,
+            [(task_id, unicode(g), state, priority, run_at)
+             for g in _group_list(group)])
+
+    _INSERT_DEP = (u'INSERT OR IGNORE INTO TaskDeps(depends_on, task_id)'
+                   u' SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM Tasks'
+                   u'   WHERE uid = ? AND state = \'finished\')'
+                   u' AND NOT EXISTS (SELECT 1 FROM ArchivedFinished'
+                   u'   WHERE uid = ?)')
+
+    def _set_deps(self, task_id, depends_on):
+        ''' (re)write the TaskDeps rows for one task, from the list of uids
+            it depends on (skipping any which have already finished).  If
+            it's 'new' and not waiting for anything, it's made ready, or if
+            failures cascade and one of them has failed, it fails too. '''
+
+        self.cur.execute(u'DELETE FROM TaskDeps WHERE task_id = ?',
+                         (task_id,))
+        self.cur.executemany(self._INSERT_DEP,
+                             [(uid, task_id, uid, uid) for uid in depends_on])
+
+        if self.cascade:
+            failed = self.cur.execute(
+                u'SELECT state FROM Tasks WHERE state IN (\'failed\','
+                u' \'cancelled\') AND uid IN (SELECT depends_on FROM'
+                u' TaskDeps WHERE task_id = ?) LIMIT 1', (task_id,)).fetchone()
+            if failed:
+                now = time()
+                self.cur.execute(
+                    u'UPDATE Tasks SET state = ?, updated_at = ?,'
+                    u' finished_at = ?, data = json_merge(data, ?)'
+                    u' WHERE id = ? AND state = \'new\'',
+                    (failed[0], now, now,
+                     json.dumps({'errcode': ERR_DEPENDENCY_FAILED}), task_id))
+                return
+
+        self.cur.execute(
+            u'UPDATE Tasks SET state = \'ready\' WHERE id = ?'
+            u' AND state = \'new\' AND NOT EXISTS'
+            u' (SELECT 1 FROM TaskDeps WHERE task_id = Tasks.id)', (task_id,))
+
+    @timed('json_decode')
+    def _row_to_task(self, row):
+        ''' turn a Tasks row back into a task dict '''
+        task = json.loads(row['data'])
+        for col in TASK_COLUMNS:
+            if row[col] is not None:
+                task[col] = row[col]
+        task['group'] = _decode_group(row['group'])
+        return task
+
+    @timed('sql_find')
+    def find(self, group=None, state=None, limit=None):
+        ''' all tasks (in order) of this group and/or state '''
+
+        if group:
+            sql = (u'SELECT Tasks.* FROM TaskGroups'
+                   u' JOIN Tasks ON Tasks.id = TaskGroups.task_id'
+                   u' WHERE TaskGroups."group" = ?')
+            values = [group]
+            if state:
+                sql += u' AND TaskGroups.state = ?'
+                values.append(state)
+            sql += u' ORDER BY TaskGroups.task_id'
+        elif state:
+            sql = u'SELECT * FROM Tasks WHERE state = ? ORDER BY id'
+            values = [state]
+        else:
+            sql = u'SELECT * FROM Tasks ORDER BY id'
+            values = []
+
+        if limit:
+            sql += u' LIMIT {0:d}'.format(limit)
+
+        return [self._row_to_task(row) for row in
+                self.cur.execute(sql, values)]
+
+    def iterate(self, group=None, state=None, fields=None, limit=None,
+                order='id', page_size=500):
+        ''' like find, but a generator, reading page_size tasks at a time
+            (each page is its own query, starting after the last id seen,
+            so it never holds the database open for long, and never gets
+            slower further on).  fields limits which fields each task dict
+            has (the JSON data isn't decoded at all if they're all
+            TASK_COLUMNS).  order is 'id' (oldest first) or '-id'. '''
+
+        if order not in ('id', '-id'):
+            raise ValueError('order must be id or -id')
+        newest_first = order == '-id'
+
+        if fields is None:
+            wanted = None
+            columns = u'Tasks.*'
+        else:
+            wanted = set(fields)
+            columns = u', '.join(
+                [u'Tasks.id'] +
+                [u'Tasks."{0}"'.format(c) for c in TASK_COLUMNS
+                 if c in wanted] +
+                ([u'Tasks.data'] if wanted - set(TASK_COLUMNS) else []))
+
+        sql, values = self._page_query(columns, group, state, newest_first)
+
+        last = (1 << 63) - 1 if newest_first else 0
+        left = limit
+
+        while left is None or left > 0:
+            page = page_size if left is None else min(page_size, left)
+            rows = self.cur.execute(sql, values + [last, page]).fetchall()
+
+            for row in rows:
+                yield self._row_to_fields(row, wanted)
+
+            if len(rows) < page:
+                return
+            last = rows[-1]['id']
+            if left is not None:
+                left -= len(rows)
+
+    @staticmethod
+    def _page_query(columns, group, state, newest_first):
+        ''' (for iterate) the SQL for one page of tasks, and its values,
+            which need the last id seen and the page size adding. '''
+
+        if group:
+            sql = (u'SELECT {0} FROM TaskGroups'
+                   u' JOIN Tasks ON Tasks.id = TaskGroups.task_id'
+                   u' WHERE TaskGroups."group" = ?'.format(columns))
+            values = [group]
+            if state:
+                sql += u' AND TaskGroups.state = ?'
+                values.append(state)
+            key = u'TaskGroups.task_id'
+        else:
+            sql = u'SELECT {0} FROM Tasks WHERE 1'.format(columns)
+            values = []
+            if state:
+                sql += u' AND Tasks.state = ?'
+                values.append(state)
+            key = u'Tasks.id'
+
+        sql += u' AND {0} {1} ? ORDER BY {0} {2} LIMIT ?'.format(
+            key, u'<' if newest_first else u'>',
+            u'DESC' if newest_first else u'ASC')
+
+        return sql, values
+
+    def _row_to_fields(self, row, wanted):
+        ''' _row_to_task, but only the fields in wanted (if it's not None) '''
+
+        if wanted is None:
+            return self._row_to_task(row)
+
+        keys = row.keys()
+        task = json.loads(row['data']) if 'data' in keys else {}
+        for col in TASK_COLUMNS:
+            if col in keys and row[col] is not None:
+                task[col] = row[col]
+        if 'group' in task:
+            task['group'] = _decode_group(task['group'])
+        return dict((k, v) for k, v in task.items() if k in wanted)
+
+    # (group, now, limit), one TaskGroups_next index seek:
+    _NEXT_READY = (
+        u'SELECT Tasks.* FROM TaskGroups'
+        u' JOIN Tasks ON Tasks.id = TaskGroups.task_id'
+        u' WHERE TaskGroups."group" = ? AND TaskGroups.state = \'ready\''
+        u' AND (TaskGroups.run_at IS NULL OR TaskGroups.run_at <= ?)'
+        u' ORDER BY TaskGroups.priority DESC, TaskGroups.task_id'
+        u' LIMIT ?')
+
+    @timed('sql_next_ready')
+    def next_ready(self, group, limit=1, now=None):
+        ''' the next (up to limit) ready tasks of group, highest priority
+            first, skipping any whose run_at hasn't come yet. '''
+
+        return [self._row_to_task(row) for row in self.cur.execute(
+            self._NEXT_READY, (group, now or time(), limit))]
+
+    @timed('sql_get')
+    def get(self, uid):
+        ''' the task with this uid, or None '''
+        row = self.cur.execute(u'SELECT * FROM Tasks WHERE uid = ?',
+                               (uid,)).fetchone()
+        return self._row_to_task(row) if row else None
+
+    def have(self, uids):
+        ''' the set of those uids which are saved here '''
+        uids = list(uids)
+        found = set()
+        for start in range(0, len(uids), 500):
+            part = uids[start:start + 500]
+            found.update(row[0] for row in self.cur.execute(
+                u'SELECT uid FROM Tasks WHERE uid IN ({0})'.format(
+                    u','.join(u'?' * len(part))), part))
+        return found
+
+    @timed('sql_group_counts')
+    def group_counts(self):
+        ''' rows of (group, state, count) for every group '''
+        return [(group, state or None, count) for group, state, count in
+                self.cur.execute(u'SELECT "group", state, count'
+                                 u' FROM GroupCounts WHERE count > 0')]
+
+    _INSERT = (u'INSERT INTO Tasks(uid, state, "group", priority, run_at,'
+               u'                  queued_at, updated_at, data,'
+               u'                  claimed_at, started_at, finished_at,'
+               u'                  dedup_key)'
+               u' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    @staticmethod
+    def _insert_values(task, now):
+        ''' the values for _INSERT, for this task '''
+        return (task['uid'],
+                task.get('state'),
+                _encode_group(task.get('group', 'none')),
+                int(task.get('priority', 0)),
+                task.get('run_at'),
+                task.get('queued_at', now),
+                now,
+                json.dumps(dict((k, v) for k, v in task.items()
+                                if k not in TASK_COLUMNS), default=unicode),
+                task.get('claimed_at'),
+                task.get('started_at'),
+                task.get('finished_at'),
+                task.get('dedup_key'))
+
+    _FIND_DUPLICATE = (u'SELECT uid FROM Tasks WHERE dedup_key = ?'
+                       u' AND uid != ? AND ' + UNFINISHED)
+
+    def _duplicate(self, task):
+        ''' the uid of the (other) unfinished task with the same dedup_key
+            as (unfinished) task, if there is one.  (one Tasks_dedup
+            lookup) '''
+
+        if task.get('dedup_key') is None or \
+           task.get('state') not in ('new', 'ready', 'running'):
+            return None
+
+        row = self.cur.execute(self._FIND_DUPLICATE,
+                               (task['dedup_key'], task['uid'])).fetchone()
+        return row[0] if row else None
+
+    def _save_duplicate(self, task, existing, on_duplicate):
+        ''' task duplicates existing: with on_duplicate='merge', save its
+            fields into existing (which keeps its state, group & place in
+            the queue).  Returns existing. '''
+
+        if on_duplicate == 'merge':
+            keep = ('state', 'group', 'queued_at', 'dedup_key')
+            self.save(dict(((k, v) for k, v in task.items()
+                            if k not in keep), uid=existing))
+        return existing
+
+    @timed('sql_save')
+    def save(self, task, on_duplicate='skip'):
+        ''' insert task, or if its uid is already there, update it.  Fields
+            not mentioned in task are left as they were.  Changing the state
+            ends any lease on the task (see claim).
+
+            A new task with the same dedup_key as one which hasn't finished
+            yet isn't added: instead, with on_duplicate='skip' nothing
+            happens, and with 'merge' its fields are saved into the existing
+            one (which keeps its state, group & place in the queue).  The
+            same goes for an update which would make a task unfinished (or
+            give it a dedup_key) while another unfinished task has its key:
+            the task is left as it was.  Returns the uid of the task which
+            was saved (the existing one, if so). '''
+
+        now = time()
+        payload = dict((k, v) for k, v in task.items()
+                       if k not in TASK_COLUMNS)
+
+        with self.transaction():
+            row = self.cur.execute(
+                u'SELECT id, state, dedup_key, data FROM Tasks WHERE uid = ?',
+                (task['uid'],)).fetchone()
+
+            if row is None:
+                existing = self._duplicate(task)
+                if existing:
+                    return self._save_duplicate(task, existing, on_duplicate)
+
+                self.cur.execute(self._INSERT, self._insert_values(task, now))
+                task_id = self.cur.lastrowid
+                self._set_groups(task_id,
+                                 task.get('group', 'none'), task.get('state'),
+                                 int(task.get('priority', 0)),
+                                 task.get('run_at'))
+                if task.get('depends_on'):
+                    self._set_deps(task_id, task['depends_on'])
+                return task['uid']
+
+            existing = self._duplicate({
+                'uid': task['uid'],
+                'state': task.get('state', row['state']),
+                'dedup_key': task.get('dedup_key', row['dedup_key'])})
+            if existing:
+                return self._save_duplicate(task, existing, on_duplicate)
+
+            data = json.loads(row['data'])
+            depends_on = data.get('depends_on')
+            data.update(payload)
+
+            sets = [u'updated_at = ?', u'data = ?']
+            values = [now, json.dumps(data, default=unicode)]
+
+            for col in ('state', 'group', 'priority', 'run_at',
+                        'dedup_key') + LIFECYCLE_COLUMNS:
+                if col in task:
+                    sets.append(u'"{0}" = ?'.format(col))
+                    if col == 'group':
+                        values.append(_encode_group(task[col]))
+                    elif col == 'priority':
+                        values.append(int(task[col]))
+                    else:
+                        values.append(task[col])
+
+            if 'state' in task and task['state'] != row['state']:
+                sets.append(u'lease_expires = NULL, lease_host = NULL,'
+                            u' lease_pid = NULL')
+
+            self.cur.execute(u'UPDATE Tasks SET ' + u', '.join(sets) +
+                             u' WHERE id = ?', values + [row['id']])
+
+            if 'group' in task:
+                self._set_groups(row['id'], task['group'], *self.cur.execute(
+                    u'SELECT state, priority, run_at FROM Tasks WHERE id = ?',
+                    (row['id'],)).fetchone())
+
+            if data.get('depends_on') != depends_on:
+                self._set_deps(row['id'], data.get('depends_on') or [])
+
+            return task['uid']
+
+    @timed('sql_save_many')
+    def save_many(self, tasks, chunk_size=500, on_duplicate='skip'):
+        ''' save every task in (any iterable of) tasks, chunk_size tasks
+            per transaction.  Brand new tasks are written with one prepared
+            INSERT per chunk; any which are already in the database (or
+            duplicate a dedup_key) are merged in, as with save().  Returns
+            the list of uids (of the existing tasks, for duplicates). '''
+
+        uids = []
+        tasks = iter(tasks)
+
+        while True:
+            chunk = list(islice(tasks, chunk_size))
+            if not chunk:
+                return uids
+
+            now = time()
+            with self.transaction():
+                existing = set(row[0] for row in self.cur.execute(
+                    u'SELECT uid FROM Tasks WHERE uid IN ({0})'.format(
+                        u','.join(u'?' * len(chunk))),
+                    [task['uid'] for task in chunk]))
+
+                keys = [task['dedup_key'] for task in chunk
+                        if task.get('dedup_key') is not None]
+                pending = set()
+                if keys:
+                    pending = set(row[0] for row in self.cur.execute(
+                        u'SELECT dedup_key FROM Tasks WHERE dedup_key IN ({0})'
+                        u' AND {1}'.format(u','.join(u'?' * len(keys)),
+                                           UNFINISHED), keys))
+
+                new = []
+                merge = []
+                for task in chunk:
+                    key = task.get('dedup_key')
+                    if task['uid'] in existing or key in pending:
+                        merge.append(task)
+                    else:
+                        existing.add(task['uid'])
+                        if key is not None and task.get('state') in \
+                                ('new', 'ready', 'running'):
+                            pending.add(key)
+                        new.append(task)
+
+                self.cur.executemany(self._INSERT,
+                                     [self._insert_values(task, now)
+                                      for task in new])
+
+                if new:
+                    ids = dict((uid, task_id) for task_id, uid in
+                               self.cur.execute(
+                                   u'SELECT id, uid FROM Tasks'
+                                   u' WHERE uid IN ({0})'.format(
+                                       u','.join(u'?' * len(new))),
+                                   [task['uid'] for task in new]))
+
+                    self.cur.executemany(
+                        self._INSERT_GROUP,
+                        [(ids[task['uid']], unicode(g), task.get('state'),
+                          int(task.get('priority', 0)), task.get('run_at'))
+                         for task in new
+                         for g in _group_list(task.get('group', 'none'))])
+
+                    for task in new:
+                        if task.get('depends_on'):
+                            self._set_deps(ids[task['uid']],
+                                           task['depends_on'])
+
+                saved = dict((task['uid'], task['uid']) for task in new)
+                for task in merge:
+                    saved[task['uid']] = self.save(task, on_duplicate)
+
+            uids.extend(saved[task['uid']] for task in chunk)
+
+    # What latency measures, and its SQL (all by the Tasks_finished index):
+    # how many finished in each group (since), and then for each measure,
+    # the tasks in one group to count or sort ({0} the measure, (since,
+    # group)).
+    LATENCY_MEASURES = (
+        ('wait', u'IFNULL(claimed_at, started_at) - queued_at'),
+        ('run', u'finished_at - IFNULL(started_at, claimed_at)'))
+
+    _FINISHED_COUNTS = (u'SELECT "group", COUNT(*), TOTAL(state = \'failed\')'
+                        u' FROM Tasks WHERE finished_at >= ?'
+                        u' GROUP BY "group" ORDER BY "group"')
+
+    _FINISHED_IN_GROUP = (u'FROM Tasks WHERE finished_at >= ? AND "group" = ?'
+                          u' AND ({0}) IS NOT NULL')
+
+    def latency(self, since, percentiles=(50, 95, 99)):
+        ''' for each group, of the tasks which finished since then: how many
+            finished (& failed), and percentiles of how long they waited
+            (queued to claimed) and ran (started to finished).  All done in
+            SQL: a count, and then one ORDER BY ... LIMIT 1 OFFSET n per
+            percentile, so only the answers are ever loaded. '''
+
+        report = []
+        for group, finished, failed in self.cur.execute(
+                self._FINISHED_COUNTS, (since,)).fetchall():
+
+            stats = {'group': _decode_group(group), 'finished': finished,
+                     'failed': int(failed)}
+
+            for name, expr in self.LATENCY_MEASURES:
+                sql = self._FINISHED_IN_GROUP.format(expr)
+                count = self.cur.execute(u'SELECT COUNT(*) ' + sql,
+                                         (since, group)).fetchone()[0]
+                stats[name] = {}
+                for pct in percentiles if count else ():
+                    # (nearest rank)
+                    rank = max(0, min(count - 1,
+                                      -(-pct * count // 100) - 1))
+                    stats[name]['p{0}'.format(pct)] = self.cur.execute(
+                        u'SELECT {0} AS v '.format(expr) + sql +
+                        u' ORDER BY v LIMIT 1 OFFSET ?',
+                        (since, group, rank)).fetchone()[0]
+
+            report.append(stats)
+        return report
+
+    # the task columns which update_where can change directly:
+    UPDATABLE_COLUMNS = ('state', 'priority', 'run_at', 'attempts')
+
+    @timed('sql_update_where')
+    def update_where(self, filters, changes):
+        ''' change every task matching filters in one UPDATE statement.
+            filters can have 'group', 'state' (one, or a list) and 'before'
+            (only tasks last updated before then).  changes is a dict of
+            fields to set, as with save (but not 'group').  Changing the
+            state ends any lease.  Tasks which would then duplicate the
+            dedup_key of a pending task are skipped, and tasks made 'ready'
+            which are still waiting for others (see depends_on) go back to
+            'new' instead.  Returns how many tasks were changed. '''
+
+        if 'group' in changes:
+            raise ValueError("update_where can't change tasks' groups")
+
+        now = time()
+        sets = [u'updated_at = ?']
+        values = [now]
+
+        for col in self.UPDATABLE_COLUMNS:
+            if col in changes:
+                if col == 'state' and changes[col] == 'ready':
+                    sets.append(u'state = CASE WHEN EXISTS (SELECT 1 FROM'
+                                u' TaskDeps WHERE task_id = Tasks.id)'
+                                u' THEN \'new\' ELSE ? END')
+                else:
+                    sets.append(u'"{0}" = ?'.format(col))
+                values.append(changes[col])
+
+        if 'state' in changes:
+            sets.append(u'lease_expires = NULL, lease_host = NULL,'
+                        u' lease_pid = NULL')
+        if changes.get('state') == 'ready':
+            # (back in the queue, so whatever happened last time is over)
+            sets.append(u'claimed_at = NULL, started_at = NULL,'
+                        u' finished_at = NULL')
+
+        payload = dict((k, v) for k, v in changes.items()
+                       if k not in TASK_COLUMNS)
+        if payload:
+            sets.append(u'data = json_merge(data, ?)')
+            values.append(json.dumps(payload, default=unicode))
+
+        where = []
+        if filters.get('group'):
+            where.append(u'id IN (SELECT task_id FROM TaskGroups'
+                         u' WHERE "group" = ?)')
+            values.append(filters['group'])
+        if filters.get('state'):
+            states = filters['state']
+            if not isinstance(states, (list, tuple)):
+                states = [states]
+            where.append(u'state IN ({0})'.format(
+                u','.join(u'?' * len(states))))
+            values.extend(states)
+        if filters.get('before') is not None:
+            where.append(u'updated_at < ?')
+            values.append(filters['before'])
+
+        # (OR IGNORE: a task whose dedup_key is already pending again is
+        # left as it is, rather than failing the whole update)
+        with self.transaction():
+            self.cur.execute(
+                u'UPDATE OR IGNORE Tasks SET ' + u', '.join(sets) +
+                (u' WHERE ' + u' AND '.join(where) if where else u''), values)
+            return self.cur.rowcount
+
+    def served(self):
+        ''' dict of group -> (served_at, pass), from GroupServed '''
+        return dict((group, (served_at, pas)) for group, served_at, pas in
+                    self.cur.execute(u'SELECT "group", served_at, pass'
+                                     u' FROM GroupServed'))
+
+    def mark_served(self, group, stride=1.0):
+        ''' note that group has just had a task handed out.  Groups new to
+            GroupServed start level with the least served group. '''
+
+        with self.transaction():
+            self.cur.execute(
+                u'INSERT OR IGNORE INTO GroupServed("group", pass)'
+                u' SELECT ?, IFNULL(MIN(pass), 0) FROM GroupServed', (group,))
+            self.cur.execute(
+                u'UPDATE GroupServed SET served_at = ?, pass = pass + ?'
+                u' WHERE "group" = ?', (time(), stride, group))
+
+    @timed('sql_claim')
+    def claim(self, uid, group, new_state, limit, lease=None, owner=None):
+        ''' atomically move task uid from 'ready' to new_state, but only if
+            group is still below limit.  The limit check and the state change
+            are one conditional UPDATE of a single row.  Returns True if this
+            connection got the task.  With lease (seconds), the task is
+            leased to owner (host, pid) until then: see renew & expire. '''
+
+        now = time()
+        host, pid = owner or (None, None)
+
+        with self.transaction():
+            self.cur.execute(
+                u'UPDATE Tasks SET state = ?, updated_at = ?, claimed_at = ?,'
+                u'  attempts = attempts + 1,'
+                u'  lease_expires = ?, lease_host = ?, lease_pid = ?'
+                u' WHERE uid = ? AND state = \'ready\''
+                u' AND IFNULL((SELECT count FROM GroupCounts'
+                u'      WHERE "group" = ? AND state = \'running\'), 0) < ?',
+                (new_state, now, now, now + lease if lease else None,
+                 host if lease else None, pid if lease else None,
+                 uid, group, limit))
+            return self.cur.rowcount == 1
+
+    def archive(self, filename, states, before=None, keep=None):
+        ''' move tasks in (finished) states into the archive database
+            filename: any last updated before the timestamp before, and any
+            more than the newest keep of them in each group.  It's all one
+            transaction (and bulk INSERT ... SELECT / DELETE), and the archive
+            is written first, so a crash part way can only leave some tasks
+            in both.  Returns how many tasks were moved. '''
+
+        if before is None and keep is None:
+            return 0
+
+        marks = u','.join(u'?' * len(states))
+        columns = u', '.join(u'"{0}"'.format(c) for c in ARCHIVE_COLUMNS)
+
+        self.cur.execute(u'ATTACH DATABASE ? AS archive', (filename,))
+        try:
+            with self.transaction():
+                for sql in ARCHIVE_SCHEMA:
+                    self.cur.execute(sql)
+                self._upgrade(ARCHIVE_UPGRADES)
+
+                self.cur.execute(u'CREATE TEMP TABLE IF NOT EXISTS ToArchive'
+                                 u' (id INTEGER PRIMARY KEY)')
+                self.cur.execute(u'DELETE FROM temp.ToArchive')
+
+                if before is not None:
+                    self.cur.execute(
+                        u'INSERT OR IGNORE INTO temp.ToArchive'
+                        u' SELECT id FROM Tasks WHERE state IN ({0})'
+                        u' AND updated_at < ?'.format(marks),
+                        list(states) + [before])
+
+                if keep is not None:
+                    groups = [row[0] for row in self.cur.execute(
+                        u'SELECT DISTINCT "group" FROM Tasks'
+                        u' WHERE state IN ({0})'.format(marks), list(states))]
+                    for group in groups:
+                        self.cur.execute(
+                            u'INSERT OR IGNORE INTO temp.ToArchive'
+                            u' SELECT id FROM Tasks WHERE state IN ({0})'
+                            u' AND "group" = ? ORDER BY id DESC'
+                            u' LIMIT -1 OFFSET ?'.format(marks),
+                            list(states) + [group, keep])
+
+                self.cur.execute(
+                    u'INSERT OR REPLACE INTO archive.Tasks({0}, archived_at)'
+                    u' SELECT {1}, ? FROM Tasks'
+                    u' WHERE id IN (SELECT id FROM temp.ToArchive)'.format(
+                        columns, columns.replace(u'"data"',
+                                                 u'compress("data")')),
+                    (time(),))
+                self.cur.execute(
+                    u'INSERT OR IGNORE INTO ArchivedFinished'
+                    u' SELECT uid FROM Tasks WHERE state = \'finished\''
+                    u' AND id IN (SELECT id FROM temp.ToArchive)')
+                self.cur.execute(u'DELETE FROM Tasks WHERE id IN'
+                                 u' (SELECT id FROM temp.ToArchive)')
+                moved = self.cur.rowcount
+                self.cur.execute(u'DELETE FROM temp.ToArchive')
+        finally:
+            self.cur.execute(u'DETACH DATABASE archive')
+
+        return moved
+
+    def archived(self, filename, group=None, limit=None):
+        ''' tasks from the archive database filename (newest first), as task
+            dicts, the same as find(). '''
+
+        if not exists(filename):
+            return []
+
+        sql = u'SELECT * FROM archive.Tasks'
+        values = []
+        if group:
+            sql += u' WHERE "group" = ?'
+            values.append(group)
+        sql += u' ORDER BY id DESC'
+        if limit:
+            sql += u' LIMIT {0:d}'.format(limit)
+
+        self.cur.execute(u'ATTACH DATABASE ? AS archive', (filename,))
+        try:
+            tasks = []
+            for row in self.cur.execute(sql, values).fetchall():
+                task = json.loads(zlib.decompress(row['data']))
+                for col in ARCHIVE_COLUMNS[1:-1]:
+                    if row[col] is not None:
+                        task[col] = row[col]
+                task['group'] = _decode_group(row['group'])
+                tasks.append(task)
+        finally:
+            self.cur.execute(u'DETACH DATABASE archive')
+        return tasks
+
+    def vacuum(self):
+        ''' give the space from deleted (archived) tasks back to the OS '''
+        self.cur.execute(u'VACUUM')
+
+    def renew(self, uids, lease, owner):
+        ''' push the leases on uids (which owner must still hold) on to lease
+            seconds from now.  Returns the list of those which were renewed,
+            any others have expired and been given to someone else. '''
+
+        until = time() + lease
+        renewed = []
+
+        with self.transaction():
+            for uid in uids:
+                self.cur.execute(
+                    u'UPDATE Tasks SET lease_expires = ?'
+                    u' WHERE uid = ? AND lease_host = ? AND lease_pid = ?'
+                    u' AND lease_expires IS NOT NULL',
+                    (until, uid) + tuple(owner))
+                if self.cur.rowcount == 1:
+                    renewed.append(uid)
+        return renewed
+
+    @timed('sql_expire')
+    def expire(self, max_attempts=None, now=None):
+        ''' tasks whose lease has run out (their runner died, probably) go
+            back to 'ready', or if they've already been tried max_attempts
+            times, to 'failed'.  Returns how many there were. '''
+
+        now = now or time()
+
+        with self.transaction():
+            expired = self.cur.execute(
+                u'SELECT id, attempts, data FROM Tasks'
+                u' WHERE lease_expires < ?', (now,)).fetchall()
+
+            for row in expired:
+                data = json.loads(row['data'])
+                if max_attempts and row['attempts'] >= max_attempts:
+                    state = u'failed'
+                    data['errcode'] = ERR_LEASE_EXPIRED
+                else:
+                    state = u'ready'
+
+                self.cur.execute(
+                    u'UPDATE Tasks SET state = ?, updated_at = ?, data = ?,'
+                    u'  lease_expires = NULL, lease_host = NULL,'
+                    u'  lease_pid = NULL, finished_at = ?'
+                    u' WHERE id = ?',
+                    (state, now, json.dumps(data, default=unicode),
+                     now if state == u'failed' else None, row['id']))
+
+        return len(expired)
+
+
+################################################################
+# Scheduling (which group to take the next task from):
+#
+# Each of these takes the TaskQueue, and a list of (groupname, next task)
+# for every group which could have a task handed out right now, and returns
+# the group names in the order they should be tried.  Pick one with
+# [scheduler] policy=... in the config file, or add your own to SCHEDULERS.
+
+def schedule_priority(tq, candidates): # pylint: disable=unused-argument
+    ''' the group whose next task has the highest priority (then the oldest)
+        first. '''
+    return [g for g, task in sorted(
+        candidates, key=lambda c: (-c[1]['priority'], c[1].get('queued_at')))]
+
+def schedule_oldest(tq, candidates): # pylint: disable=unused-argument
+    ''' the group whose next task has been waiting longest first. '''
+    return [g for g, task in sorted(
+        candidates, key=lambda c: c[1].get('queued_at'))]
+
+def schedule_round_robin(tq, candidates):
+    ''' the group which was least recently given a task first. '''
+    served = tq.served()
+    return [g for g, task in sorted(
+        candidates,
+        key=lambda c: (served.get(c[0], (0, 0))[0] or 0,
+                       -c[1]['priority'], c[1].get('queued_at')))]
+
+def schedule_weighted(tq, candidates):
+    ''' stride scheduling: each group gets tasks in proportion to its
+        weight= setting (default 1).  The group with the lowest 'pass'
+        (which goes up by 1/weight every time it's served) goes first, and
+        groups which have never been served before any of them. '''
+    served = tq.served()
+    return [g for g, task in sorted(
+        candidates,
+        key=lambda c: (c[0] in served, served.get(c[0], (0, 0))[1],
+                       -c[1]['priority'], c[1].get('queued_at')))]
+
+SCHEDULERS = {
+    'priority': schedule_priority,
+    'oldest': schedule_oldest,
+    'round-robin': schedule_round_robin,
+    'weighted': schedule_weighted,
+    }
 
 
 ################################################################
@@ -152,36 +1554,469 @@ class Config(object):
 class TaskQueue(object):
     ''' The actual Task Queue object. See Module docs '''
 
-    def __init__(self, config_file):
-        ''' initialise the task queue, from the config file '''
+    def __init__(self, config_file, use_lock=None):
+        ''' initialise the task queue, from the config file.  Claiming tasks
+            is atomic in the database itself, so the file lock is optional:
+            use_lock=True/False overrides the [sqlite] file_lock setting. '''
         self.config = Config(config_file)
-        self.lock = Lock(pathjoin(self.config.get('DIRS', 'db'),
-                         'TaskQueue.lock'))
-        self.db = DictLiteStore(pathjoin(self.config.get('DIRS', 'db'),
-                                'TaskQueue.db'), 'Tasks')
+        sqlite_options = self.config.sqlite()
+
+        if use_lock is None:
+            use_lock = sqlite_options['file_lock']
+
+        if use_lock:
+            self.lock = Lock(pathjoin(self.config.get('DIRS', 'db'),
+                             'TaskQueue.lock'))
+        else:
+            self.lock = None
+
+        # [metrics] enabled=yes to time & count things (see stats):
+        self.metrics = Metrics() if self.config.getboolean(
+            'metrics', 'enabled', False) else None
+        self.metrics_export = self.config.get('metrics', 'export')
+        try:
+            self.metrics_interval = float(self.config.get(
+                'metrics', 'export_interval', 10))
+        except ValueError:
+            raise InvalidConfigFile(
+                'Config file ({0}) metrics->export_interval should be a'
+                ' number'.format(config_file))
+        self._metrics_exported = 0
+
+        # tasks can depend on others (depends_on: [uid, ...]), and with
+        # [dependencies] cascade_failures=yes, fail if any of those do:
+        cascade = self.config.getboolean('dependencies', 'cascade_failures',
+                                         False)
+        self.db = TaskStore(self._shard_path('TaskQueue', ''),
+                            sqlite_options, self.metrics, cascade)
+
+        # Groups with shard=name in their section are kept in a database of
+        # their own (TaskQueue-name.db), so writing to them never waits for
+        # any other groups.  Everything else is in TaskQueue.db (self.db).
+        self.shards = OrderedDict([('', self.db)])
+        self.group_shards = {}
+        for group in self.config.groups():
+            shard = self.config.get(group, 'shard')
+            if not shard:
+                continue
+            if not shard.replace('-', '').replace('_', '').isalnum():
+                raise InvalidConfigFile(
+                    'Config file ({0}) {1}->shard should be a simple name'
+                    ' (letters, numbers, - and _)'.format(config_file,
+                                                         group))
+            if shard not in self.shards:
+                self.shards[shard] = TaskStore(
+                    self._shard_path('TaskQueue', shard), sqlite_options,
+                    self.metrics, cascade)
+            self.group_shards[group] = shard
+
+        policy = self.config.get('scheduler', 'policy', 'priority')
+        try:
+            self.scheduler = SCHEDULERS[policy]
+        except KeyError:
+            raise InvalidConfigFile(
+                'Config file ({0}) scheduler->policy must be one of {1}'
+                .format(config_file, ', '.join(sorted(SCHEDULERS))))
+
+        # claimed tasks are leased for lease_time seconds, and runners have
+        # to keep renewing them (0 means no leases, tasks are just claimed):
+        try:
+            self.lease_time = float(self.config.get('leases', 'time', 300))
+            self.max_attempts = int(self.config.get('leases',
+                                                    'max_attempts', 3))
+        except ValueError:
+            raise InvalidConfigFile(
+                'Config file ({0}) leases->time and max_attempts should be'
+                ' numbers'.format(config_file))
+
+        self.archive_path = self._shard_path('TaskArchive', '')
+        self.wakeup_path = pathjoin(self.config.get('DIRS', 'db'),
+                                    'TaskQueue.wakeup')
+        self._wakeup_writer = None
+        self._wakeup_fifo = None
+        # (inside transaction(): whether anything wants to notify, after)
+        self._notify_later = None
+        self.persistent = False
+
+    def open(self):
+        ''' open the database, and keep it open until close().  For long
+            lived processes (task runners, etc) so that the config is read
+            and the database connected only once.  Every operation is still
+            its own short transaction, and 'with' blocks still work (they
+            just take the lock, if there is one). '''
+
+        for store in self.shards.values():
+            if store.db is None:
+                store.open()
+        self.persistent = True
+        return self
+
+    def close(self):
+        ''' close the database (and wakeup fifo, if listening).  Only needed
+            after open(), 'with' blocks do this themselves. '''
+
+        self.persistent = False
+        for store in self.shards.values():
+            if store.db is not None:
+                store.close()
+        if self._wakeup_writer is not None:
+            os.close(self._wakeup_writer)
+            self._wakeup_writer = None
+            try:
+                os.remove(self._wakeup_fifo)
+            except OSError:
+                pass
+
+    def listen(self):
+        ''' get a file descriptor which becomes readable whenever tasks are
+            saved (see notify), so runners can select() on it rather than
+            polling.  Returns None if the wakeup fifo can't be used, in which
+            case, poll.  Read (and ignore) whatever arrives.
+
+            Each listening TaskQueue has a fifo of its own (TaskQueue.wakeup.
+            <pid>.<id>, removed by close()), so every one of them is woken. '''
+
+        if self._wakeup_fifo is not None:
+            try:
+                return os.open(self._wakeup_fifo, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                return None
+
+        # (made under another name, and only renamed once it has a reader,
+        # so notify() never mistakes it for one whose listener has gone)
+        fifo = '{0}.{1}.{2}'.format(self.wakeup_path, os.getpid(),
+                                    uuid1().hex[:8])
+        fd = None
+        try:
+            os.mkfifo(fifo + '.new')
+            fd = os.open(fifo + '.new', os.O_RDONLY | os.O_NONBLOCK)
+            # Keep a writer open too, otherwise once the last notify()
+            # closes its end, the fifo would look readable (EOF) for ever.
+            self._wakeup_writer = os.open(fifo + '.new',
+                                          os.O_WRONLY | os.O_NONBLOCK)
+            os.rename(fifo + '.new', fifo)
+        except OSError:
+            if fd is not None:
+                os.close(fd)
+            if self._wakeup_writer is not None:
+                os.close(self._wakeup_writer)
+                self._wakeup_writer = None
+            if exists(fifo + '.new'):
+                os.remove(fifo + '.new')
+            return None
+
+        self._wakeup_fifo = fifo
+        return fd
+
+    def notify(self):
+        ''' wake up everything waiting on listen().  Never blocks, and
+            quietly does nothing if nobody is listening.  (Inside a
+            transaction(), waits until that has committed.) '''
+
+        if self._notify_later is not None:
+            self._notify_later = True
+            return
+
+        for fifo in glob(self.wakeup_path + '.*'):
+            if fifo.endswith('.new'):
+                continue
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # nobody reading it: its listener died without closing.
+                    try:
+                        os.remove(fifo)
+                    except OSError:
+                        pass
+                continue
+            try:
+                os.write(fd, '.')
+            except OSError:
+                # fifo full: they've got plenty of wakeups waiting already.
+                pass
+            finally:
+                os.close(fd)
 
     def __enter__(self):
         ''' start of with TaskQueue(...) as t: block '''
-        self.lock.lock()
-        self.db.open()
+        if self.lock:
+            if self.metrics is None:
+                self.lock.lock()
+            else:
+                with self.metrics.timer('lock_wait'):
+                    self.lock.lock()
+        for store in self.shards.values():
+            if store.db is None:
+                store.open()
         return self
 
+    def _shard_path(self, name, shard):
+        ''' DIRS/db/name.db, or name-shard.db for tasks in that shard '''
+        return pathjoin(self.config.get('DIRS', 'db'), '{0}{1}.db'.format(
+            name, '-' + shard if shard else ''))
+
+    def store(self, group):
+        ''' the TaskStore (database) tasks of this group are kept in.  A
+            task in a list of groups goes in the first one's. '''
+
+        if isinstance(group, list):
+            group = group[0] if group else 'none'
+        return self.shards[self.group_shards.get(group, '')]
+
+    def _stores_for(self, groups):
+        ''' the TaskStores these groups are in (in order, no repeats) '''
+
+        stores = []
+        for group in groups:
+            if self.store(group) not in stores:
+                stores.append(self.store(group))
+        return stores
+
+    def _check_shards(self, tasks):
+        ''' raise ValueError if any of tasks (about to be saved together)
+            can't go in its group's shard: because its list of groups is
+            in more than one (it'd only be seen in the first), it's already
+            saved in another one (moving it would leave a second copy
+            behind), or it depends on a task which isn't in the same shard
+            (saved, or being saved with it): it'd never see that finish. '''
+
+        if len(self.shards) == 1:
+            return
+
+        uids = set()
+        for task in tasks:
+            uids.add(task['uid'])
+            uids.update(task.get('depends_on') or [])
+
+        where = {}
+        for store in self.shards.values():
+            for uid in store.have(uids):
+                where[uid] = store
+
+        for task in tasks:
+            if len(self._stores_for(_group_list(task['group']))) > 1:
+                raise ValueError(
+                    'Task {0} is in groups in different shards: {1}'.format(
+                        task['uid'], task['group']))
+
+            store = self.store(task['group'])
+            if where.setdefault(task['uid'], store) is not store:
+                raise ValueError(
+                    "Task {0} is in another shard: can't move it to group"
+                    " {1}".format(task['uid'], task['group']))
+
+        for task in tasks:
+            for uid in task.get('depends_on') or []:
+                if where.get(uid) is not self.store(task['group']):
+                    raise ValueError(
+                        'Task {0} depends on {1}, which is not in the same'
+                        ' shard'.format(task['uid'], uid))
+
+    @contextmanager
+    def transaction(self):
+        ''' with tq.transaction(): ... is one write transaction on each
+            shard's database, all rolled back if the block fails.  They
+            commit one after another at the end, and only then are
+            listeners woken (once) for anything saved in it. '''
+
+        outer = self._notify_later is None
+        if outer:
+            self._notify_later = False
+        wake = False
+        try:
+            with self._transactions(list(self.shards.values())):
+                yield
+            wake = outer and self._notify_later
+        finally:
+            if outer:
+                self._notify_later = None
+
+        if wake:
+            self.notify()
+
+    @contextmanager
+    def _transactions(self, stores):
+        ''' a transaction on each of stores, one inside the next '''
+
+        if not stores:
+            yield
+            return
+
+        with stores[0].transaction():
+            with self._transactions(stores[1:]):
+                yield
+
     def __exit__(self, exptype, value, tb):
         ''' end of with ... block '''
-        self.db.close()
-        self.lock.unlock()
+        if not self.persistent:
+            self.close()
+        if self.lock:
+            self.lock.unlock()
+
+    def stats(self):
+        ''' the timers & counters so far (see Metrics), or {} if [metrics]
+            aren't enabled. '''
+
+        return self.metrics.stats() if self.metrics else {}
+
+    def prometheus(self):
+        ''' the metrics (and how many tasks are in each group & state) in
+            prometheus' text format '''
+
+        text = self.metrics.prometheus() if self.metrics else ''
+        if self.db.db is not None:
+            counts = chain(*(store.group_counts()
+                             for store in self.shards.values()))
+            text += '# TYPE stq_tasks gauge\n' + ''.join(
+                'stq_tasks{{group="{0}",state="{1}"}} {2}\n'.format(
+                    group, state or '', count)
+                for group, state, count in sorted(counts))
+        return text
+
+    def export_metrics(self, force=False):
+        ''' write the metrics out to [metrics] export: either a file, or
+            unix:/path/to/socket (a local collector), if it's been
+            export_interval seconds since last time. '''
+
+        if not (self.metrics and self.metrics_export):
+            return
+        if not force and time() - self._metrics_exported < \
+           self.metrics_interval:
+            return
+        self._metrics_exported = time()
+
+        text = self.prometheus()
+        try:
+            if self.metrics_export.startswith('unix:'):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.metrics_export[5:])
+                    sock.sendall(text)
+                finally:
+                    sock.close()
+            else:
+                # (written & renamed, so it's never read half written)
+                with open(self.metrics_export + '.tmp', 'w') as outfile:
+                    outfile.write(text)
+                os.rename(self.metrics_export + '.tmp', self.metrics_export)
+        except (IOError, OSError, socket.error):
+            self.metrics.count('export_failed')
+
+    def archive(self, days=None, rows=None):
+        ''' move finished (failed & cancelled) tasks to the archive
+            database: those not touched for days, and any more than the
+            newest rows in each group.  Without arguments, uses the
+            [retention] keep_days and keep_rows settings.  Returns how many
+            were moved. '''
+
+        if days is None:
+            days = self.config.get('retention', 'keep_days')
+        if rows is None:
+            rows = self.config.get('retention', 'keep_rows')
+        states = [s.strip() for s in self.config.get(
+            'retention', 'states',
+            'finished,done,failed,cancelled').split(',')]
 
-    def tasks(self, group=None, state=None):
+        try:
+            before = None if days is None else time() - float(days) * 86400
+            keep = None if rows is None else int(rows)
+        except ValueError:
+            raise InvalidConfigFile(
+                'Config file ({0}) retention->keep_days and keep_rows should'
+                ' be numbers'.format(self.config.filename))
 
-        q = []
-        if group:
-            q.append(('group', 'LIKE', NoJSON('%"' + group + '"%')))
-        if state:
-            q.append(('state', '==', state))
+        # (each shard has its own archive, TaskArchive-shard.db)
+        return sum(store.archive(self._shard_path('TaskArchive', shard),
+                                 states, before, keep)
+                   for shard, store in self.shards.items())
 
-        return self.db.get(*q) # pylint: disable=W0142
+    def archived(self, group=None, limit=None):
+        ''' archived tasks, newest first (see archive) '''
 
+        if group:
+            shard = self.group_shards.get(group, '')
+            return self.shards[shard].archived(
+                self._shard_path('TaskArchive', shard), group, limit)
+
+        tasks = []
+        for shard, store in self.shards.items():
+            tasks += store.archived(self._shard_path('TaskArchive', shard),
+                                    None, limit)
+        if len(self.shards) > 1:
+            tasks.sort(key=lambda t: t.get('queued_at') or 0, reverse=True)
+        return tasks[:limit] if limit else tasks
+
+    def compact(self, days=None, rows=None):
+        ''' archive (see archive), and then VACUUM the database so that it
+            actually gets smaller.  Returns how many tasks were archived. '''
+
+        moved = self.archive(days, rows)
+        for store in self.shards.values():
+            store.vacuum()
+        return moved
+
+    @timed('tasks')
+    def tasks(self, group=None, state=None):
+        ''' list of all tasks, optionally only of one group and/or state '''
 
+        if group:
+            return self.store(group).find(group, state)
+        return [task for store in self.shards.values()
+                for task in store.find(group, state)]
+
+    def latency(self, window=3600):
+        ''' per group, for tasks which finished in the last window seconds:
+            how many, how many a second, and p50/p95/p99 of how long they
+            waited in the queue & took to run.  (see TaskStore.latency) '''
+
+        report = []
+        for store in self.shards.values():
+            report += store.latency(time() - window)
+        if len(self.shards) > 1:
+            report.sort(key=lambda stats: stats['group'])
+        for stats in report:
+            stats['per_second'] = stats['finished'] / float(window)
+        return report
+
+    def update_where(self, filters, changes):
+        ''' change all the tasks matching filters at once (one UPDATE, in
+            one transaction).  filters: 'group', 'state' (or a list of
+            states) and 'older_than' (seconds since they were last updated).
+            changes: fields to set.  Returns how many tasks were changed.
+            (see TaskStore.update_where) '''
+
+        filters = dict(filters)
+        if filters.get('older_than') is not None:
+            filters['before'] = time() - float(filters.pop('older_than'))
+
+        if filters.get('group'):
+            changed = self.store(filters['group']).update_where(filters,
+                                                                changes)
+        else:
+            changed = sum(store.update_where(filters, changes)
+                          for store in self.shards.values())
+        if changed and changes.get('state') == 'ready':
+            self.notify()
+        return changed
+
+    def itertasks(self, group=None, state=None, fields=None, limit=None,
+                  order='id'):
+        ''' like tasks, but goes through them a page at a time, rather than
+            loading them all at once.  fields is a list of which fields you
+            want (default all), and order is 'id' or '-id' (newest first).
+            Without a group, each shard's tasks come after the last's.
+            (see TaskStore.iterate) '''
+
+        if group or len(self.shards) == 1:
+            return self.store(group).iterate(group, state, fields, limit,
+                                             order)
+        return islice(chain(*(store.iterate(None, state, fields, limit,
+                                            order)
+                              for store in self.shards.values())), limit)
+
+
+    @timed('active_groups')
     def active_groups(self):
         ''' return a list of all groups currently in the task list, and how
             many tasks they each are running '''
@@ -193,28 +2028,9 @@ class TaskQueue(object):
 
         grouplist = defaultdict(lambda:defaultdict(lambda:0))
 
-        sql = u'SELECT Tasks."group", Tasks."state" From Tasks'
-
-        try:
-            rows = self.db.cur.execute(sql).fetchall()
-        except OperationalError as err:
-            # usually no such column, which means usually no rows.
-            rowcount = self.db.cur.execute(u'SELECT Count(id) FROM Tasks')
-            if rowcount.fetchone()[0] == 0:
-                return grouplist
-            else:
-                raise err
-
-        for rawgroups, rawstate in rows:
-
-            groups = json.loads(rawgroups)
-            state = json.loads(rawstate)
-
-            if isinstance(groups, list):
-                for g in groups:
-                    grouplist[g][state] += 1
-            else:
-                grouplist[groups][state] += 1
+        for store in self.shards.values():
+            for group, state, count in store.group_counts():
+                grouplist[group][state] += count
 
         return grouplist
 
@@ -228,52 +2044,148 @@ class TaskQueue(object):
 
         #return to_return
 
+    def check(self):
+        ''' rebuild the group membership & count tables from scratch, and
+            return a list of any (group, state, was, is) counts which had
+            got out of step. '''
+
+        return [wrong for store in self.shards.values()
+                for wrong in store.check()]
+
     def grouplimit(self, groupname):
         ''' how many tasks can be run at the same time in this group? '''
 
         return int(self.config.get(groupname, 'limit', 1))
 
+    def groupweight(self, groupname):
+        ''' this group's share of tasks, for the weighted scheduler '''
+
+        return float(self.config.get(groupname, 'weight', 1))
+
+
+    def _defaults(self, group):
+        ''' everything a task of this group gets, if it doesn't say
+            otherwise: the group's config section, then [task_defaults] '''
+
+        defaults = {}
+
+        if self.config.config.has_section('task_defaults'):
+            defaults.update(self.config.config.items('task_defaults'))
+
+        if self.config.config.has_section(group):
+            defaults.update(self.config.config.items(group))
+
+        return defaults
+
+    @staticmethod
+    def _with_defaults(task, defaults):
+        ''' fill in anything missing from task from the defaults dict '''
+
+        for k, v in defaults.items():
+            if not k in task:
+                task[k] = v
+
+        return task
+
+    def _claim(self, task, group, new_state, lease=False):
+        ''' atomically move task from 'ready' to new_state, as long as group
+            is still below its limit (and with lease, leased for lease_time).
+            Returns True if this process got the task.  (see
+            TaskStore.claim) '''
+
+        store = self.store(group)
+        lease_time = self.lease_time if lease else None
+        with store.transaction():
+            claimed = store.claim(task['uid'], group, new_state,
+                                  self.grouplimit(group), lease_time,
+                                  self._owner())
+            if claimed:
+                store.mark_served(group, 1.0 / self.groupweight(group))
+                task['attempts'] = task.get('attempts', 0) + 1
+                if lease_time:
+                    task['lease_expires'] = time() + lease_time
+            elif self.metrics:
+                self.metrics.count('claim_lost')
+        return claimed
+
+    @staticmethod
+    def _owner():
+        ''' who leases are held by: (this host, this process) '''
+        return (gethostname(), os.getpid())
+
+    def renew(self, uids):
+        ''' keep the leases on these (claimed by this process) tasks going
+            for another lease_time.  Returns the uids which are still ours
+            (the others expired, and may have been given to someone else). '''
 
-    def _getnexttask(self, group, new_state='running'):
+        if not self.lease_time:
+            return list(uids)
+
+        renewed = []
+        for store in self.shards.values():
+            left = [uid for uid in uids if uid not in renewed]
+            if not left:
+                break
+            renewed += store.renew(left, self.lease_time, self._owner())
+        return renewed
+
+    def recover(self):
+        ''' put tasks whose leases have expired back to 'ready' (or 'failed'
+            after max_attempts tries).  Done every getnexttask anyway. '''
+
+        return sum(store.expire(self.max_attempts)
+                   for store in self.shards.values())
+
+    def served(self):
+        ''' when each group was last served (see TaskStore.served), from
+            every shard '''
+
+        served = {}
+        for store in self.shards.values():
+            served.update(store.served())
+        return served
+
+    @timed('_getnexttask')
+    def _getnexttask(self, group, new_state='running', lease=False):
         ''' get the next 'ready' task of this group. This should ONLY be called
         by self.getnexttask, not by end users. getnexttask checks that limits
         haven't been reached, etc. '''
-        try:
-            task = self.tasks(group, 'ready')[0]
-            if new_state:
-                task['state'] = new_state
-                self.db.update(task, False, ('uid', '==', task['uid']))
 
-            # Now we are going to start the task, import the defaults from
-            # the group config:
-            if self.config.config.has_section(group):
-                for k, v in self.config.config.items(group):
-                    if not k in task:
-                        task[k] = v
+        while True:
+            found = self.store(group).next_ready(group)
+            if not found:
+                raise NoAvailableTasks()
+            task = found[0]
 
-            # and finally load defaults:
-            if self.config.config.has_section('task_defaults'):
-                for k, v in self.config.config.items('task_defaults'):
-                    if not k in task:
-                        task[k] = v
+            if new_state:
+                if not self._claim(task, group, new_state, lease):
+                    # someone else got there first.  If that's because the
+                    # group is now full, then stop looking.
+                    if self.active_groups()[group]['running'] \
+                            >= self.grouplimit(group):
+                        raise TooBusy()
+                    continue
+                task['state'] = new_state
 
-            return task
-        except IndexError as err:
-            import pdb; pdb.set_trace()
-            raise NoAvailableTasks()
+            return self._with_defaults(task, self._defaults(group))
 
 
-    def getnexttask(self, group=None, new_state='running'):
+    @timed('getnexttask')
+    def getnexttask(self, group=None, new_state='running', lease=False):
         ''' Get one available next task, as long as 'group' isn't overloaded.
             When the task is 'got', sets the state to new_state in the database.
-            So this can be used as an atomic action on tasks. '''
+            So this can be used as an atomic action on tasks.  With lease, the
+            task is leased (see renew), and goes back to the queue if it isn't
+            renewed in time. '''
+
+        self.recover()
 
         if group:
             running_tasks = self.active_groups()[group]['running']
             group_limit = self.grouplimit(group)
 
             if running_tasks < group_limit:
-                return self._getnexttask(group, new_state)
+                return self._getnexttask(group, new_state, lease)
             else:
                 raise TooBusy()
 
@@ -281,35 +2193,59 @@ class TaskQueue(object):
 
             all_groups = self.active_groups()
 
-            for groupname, grouptasks in all_groups.items():
-
-                # already at limit:
-                if grouptasks['running'] >= self.grouplimit(groupname):
+            for groupname in self._group_order(all_groups):
+                try:
+                    return self._getnexttask(groupname, new_state, lease)
+                except (NoAvailableTasks, TooBusy):
+                    # (someone else got there first)
                     continue
 
-                # no ready tasks:
-                if grouptasks['ready'] == 0:
-                    continue
+            self._nothing_to_do(all_groups)
 
-                # we have a winner! (a group with available tasks)
-                return self._getnexttask(groupname, new_state)
+    def _group_order(self, all_groups):
+        ''' the groups (from active_groups) which have free slots and ready
+            tasks that can run now, in the order they should be tried (which
+            is up to the scheduler policy). '''
 
-            # if there are no ready tasks at all, then raise that exception
+        now = time()
+        candidates = []
 
-            if all((g['ready'] == 0 for g in all_groups.values())):
-                raise NoAvailableTasks()
+        for groupname, grouptasks in all_groups.items():
 
-            # otherwise, there are availible tasks, but we're too busy.
+            # already at limit:
+            if grouptasks['running'] >= self.grouplimit(groupname):
+                continue
 
-            raise TooBusy()
+            # no ready tasks:
+            if grouptasks['ready'] == 0:
+                continue
 
+            found = self.store(groupname).next_ready(groupname, 1, now)
+            if found:
+                candidates.append((groupname, found[0]))
 
-    def save(self, data):
-        ''' add needed fields if they're not there, and then save to the
-            database.  If the same uuid is already there, then update it. '''
+        return self.scheduler(self, candidates)
+
+    def _nothing_to_do(self, all_groups, group=None):
+        ''' raise the right exception for when no tasks could be got: TooBusy
+            if (any of) the group(s) are full and have ready tasks waiting,
+            otherwise NoAvailableTasks. '''
+
+        for groupname in ([group] if group else all_groups.keys()):
+            if all_groups[groupname]['ready'] and \
+                    all_groups[groupname]['running'] \
+                    >= self.grouplimit(groupname):
+                raise TooBusy()
+
+        raise NoAvailableTasks()
+
+
+    def _prepare(self, data):
+        ''' add needed fields to a task if they're not there '''
 
         if 'state' not in data:
-            data['state'] = 'ready'
+            # (tasks which depend on others wait until they've finished)
+            data['state'] = 'new' if data.get('depends_on') else 'ready'
 
         if not 'uid' in data:
             data['uid'] = uuid1().hex
@@ -328,34 +2264,344 @@ class TaskQueue(object):
             data['stderr'] = abspath(pathjoin(self.config.get('DIRS', 'log'),
                                               data['stderr']))
 
-        # And save it to the database.
+        return data
+
+    @timed('getnexttasks')
+    def getnexttasks(self, n, group=None, new_state='running', lease=False):
+        ''' Get up to n available tasks at once (all claimed in one
+            transaction), never going over any group's limit.  Like
+            getnexttask (and lease), raises NoAvailableTasks or TooBusy if it
+            can't get any at all. '''
+
+        got = []
+
+        self.recover()
+        all_groups = self.active_groups()
+        order = [group] if group else self._group_order(all_groups)
+
+        # (one transaction for each database, for all its groups' tasks)
+        for store in self._stores_for(order):
+            with store.transaction():
+                for groupname in order:
+                    if self.store(groupname) is not store:
+                        continue
+                    grouptasks = all_groups[groupname]
+                    group_limit = self.grouplimit(groupname)
+                    free = group_limit - grouptasks['running']
+                    wanted = n - len(got)
+
+                    if not new_state:
+                        free = wanted
+                    if wanted <= 0:
+                        break
+                    if free <= 0 or grouptasks['ready'] == 0:
+                        continue
+
+                    defaults = self._defaults(groupname)
+
+                    for task in store.next_ready(groupname,
+                                                 min(free, wanted)):
+                        if new_state:
+                            if not self._claim(task, groupname, new_state,
+                                               lease):
+                                break
+                            task['state'] = new_state
+                        elif task['uid'] in (t['uid'] for t in got):
+                            continue
+                        got.append(self._with_defaults(task, defaults))
+
+        if got:
+            return got
+
+        self._nothing_to_do(all_groups, group)
+
+    @timed('save')
+    def save(self, data, on_duplicate='skip'):
+        ''' add needed fields if they're not there, and then save to the
+            database.  If the same uuid is already there, then update it.
+            If data has a dedup_key which an unfinished task already has,
+            then that task is returned instead (see TaskStore.save for
+            on_duplicate). '''
+
+        self._prepare(data)
+        self._check_shards([data])
+        store = self.store(data['group'])
+        uid = store.save(data, on_duplicate)
+        if uid != data['uid']:
+            return store.get(uid)
 
-        self.db.update(data, True, ('uid', '==', data['uid']))
+        if data['state'] != 'running':
+            self.notify()
 
         return data
 
+    @timed('save_many')
+    def save_many(self, tasks, chunk_size=500, on_duplicate='skip'):
+        ''' save lots of tasks (a list, generator, etc) at once.  Each task
+            gets the same defaults as with save(), and they are written in
+            transactions of chunk_size tasks.  Returns the list of uids
+            (for duplicates, the uid of the task already there). '''
+
+        tasks = (self._prepare(t) for t in tasks)
+
+        if len(self.shards) == 1:
+            uids = self.db.save_many(tasks, chunk_size, on_duplicate)
+        else:
+            # each chunk is split up by shard (and put back in order after)
+            uids = []
+            while True:
+                chunk = list(islice(tasks, chunk_size))
+                if not chunk:
+                    break
+                self._check_shards(chunk)
+                saved = {}
+                for store in self._stores_for(t['group'] for t in chunk):
+                    mine = [t for t in chunk
+                            if self.store(t['group']) is store]
+                    saved.update(zip((t['uid'] for t in mine),
+                                     store.save_many(mine, chunk_size,
+                                                     on_duplicate)))
+                uids += [saved[t['uid']] for t in chunk]
+
+        if uids:
+            self.notify()
+
+        return uids
+
     def get(self, uid):
-        ''' get a task based of its uuid '''
+        ''' get a task based of its uuid (as a list, empty if not found) '''
+
+        for store in self.shards.values():
+            task = store.get(uid)
+            if task:
+                return [task]
+        return []
+
+
+################################################################
+# asyncio:
+
+class AsyncTaskQueue(object):
+    '''
+    TaskQueue for asyncio code.  save, save_many, get, tasks & getnexttask
+    return futures (so 'await' them, or 'yield From(...)' with trollius)
+    rather than blocking the event loop.
+
+    All the database work (and the file lock, if any) is done on one
+    thread of its own, with its own connection.  Saves which arrive while
+    it's busy are written together in one transaction.
+    '''
+
+    def __init__(self, config_file, loop=None, use_lock=None):
+        if asyncio is None:
+            raise ImportError('AsyncTaskQueue needs asyncio (or trollius)')
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.taskqueue = TaskQueue(config_file, use_lock)
+        self.requests = Queue()
+        self.thread = threading.Thread(target=self._serve,
+                                       name='AsyncTaskQueue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _call(self, method, *args):
+        ''' queue up taskqueue.method(*args) for the thread, and return a
+            future of the result '''
+
+        future = asyncio.Future(loop=self.loop)
+        self.requests.put((method, args, future))
+        return future
+
+    def save(self, data, on_duplicate='skip'):
+        ''' (see TaskQueue.save) '''
+        return self._call('save', data, on_duplicate)
+
+    def save_many(self, tasks, chunk_size=500, on_duplicate='skip'):
+        ''' (see TaskQueue.save_many) '''
+        return self._call('save_many', list(tasks), chunk_size, on_duplicate)
+
+    def get(self, uid):
+        ''' (see TaskQueue.get) '''
+        return self._call('get', uid)
+
+    def tasks(self, group=None, state=None):
+        ''' (see TaskQueue.tasks) '''
+        return self._call('tasks', group, state)
+
+    def getnexttask(self, group=None, new_state='running', lease=False):
+        ''' (see TaskQueue.getnexttask).  Raises TooBusy or NoAvailableTasks
+            in the same way. '''
+        return self._call('getnexttask', group, new_state, lease)
+
+    def close(self):
+        ''' finish what's queued, close the database & stop the thread.
+            Returns a future which is done when that has all happened. '''
+        return self._call(None)
+
+    ##############################
+    # on the thread:
+
+    def _resolve(self, future, result=None, error=None):
+        ''' pass the result (or error) back to the future, on the loop '''
+
+        def resolve():
+            ''' (on the event loop thread) '''
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self.loop.call_soon_threadsafe(resolve)
+
+    def _run(self, method, args, future):
+        ''' one request, on its own '''
+        try:
+            with self.taskqueue as taskqueue:
+                self._resolve(future, getattr(taskqueue, method)(*args))
+        except Exception as err: # pylint: disable=broad-except
+            self._resolve(future, error=err)
+
+    def _save_batch(self, batch):
+        ''' several save / save_many requests in one transaction.  If any
+            fails, they're all done again one by one, so the others still
+            get saved. '''
+
+        try:
+            with self.taskqueue as taskqueue:
+                with taskqueue.transaction():
+                    results = [getattr(taskqueue, method)(*args)
+                               for method, args, _ in batch]
+        except Exception: # pylint: disable=broad-except
+            for request in batch:
+                self._run(*request)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            self._resolve(future, result)
+
+    def _serve(self):
+        ''' the thread: run requests until close() '''
+
+        self.taskqueue.open()
+        request = self.requests.get()
+
+        while request[0] is not None:
+            batch = []
+            while request[0] in ('save', 'save_many'):
+                batch.append(request)
+                try:
+                    request = self.requests.get_nowait()
+                except Empty:
+                    request = (False, None, None) # (nothing else waiting)
+                    break
+
+            if batch:
+                self._save_batch(batch)
+            if request[0]:
+                self._run(*request)
+
+            if request[0] is not None:
+                request = self.requests.get()
+
+        self.taskqueue.close()
+        self._resolve(request[2])
 
-        return self.db.get(('uid', '==', uid))
 
 ################################################################################
 # Basic Commandline interface:
 
+def parse_time(text):
+    ''' a time from the command line, as a unix timestamp.  Either a
+        timestamp already, '+N' (N seconds from now), or 'YYYY-MM-DD HH:MM'
+        (or 'YYYY-MM-DDTHH:MM:SS', etc) in local time. '''
+
+    text = text.strip()
+
+    if text.startswith('+'):
+        return time() + float(text[1:])
+
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return mktime(strptime(text, fmt))
+        except ValueError:
+            pass
+
+    raise ValueError('Not a time I understand: ' + text)
+
+def _pop_option(args, name, default=None):
+    ''' take '--name value' out of the args list, returning value '''
+
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
 
 def simple_cli(database, todo, all_args):
     ''' a simple example CLI '''
 
     with TaskQueue(database) as tq:
         if todo == 'list':
+            try:
+                limit = _pop_option(all_args, '--limit')
+                limit = None if limit is None else int(limit)
+                group = _pop_option(all_args, '--group')
+                fields = _pop_option(all_args, '--fields')
+                fields = None if fields is None else fields.split(',')
+                jsonl = _pop_option(all_args, '--format', 'text') == 'jsonl'
+                order = '-id' if '--newest' in all_args else 'id'
+                all_args = [a for a in all_args if a != '--newest']
+            except (IndexError, ValueError):
+                print 'Usage:'
+                print all_args[0], 'list [state] [--group G] [--limit N]', \
+                                   '[--fields a,b,c] [--newest]', \
+                                   '[--format text|jsonl]'
+                exit(1)
+
             state = None if len(all_args) == 3 else all_args[3]
 
-            tasks = tq.tasks(None, state)
-            print '{0} {1} tasks:'.format(len(tasks), state if state else '')
-            print '\n'.join([str(t) for t in tasks])
+            count = 0
+            for task in tq.itertasks(group, state, fields, limit, order):
+                if jsonl:
+                    print json.dumps(task, default=unicode)
+                else:
+                    print str(task)
+                count += 1
+
+            if not jsonl:
+                print '{0} {1} tasks.'.format(count, state if state else '')
+
+        elif todo == 'create' and all_args[3:4] == ['--from-jsonl']:
+            try:
+                filename = all_args[4]
+            except IndexError:
+                print 'Usage:'
+                print all_args[0], 'create --from-jsonl tasks.jsonl'
+                exit(1)
+
+            with (sys.stdin if filename == '-' else open(filename)) as jsonl:
+                uids = tq.save_many(json.loads(line) for line in jsonl
+                                    if line.strip())
+            print '{0} tasks created.'.format(len(uids))
 
         elif todo == 'create':
             try:
+                priority = int(_pop_option(all_args, '--priority', 0))
+                run_at = _pop_option(all_args, '--run-at')
+                if run_at is not None:
+                    run_at = parse_time(run_at)
+
                 tname = all_args[3]
                 tcommand = all_args[4]
                 tgroup = all_args[5]
@@ -363,15 +2609,21 @@ def simple_cli(database, todo, all_args):
                     args = all_args[6:]
                 else:
                     args = None
-            except IndexError:
+            except (IndexError, ValueError):
                 print 'Usage:'
-                print all_args[0], 'create task_name command group'
+                print all_args[0], 'create [--priority N] [--run-at TIME]', \
+                                   'task_name command group'
+                print all_args[0], 'create --from-jsonl tasks.jsonl'
+                print 'TIME is a unix timestamp, +seconds from now,', \
+                      'or "YYYY-MM-DD HH:MM"'
                 exit(1)
 
             tq.save( {'name': tname ,
                       'command': tcommand ,
                       'group': tgroup,
-                      'command_args': args})
+                      'command_args': args,
+                      'priority': priority,
+                      'run_at': run_at})
 
         elif todo == 'get':
             try:
@@ -387,12 +2639,83 @@ def simple_cli(database, todo, all_args):
             except NoAvailableTasks:
                 print 'There are no free tasks to do! Sorry!'
 
-        elif todo == 'reset':
-            for task in tq.tasks():
-                task['state'] = 'ready'
-                task['errcode'] = None
-                task['pid'] = None
-                tq.save(task)
+        elif todo == 'check':
+            wrong = tq.check()
+            for group, state, was, now in wrong:
+                print '{0} {1}: counted {2}, actually {3}'.format(
+                    group, state, was, now)
+            print '{0} group counts fixed.'.format(len(wrong))
+
+        elif todo == 'compact':
+            try:
+                days = _pop_option(all_args, '--days')
+                rows = _pop_option(all_args, '--rows')
+                moved = tq.compact(days, rows)
+            except (IndexError, InvalidConfigFile):
+                print 'Usage:'
+                print all_args[0], 'compact [--days N] [--rows N]'
+                print '(defaults from [retention] keep_days & keep_rows)'
+                exit(1)
+            print '{0} tasks archived.'.format(moved)
+
+        elif todo == 'stats':
+            try:
+                window = float(_pop_option(all_args, '--window', 3600))
+                jsonl = _pop_option(all_args, '--format', 'text') == 'jsonl'
+            except (IndexError, ValueError):
+                print 'Usage:'
+                print all_args[0], 'stats [--window SECONDS]', \
+                                   '[--format text|jsonl]'
+                exit(1)
+
+            report = tq.latency(window)
+            if jsonl:
+                for stats in report:
+                    print json.dumps(stats, default=unicode)
+            else:
+                seconds = lambda d, k: ('{0:.3f}'.format(d[k]) if k in d
+                                        else '-')
+                print '{0:<20} {1:>8} {2:>6} {3:>8}  {4:>26}  {5:>26}'.format(
+                    'group', 'finished', 'failed', 'per sec',
+                    'wait p50 / p95 / p99', 'run p50 / p95 / p99')
+                for stats in report:
+                    print ('{0:<20} {1:>8} {2:>6} {3:>8.3f}  {4:>26}  {5:>26}'
+                           .format(stats['group'], stats['finished'],
+                                   stats['failed'], stats['per_second'],
+                                   ' / '.join(seconds(stats['wait'], p)
+                                              for p in ('p50', 'p95', 'p99')),
+                                   ' / '.join(seconds(stats['run'], p)
+                                              for p in ('p50', 'p95', 'p99'))))
+
+        elif todo in ('reset', 'cancel', 'requeue-failed'):
+            try:
+                filters = {'group': _pop_option(all_args, '--group'),
+                           'state': _pop_option(all_args, '--state'),
+                           'older_than': _pop_option(all_args,
+                                                     '--older-than')}
+                if filters['state']:
+                    filters['state'] = filters['state'].split(',')
+
+                if todo == 'reset':
+                    changes = {'state': 'ready', 'errcode': None,
+                               'pid': None}
+                elif todo == 'cancel':
+                    filters['state'] = filters['state'] or ['new', 'ready']
+                    changes = {'state': 'cancelled'}
+                else:
+                    filters['state'] = ['failed']
+                    changes = {'state': 'ready', 'errcode': None,
+                               'pid': None, 'attempts': 0}
+
+                changed = tq.update_where(filters, changes)
+            except (IndexError, ValueError):
+                print 'Usage:'
+                print all_args[0], 'reset|cancel|requeue-failed', \
+                                   '[--group G] [--state S,S...]', \
+                                   '[--older-than SECONDS]'
+                exit(1)
+
+            print '{0} tasks changed.'.format(changed)
 
 if __name__ == '__main__':
     from sys import argv
@@ -401,6 +2724,7 @@ if __name__ == '__main__':
         simple_cli(argv[1].strip(), argv[2].strip(), argv)
     except IndexError:
         print 'Usage:'
-        print argv[0], 'config.ini list/create/get'
+        print argv[0], 'config.ini list/create/get/check/compact/stats'
+        print argv[0], 'config.ini reset/cancel/requeue-failed'
         exit(1)
 
@@ -1,11 +1,20 @@
 #!.virtualenv/bin/python
 
-from os.path import exists
+from os.path import exists, abspath
 from os import remove
+import os
+import sys
+import select
+import signal
+import socket
 from shutil import rmtree
+from glob import glob
 
 import unittest
+import sqlite3
+from time import time, sleep
 import stq
+import run_tasks
 
 class BaseCase(unittest.TestCase):
     ''' a generic unittest class for you to base everything off. '''
@@ -131,6 +140,52 @@ class Test_Config_get(BaseCaseClass_Config):
 
 
 
+class Test_Config_sqlite(BaseCaseClass_Config):
+    ''' Method docstring:
+     the [sqlite] settings (with defaults filled in), checked.
+    ----------
+    Args: None
+    '''
+    def add_config(self, text):
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write(text)
+        self.config = stq.Config(CONFIG_FILE)
+
+    def test_defaults(self):
+        options = self.config.sqlite()
+        self.assertEqual(options['journal_mode'], 'WAL')
+        self.assertEqual(options['busy_timeout'], 30000)
+        self.assertEqual(options['file_lock'], False)
+
+    def test_settings(self):
+        self.add_config('[sqlite]\njournal_mode=delete\nbusy_timeout=10\n'
+                        'file_lock=yes\n')
+        options = self.config.sqlite()
+        self.assertEqual(options['journal_mode'], 'DELETE')
+        self.assertEqual(options['busy_timeout'], 10)
+        self.assertEqual(options['file_lock'], True)
+
+    def test_not_a_group(self):
+        self.add_config('[sqlite]\n[alpha]\n')
+        self.assertEqual(self.config.groups(), ['alpha'])
+
+    def test_invalid(self):
+        self.add_config('[sqlite]\njournal_mode=sideways\n')
+        with self.assertRaises(stq.InvalidConfigFile):
+            self.config.sqlite()
+
+    def test_invalid_number(self):
+        self.add_config('[sqlite]\nmmap_size=lots\n')
+        with self.assertRaises(stq.InvalidConfigFile):
+            self.config.sqlite()
+
+    def test_applied(self):
+        with stq.TaskQueue(CONFIG_FILE) as tq:
+            self.assertEqual(tq.lock, None)
+            self.assertEqual(
+                tq.db.cur.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+
 ################################################################################
 #
 # TaskQueue
@@ -161,6 +216,120 @@ class BaseCaseClass_TaskQueue(BaseCaseClass_Config):
             print line
 
 
+class Test_TaskQueue_open(BaseCase):
+    ''' Method docstring:
+    open the database, and keep it open until close().
+    ----------
+    Args: None
+    '''
+    def setUp(self):
+        make_config()
+
+    def tearDown(self):
+        remove_config()
+
+    def test_stays_open(self):
+        tq = stq.TaskQueue(CONFIG_FILE).open()
+        connection = tq.db.db
+
+        with tq:
+            tq.save({'name': 'a'})
+        with tq:
+            self.assertEqual(len(tq.tasks()), 1)
+
+        self.assertIs(tq.db.db, connection)
+
+        tq.close()
+        self.assertEqual(tq.db.db, None)
+
+    def test_plain_with_closes(self):
+        tq = stq.TaskQueue(CONFIG_FILE)
+        with tq:
+            tq.save({'name': 'a'})
+        self.assertEqual(tq.db.db, None)
+
+
+class Test_TaskQueue_listen(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    get a file descriptor which becomes readable whenever tasks are
+    saved (see notify), so runners can select() on it rather than
+    polling.
+    ----------
+    Args: None
+    '''
+    def test_notify_without_listener(self):
+        self.taskqueue.notify()
+        self.taskqueue.save({'name': 'a'})
+
+    def test_save_wakes(self):
+        fd = self.taskqueue.listen()
+        try:
+            self.assertEqual(select.select([fd], [], [], 0)[0], [])
+
+            self.taskqueue.save_many([{'name': 'a'}, {'name': 'b'}])
+
+            self.assertEqual(select.select([fd], [], [], 0)[0], [fd])
+            os.read(fd, 512)
+            self.assertEqual(select.select([fd], [], [], 0)[0], [])
+        finally:
+            os.close(fd)
+
+    def test_after_transaction(self):
+        fd = self.taskqueue.listen()
+        try:
+            with self.taskqueue.transaction():
+                self.taskqueue.save({'name': 'a'})
+                self.taskqueue.save({'name': 'b'})
+                self.assertEqual(select.select([fd], [], [], 0)[0], [])
+
+            self.assertEqual(select.select([fd], [], [], 0)[0], [fd])
+            self.assertEqual(os.read(fd, 512), '.')
+        finally:
+            os.close(fd)
+
+    def test_not_after_rollback(self):
+        fd = self.taskqueue.listen()
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                with self.taskqueue.transaction():
+                    self.taskqueue.save({'name': 'a'})
+                    1 / 0
+
+            self.assertEqual(select.select([fd], [], [], 0)[0], [])
+            self.taskqueue.notify()
+            self.assertEqual(select.select([fd], [], [], 0)[0], [fd])
+        finally:
+            os.close(fd)
+
+    def test_wakes_everyone(self):
+        others = [stq.TaskQueue(CONFIG_FILE) for _ in range(2)]
+        fds = [tq.listen() for tq in others]
+        try:
+            self.taskqueue.save({'name': 'a'})
+
+            self.assertEqual(sorted(select.select(fds, [], [], 0)[0]),
+                             sorted(fds))
+        finally:
+            for fd in fds:
+                os.close(fd)
+            for tq in others:
+                tq.close()
+
+    def test_close_removes_fifo(self):
+        os.close(self.taskqueue.listen())
+        self.assertEqual(len(glob(self.taskqueue.wakeup_path + '.*')), 1)
+
+        self.taskqueue.close()
+        self.assertEqual(glob(self.taskqueue.wakeup_path + '.*'), [])
+
+    def test_dead_listener(self):
+        fifo = self.taskqueue.wakeup_path + '.1.dead'
+        os.mkfifo(fifo)
+
+        self.taskqueue.notify()
+        self.assertFalse(exists(fifo))
+
+
 class Test_TaskQueue_tasks(BaseCaseClass_TaskQueue):
     ''' Method docstring:
     None
@@ -281,11 +450,45 @@ class Test_TaskQueue_active_groups(BaseCaseClass_TaskQueue):
 
 
 
+class Test_TaskQueue_check(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    rebuild the group membership & count tables from scratch, and
+    return a list of any (group, state, was, is) counts which had
+    got out of step.
+    ----------
+    Args: None
+    '''
+    def test_empty(self):
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_counts_follow_state(self):
+        sent = self.taskqueue.save({'name': 'a', 'group': ['alpha', 'beta']})
+        self.taskqueue.getnexttask('alpha')
+
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'running': 1}, 'beta': {'running': 1}})
+
+        sent['state'] = 'finished'
+        self.taskqueue.save(sent)
+
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'finished': 1}, 'beta': {'finished': 1}})
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_fixes_wrong_counts(self):
+        self.taskqueue.save({'name': 'a', 'group': 'alpha'})
+        self.taskqueue.db.cur.execute('UPDATE GroupCounts SET count = 7')
+
+        self.assertEqual(self.taskqueue.check(), [('alpha', 'ready', 7, 1)])
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'ready': 1}})
+
+
 class Test_TaskQueue_getnexttask(BaseCaseClass_TaskQueue):
     ''' Method docstring:
     None
     ----------
-    Args: ['group', 'new_state']
+    Args: ['group', 'new_state', 'lease']
     '''
     def test_empty_args(self):
         with self.assertRaises(stq.NoAvailableTasks):
@@ -396,6 +599,1221 @@ class Test_TaskQueue_getnexttask(BaseCaseClass_TaskQueue):
 
         self.assertDictContainsSubset( sent, self.taskqueue.getnexttask())
 
+    def test_claim_is_conditional(self):
+        ''' a task which is no longer 'ready' can't be claimed twice '''
+
+        sent = self.taskqueue.save({'name': 'read a book'})
+
+        self.assertTrue(self.taskqueue._claim(sent, 'none', 'running'))
+        self.assertFalse(self.taskqueue._claim(sent, 'none', 'running'))
+
+    def test_claim_respects_limit(self):
+        ''' the group limit is checked in the same UPDATE as the claim '''
+
+        self.taskqueue.save({'name': 'read a book'})
+        sent2 = self.taskqueue.save({'name': 'sing a song'})
+
+        self.taskqueue.getnexttask('none')
+
+        self.assertFalse(self.taskqueue._claim(sent2, 'none', 'running'))
+
+        with self.assertRaises(stq.TooBusy):
+            self.taskqueue.getnexttask('none')
+
+    def test_group_without_ready_tasks(self):
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask('nothing_here')
+
+    def test_without_lock(self):
+        ''' the file lock is optional '''
+
+        unlocked = stq.TaskQueue(CONFIG_FILE, use_lock=False)
+        self.assertEqual(unlocked.lock, None)
+
+        with unlocked as tq:
+            sent = tq.save({'name': 'read a book'})
+            self.assertEqual(tq.getnexttask()['uid'], sent['uid'])
+
+
+class Test_TaskQueue_tasks_groups(BaseCaseClass_TaskQueue):
+    ''' group matching in tasks() '''
+
+    def test_single_and_list_groups(self):
+        self.taskqueue.save({'name': 'a', 'group': 'alpha'})
+        self.taskqueue.save({'name': 'b', 'group': ['alpha', 'beta']})
+        self.taskqueue.save({'name': 'c', 'group': 'beta'})
+
+        self.assertEqual([t['name'] for t in self.taskqueue.tasks('alpha')],
+                         ['a', 'b'])
+        self.assertEqual([t['name'] for t in self.taskqueue.tasks('beta')],
+                         ['b', 'c'])
+
+    def test_no_substring_matches(self):
+        ''' groups are matched exactly, not with LIKE '''
+        self.taskqueue.save({'name': 'a', 'group': 'alpha'})
+        self.taskqueue.save({'name': 'b', 'group': ['%', 'alp']})
+
+        self.assertEqual([t['name'] for t in self.taskqueue.tasks('%')],
+                         ['b'])
+        self.assertEqual([t['name'] for t in self.taskqueue.tasks('alp')],
+                         ['b'])
+        self.assertEqual(self.taskqueue.tasks('lph'), [])
+
+    def test_change_group(self):
+        sent = self.taskqueue.save({'name': 'a', 'group': ['alpha', 'beta']})
+        self.taskqueue.save({'uid': sent['uid'], 'group': 'gamma'})
+
+        self.assertEqual(self.taskqueue.tasks('alpha'), [])
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'gamma': {'ready': 1}})
+
+    def test_rebuild_groups(self):
+        ''' databases from before TaskGroups get it filled in on open '''
+        self.taskqueue.save({'name': 'a', 'group': ['alpha', 'beta']})
+        self.taskqueue.db.cur.execute('DROP TABLE TaskGroups')
+        self.taskqueue.db.close()
+        self.taskqueue.db.open()
+
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'ready': 1}, 'beta': {'ready': 1}})
+
+    def test_list_group_roundtrip(self):
+        sent = self.taskqueue.save({'name': 'a', 'group': ['alpha', 'beta']})
+
+        self.assertEqual(self.taskqueue.get(sent['uid'])[0]['group'],
+                         ['alpha', 'beta'])
+
+    def test_save_merges(self):
+        ''' saving only some fields leaves the others alone '''
+        sent = self.taskqueue.save({'name': 'a', 'other': 'stuff'})
+
+        self.taskqueue.save({'uid': sent['uid'], 'state': 'failed'})
+
+        task = self.taskqueue.get(sent['uid'])[0]
+        self.assertEqual(task['state'], 'failed')
+        self.assertEqual(task['other'], 'stuff')
+        self.assertEqual(len(self.taskqueue.tasks()), 1)
+
+    def test_lookup_by_state_and_group(self):
+        self.taskqueue.save_many(
+            {'name': str(i), 'group': ['alpha', 'beta'][i % 2],
+             'state': ['ready', 'failed', 'failed'][i % 3]} for i in range(6))
+
+        self.assertEqual([t['name'] for t in
+                          self.taskqueue.tasks('alpha', 'ready')], ['0'])
+        self.assertEqual([t['name'] for t in
+                          self.taskqueue.tasks('beta', 'failed')], ['1', '5'])
+        self.assertEqual([t['name'] for t in
+                          self.taskqueue.tasks(state='ready')], ['0', '3'])
+
+
+################################################################################
+#
+# TaskStore
+#
+################################################################################
+
+class Test_TaskStore_upgrade(BaseCase):
+    ''' databases made before some columns existed get them added '''
+
+    def setUp(self):
+        make_config()
+        stq.Config(CONFIG_FILE)
+
+        db = sqlite3.connect('__test/TaskQueue.db')
+        db.execute('CREATE TABLE Tasks (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                   ' uid TEXT NOT NULL UNIQUE, state TEXT,'
+                   ' "group" TEXT NOT NULL DEFAULT \'none\','
+                   ' priority INTEGER NOT NULL DEFAULT 0, queued_at REAL,'
+                   ' updated_at REAL, data TEXT NOT NULL DEFAULT \'{}\')')
+        db.execute('CREATE TABLE TaskGroups (task_id INTEGER NOT NULL,'
+                   ' "group" TEXT NOT NULL, state TEXT,'
+                   ' PRIMARY KEY (task_id, "group"))')
+        db.execute('INSERT INTO Tasks(uid, state, "group", priority, data)'
+                   ' VALUES (\'a\', \'ready\', \'alpha\', 0, \'{}\')')
+        db.execute('INSERT INTO Tasks(uid, state, "group", priority, data)'
+                   ' VALUES (\'b\', \'ready\', \'alpha\', 3, \'{}\')')
+        db.execute('INSERT INTO TaskGroups VALUES (1, \'alpha\', \'ready\')')
+        db.execute('INSERT INTO TaskGroups VALUES (2, \'alpha\', \'ready\')')
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        remove_config()
+
+    def test_upgrade(self):
+        with stq.TaskQueue(CONFIG_FILE) as tq:
+            self.assertEqual(tq.active_groups(), {'alpha': {'ready': 2}})
+            self.assertEqual(tq.getnexttask()['uid'], 'b')
+            self.assertEqual(tq.check(), [])
+
+
+class Test_TaskStore_migrate(BaseCase):
+    ''' old DictLiteStore databases get converted on open '''
+
+    def setUp(self):
+        make_config()
+        stq.Config(CONFIG_FILE)
+
+        db = sqlite3.connect('__test/TaskQueue.db')
+        db.execute('CREATE TABLE Tasks(Id INT, "name", "uid", "state",'
+                   ' "group", "other")')
+        db.execute('INSERT INTO Tasks VALUES (NULL, ?, ?, ?, ?, NULL)',
+                   ('"one"', '"abc"', '"ready"', '"alpha"'))
+        db.execute('INSERT INTO Tasks VALUES (NULL, ?, ?, ?, ?, ?)',
+                   ('"two"', '"def"', '"failed"', '["alpha", "beta"]',
+                    '{"x": 1}'))
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        remove_config()
+
+    def test_migrate(self):
+        with stq.TaskQueue(CONFIG_FILE) as tq:
+            tasks = tq.tasks()
+
+            self.assertEqual(len(tasks), 2)
+            self.assertDictContainsSubset(
+                {'name': 'one', 'uid': 'abc', 'state': 'ready',
+                 'group': 'alpha'}, tasks[0])
+            self.assertDictContainsSubset(
+                {'name': 'two', 'uid': 'def', 'state': 'failed',
+                 'group': ['alpha', 'beta'], 'other': {'x': 1}}, tasks[1])
+            self.assertNotIn('other', tasks[0])
+
+            self.assertEqual(tq.active_groups(),
+                             {'alpha': {'ready': 1, 'failed': 1},
+                              'beta': {'failed': 1}})
+
+        # and opening again doesn't do anything odd:
+        with stq.TaskQueue(CONFIG_FILE) as tq:
+            self.assertEqual(len(tq.tasks()), 2)
+
+    def test_data_field(self):
+        # (tasks with a 'data' field gave the old table a 'data' column too)
+        db = sqlite3.connect('__test/TaskQueue.db')
+        db.execute('ALTER TABLE Tasks ADD COLUMN "data"')
+        db.execute('INSERT INTO Tasks("Id", "name", "uid", "state", "group",'
+                   ' "data") VALUES (NULL, ?, ?, ?, ?, ?)',
+                   ('"three"', '"ghi"', '"ready"', '"alpha"', '{"y": 2}'))
+        db.commit()
+        db.close()
+
+        with stq.TaskQueue(CONFIG_FILE) as tq:
+            self.assertEqual(len(tq.tasks()), 3)
+            self.assertEqual(tq.get('ghi')[0]['data'], {'y': 2})
+            self.assertEqual(tq.active_groups()['alpha']['ready'], 2)
+
+
+class Test_TaskQueue_getnexttasks(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    Get up to n available tasks at once (all claimed in one
+    transaction), never going over any group's limit.  Like
+    getnexttask (and lease), raises NoAvailableTasks or TooBusy if it
+    can't get any at all.
+    ----------
+    Args: ['n', 'group', 'new_state', 'lease']
+    '''
+    def setUp(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[alpha]\nlimit=3\nthing=stuff\n')
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE)
+        self.taskqueue.__enter__()
+
+    def test_empty(self):
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttasks(5)
+
+    def test_limits(self):
+        self.taskqueue.save_many({'name': str(i), 'group': 'alpha'}
+                                 for i in range(5))
+        self.taskqueue.save_many({'name': str(i), 'group': 'beta'}
+                                 for i in range(5))
+
+        got = self.taskqueue.getnexttasks(10)
+
+        self.assertEqual(sorted(t['group'] for t in got),
+                         ['alpha', 'alpha', 'alpha', 'beta'])
+        self.assertTrue(all(t['state'] == 'running' for t in got))
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'running': 3, 'ready': 2},
+                          'beta': {'running': 1, 'ready': 4}})
+
+        with self.assertRaises(stq.TooBusy):
+            self.taskqueue.getnexttasks(10)
+
+    def test_n_and_group(self):
+        self.taskqueue.save_many({'name': str(i), 'group': 'alpha'}
+                                 for i in range(5))
+        self.taskqueue.save({'name': 'x', 'group': 'beta'})
+
+        got = self.taskqueue.getnexttasks(2, 'alpha')
+
+        self.assertEqual([t['name'] for t in got], ['0', '1'])
+        self.assertEqual(got[0]['thing'], 'stuff')
+        self.assertEqual(got[0]['stdout'], '__test/tasks.log')
+
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttasks(2, 'gamma')
+
+    def test_multiple_groups(self):
+        ''' a task in two groups counts towards both limits '''
+        self.taskqueue.save({'name': 'x', 'group': ['alpha', 'beta']})
+        self.taskqueue.save({'name': 'y', 'group': 'beta'})
+
+        got = self.taskqueue.getnexttasks(5)
+
+        self.assertEqual([t['name'] for t in got], ['x'])
+
+
+class Test_TaskQueue_getnexttask_priority(BaseCaseClass_TaskQueue):
+    ''' priority & run_at in the dequeue path '''
+
+    def test_priority(self):
+        self.taskqueue.save({'name': 'routine'})
+        self.taskqueue.save({'name': 'urgent', 'priority': 10})
+        self.taskqueue.save({'name': 'routine2'})
+
+        self.assertEqual(self.taskqueue.getnexttask()['name'], 'urgent')
+
+    def test_priority_across_groups(self):
+        self.taskqueue.save({'name': 'routine', 'group': 'alpha'})
+        self.taskqueue.save({'name': 'urgent', 'group': 'beta',
+                             'priority': 5})
+
+        self.assertEqual(self.taskqueue.getnexttask()['name'], 'urgent')
+        self.assertEqual(self.taskqueue.getnexttasks(5)[0]['name'],
+                         'routine')
+
+    def test_run_at(self):
+        self.taskqueue.save({'name': 'later', 'priority': 10,
+                             'run_at': time() + 3600})
+        self.taskqueue.save({'name': 'now', 'run_at': time() - 1})
+
+        sent = self.taskqueue.getnexttask()
+        self.assertEqual(sent['name'], 'now')
+
+        sent['state'] = 'finished'
+        self.taskqueue.save(sent)
+
+        # and the 'later' one isn't ready to run yet:
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask()
+
+    def test_change_priority(self):
+        self.taskqueue.save({'name': 'a'})
+        sent = self.taskqueue.save({'name': 'b'})
+        self.taskqueue.save({'uid': sent['uid'], 'priority': 1})
+
+        self.assertEqual(self.taskqueue.getnexttask()['name'], 'b')
+
+    def test_uses_index(self):
+        plan = self.taskqueue.db.cur.execute(
+            u'EXPLAIN QUERY PLAN ' + stq.TaskStore._NEXT_READY,
+            ('x', 0, 1)).fetchall()
+        plan = ' '.join(str(r[-1]) for r in plan)
+
+        self.assertIn('TaskGroups_next', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class Test_TaskQueue_scheduler(BaseCaseClass_TaskQueue):
+    ''' [scheduler] policy=..., for getnexttask(group=None) '''
+
+    def setUp(self):
+        self.taskqueue = None
+
+    def tearDown(self):
+        if self.taskqueue:
+            self.taskqueue.__exit__(None, None, None)
+        remove_config()
+
+    def use(self, policy, alpha=''):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[scheduler]\npolicy={0}\n'
+                        '[alpha]\nlimit=10\n{1}'
+                        '[beta]\nlimit=10\n'.format(policy, alpha))
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE)
+        self.taskqueue.__enter__()
+
+    def groups_served(self, n):
+        return [self.taskqueue.getnexttask()['group'] for _ in range(n)]
+
+    def test_invalid(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[scheduler]\npolicy=whenever\n')
+        with self.assertRaises(stq.InvalidConfigFile):
+            stq.TaskQueue(CONFIG_FILE)
+
+    def test_not_a_group(self):
+        self.use('priority')
+        self.assertNotIn('scheduler', self.taskqueue.config.groups())
+
+    def test_round_robin(self):
+        self.use('round-robin')
+        self.taskqueue.save_many({'name': str(i), 'group': 'alpha'}
+                                 for i in range(4))
+        self.taskqueue.save_many({'name': str(i), 'group': 'beta'}
+                                 for i in range(2))
+
+        served = self.groups_served(6)
+        self.assertEqual(served[:4].count('alpha'), 2)
+        self.assertEqual(served[:4].count('beta'), 2)
+        self.assertEqual(served[4:], ['alpha', 'alpha'])
+
+    def test_weighted(self):
+        self.use('weighted', 'weight=3\n')
+        self.taskqueue.save_many({'name': str(i), 'group': 'alpha'}
+                                 for i in range(8))
+        self.taskqueue.save_many({'name': str(i), 'group': 'beta'}
+                                 for i in range(8))
+
+        served = self.groups_served(8)
+        self.assertEqual(served.count('alpha'), 6)
+        self.assertEqual(served.count('beta'), 2)
+
+    def test_oldest(self):
+        self.use('oldest')
+        self.taskqueue.save({'name': 'new', 'group': 'alpha',
+                             'priority': 10, 'queued_at': 2000})
+        self.taskqueue.save({'name': 'old', 'group': 'beta',
+                             'queued_at': 1000})
+
+        self.assertEqual(self.taskqueue.getnexttask()['name'], 'old')
+
+    def test_priority_default(self):
+        self.use('priority')
+        self.taskqueue.save({'name': 'new', 'group': 'alpha',
+                             'priority': 10, 'queued_at': 2000})
+        self.taskqueue.save({'name': 'old', 'group': 'beta',
+                             'queued_at': 1000})
+
+        self.assertEqual(self.taskqueue.getnexttask()['name'], 'new')
+
+
+class Test_TaskQueue_leases(BaseCaseClass_TaskQueue):
+    ''' claimed tasks are leased, and go back to the queue if their runner
+        stops renewing them '''
+
+    def setUp(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[leases]\ntime=60\nmax_attempts=2\n')
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE)
+        self.taskqueue.__enter__()
+
+    def expire_all(self):
+        self.taskqueue.db.cur.execute(
+            'UPDATE Tasks SET lease_expires = 1 WHERE lease_expires > 0')
+
+    def test_not_a_group(self):
+        self.assertNotIn('leases', self.taskqueue.config.groups())
+
+    def test_claim(self):
+        self.taskqueue.save({'name': 'thing'})
+        sent = self.taskqueue.getnexttask(lease=True)
+        task = self.taskqueue.db.get(sent['uid'])
+
+        self.assertAlmostEqual(task['lease_expires'], time() + 60, delta=5)
+        self.assertEqual(task['lease_pid'], os.getpid())
+        self.assertEqual(task['attempts'], 1)
+
+    def test_not_leased_unless_asked(self):
+        self.taskqueue.save({'name': 'thing'})
+        sent = self.taskqueue.getnexttask()
+        self.expire_all()
+
+        self.assertNotIn('lease_expires', self.taskqueue.db.get(sent['uid']))
+        self.assertEqual(self.taskqueue.recover(), 0)
+        self.assertEqual(self.taskqueue.db.get(sent['uid'])['state'],
+                         'running')
+
+    def test_finishing_ends_lease(self):
+        self.taskqueue.save({'name': 'thing'})
+        sent = self.taskqueue.getnexttask(lease=True)
+        sent['state'] = 'finished'
+        self.taskqueue.save(sent)
+
+        self.assertNotIn('lease_expires', self.taskqueue.db.get(sent['uid']))
+
+    def test_renew(self):
+        self.taskqueue.save({'name': 'thing'})
+        uid = self.taskqueue.getnexttask(lease=True)['uid']
+
+        self.assertEqual(self.taskqueue.renew([uid]), [uid])
+        self.assertEqual(self.taskqueue.db.renew([uid], 60, ('elsewhere', 1)),
+                         [])
+
+    def test_expired_back_to_ready(self):
+        self.taskqueue.save({'name': 'thing'})
+        uid = self.taskqueue.getnexttask(lease=True)['uid']
+        self.expire_all()
+
+        self.assertEqual(self.taskqueue.renew([uid]), [uid])
+        self.expire_all()
+        self.assertEqual(self.taskqueue.recover(), 1)
+        self.assertEqual(self.taskqueue.db.get(uid)['state'], 'ready')
+        self.assertEqual(self.taskqueue.renew([uid]), [])
+
+    def test_getnexttask_recovers(self):
+        # group limit is 1, so without recovery this would be TooBusy:
+        self.taskqueue.save({'name': 'thing'})
+        uid = self.taskqueue.getnexttask(lease=True)['uid']
+        self.expire_all()
+
+        again = self.taskqueue.getnexttask(lease=True)
+        self.assertEqual(again['uid'], uid)
+        self.assertEqual(again['attempts'], 2)
+
+    def test_max_attempts(self):
+        self.taskqueue.save({'name': 'thing'})
+        for _ in range(2):
+            uid = self.taskqueue.getnexttask(lease=True)['uid']
+            self.expire_all()
+
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask(lease=True)
+
+        task = self.taskqueue.db.get(uid)
+        self.assertEqual(task['state'], 'failed')
+        self.assertEqual(task['errcode'], stq.ERR_LEASE_EXPIRED)
+
+    def test_no_leases(self):
+        self.taskqueue.lease_time = 0
+        self.taskqueue.save({'name': 'thing'})
+        sent = self.taskqueue.getnexttask(lease=True)
+
+        self.assertNotIn('lease_expires', self.taskqueue.db.get(sent['uid']))
+        self.assertEqual(self.taskqueue.renew([sent['uid']]), [sent['uid']])
+
+
+class Test_TaskQueue_archive(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    move finished (failed & cancelled) tasks to the archive
+    database: those not touched for days, and any more than the
+    newest rows in each group.  Without arguments, uses the
+    [retention] keep_days and keep_rows settings.  Returns how many
+    were moved.
+    ----------
+    Args: ['days', 'rows']
+    '''
+    def finish(self, n, group='alpha', state='finished'):
+        return self.taskqueue.save_many({'name': str(i), 'group': group,
+                                         'state': state} for i in range(n))
+
+    def test_nothing_set(self):
+        self.finish(3)
+        self.assertEqual(self.taskqueue.archive(), 0)
+        self.assertEqual(len(self.taskqueue.tasks()), 3)
+
+    def test_days(self):
+        old = self.finish(2)
+        self.taskqueue.db.cur.execute('UPDATE Tasks SET updated_at = 0')
+        self.finish(1)
+        self.taskqueue.save({'name': 'waiting', 'group': 'alpha'})
+
+        self.assertEqual(self.taskqueue.archive(days=1), 2)
+        self.assertEqual(len(self.taskqueue.tasks()), 2)
+        self.assertEqual(sorted(t['uid'] for t in self.taskqueue.archived()),
+                         sorted(old))
+
+    def test_rows_per_group(self):
+        alpha = self.finish(5)
+        self.finish(2, 'beta', 'failed')
+
+        self.assertEqual(self.taskqueue.archive(rows=2), 3)
+
+        # the newest 2 of each are kept:
+        kept = [t['uid'] for t in self.taskqueue.tasks('alpha')]
+        self.assertEqual(kept, alpha[3:])
+        self.assertEqual(len(self.taskqueue.tasks('beta')), 2)
+
+    def test_cancelled(self):
+        self.finish(2, state='new')
+        self.taskqueue.update_where({'group': 'alpha'},
+                                    {'state': 'cancelled'})
+
+        self.assertEqual(self.taskqueue.archive(rows=0), 2)
+        self.assertEqual(len(self.taskqueue.tasks()), 0)
+
+    def test_counts(self):
+        self.finish(4)
+        self.taskqueue.save({'name': 'waiting', 'group': 'alpha'})
+        self.taskqueue.archive(rows=0)
+
+        self.assertEqual(self.taskqueue.check(), [])
+        self.assertEqual(dict(self.taskqueue.active_groups()['alpha']),
+                         {'ready': 1})
+
+    def test_archived_data(self):
+        self.taskqueue.save({'name': 'thing', 'group': 'alpha',
+                             'state': 'finished', 'stuff': [1, 2]})
+        self.taskqueue.archive(rows=0)
+
+        task = self.taskqueue.archived('alpha')[0]
+        self.assertEqual(task['name'], 'thing')
+        self.assertEqual(task['stuff'], [1, 2])
+        self.assertEqual(task['state'], 'finished')
+
+    def test_config(self):
+        self.taskqueue.config.config.add_section('retention')
+        self.taskqueue.config.config.set('retention', 'keep_rows', '1')
+        self.finish(3)
+
+        self.assertEqual(self.taskqueue.compact(), 2)
+        self.assertEqual(len(self.taskqueue.tasks()), 1)
+
+
+class Test_TaskQueue_itertasks(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    like tasks, but goes through them a page at a time, rather than
+    loading them all at once.  fields is a list of which fields you
+    want (default all), and order is 'id' or '-id' (newest first).
+    (see TaskStore.iterate)
+    ----------
+    Args: ['group', 'state', 'fields', 'limit', 'order']
+    '''
+    def setUp(self):
+        super(Test_TaskQueue_itertasks, self).setUp()
+        self.uids = self.taskqueue.save_many(
+            {'name': str(i), 'group': 'odd' if i % 2 else 'even'}
+            for i in range(25))
+
+    def test_all(self):
+        self.assertEqual([t['uid'] for t in self.taskqueue.itertasks()],
+                         [t['uid'] for t in self.taskqueue.tasks()])
+
+    def test_pages(self):
+        got = list(self.taskqueue.db.iterate(page_size=4))
+        self.assertEqual([t['uid'] for t in got], self.uids)
+
+        got = list(self.taskqueue.db.iterate('odd', page_size=4))
+        self.assertEqual([t['uid'] for t in got], self.uids[1::2])
+
+    def test_limit_and_order(self):
+        got = list(self.taskqueue.db.iterate(limit=6, order='-id',
+                                             page_size=4))
+        self.assertEqual([t['uid'] for t in got], self.uids[:-7:-1])
+
+    def test_fields(self):
+        task = next(self.taskqueue.itertasks(fields=['uid', 'name']))
+        self.assertEqual(task, {'uid': self.uids[0], 'name': '0'})
+
+        task = next(self.taskqueue.itertasks('even', fields=['group']))
+        self.assertEqual(task, {'group': 'even'})
+
+    def test_state(self):
+        self.assertEqual(len(list(self.taskqueue.itertasks(
+            'odd', state='ready'))), 12)
+        self.assertEqual(list(self.taskqueue.itertasks(state='failed')), [])
+
+    def test_bad_order(self):
+        with self.assertRaises(ValueError):
+            list(self.taskqueue.itertasks(order='name'))
+
+    def plan(self, group, state, newest_first):
+        sql, values = stq.TaskStore._page_query(u'Tasks.*', group, state,
+                                                newest_first)
+        return ' '.join(str(r[-1]) for r in self.taskqueue.db.cur.execute(
+            u'EXPLAIN QUERY PLAN ' + sql, values + [0, 10]))
+
+    def test_uses_index(self):
+        for newest_first in (False, True):
+            plan = self.plan('x', None, newest_first)
+            self.assertIn('TaskGroups_list', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+            plan = self.plan(None, None, newest_first)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+            plan = self.plan(None, 'ready', newest_first)
+            self.assertIn('Tasks_state', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class Test_TaskQueue_update_where(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    change all the tasks matching filters at once (one UPDATE, in
+    one transaction).  filters: 'group', 'state' (or a list of
+    states) and 'older_than' (seconds since they were last updated).
+    changes: fields to set.  Returns how many tasks were changed.
+    (see TaskStore.update_where)
+    ----------
+    Args: ['filters', 'changes']
+    '''
+    def setUp(self):
+        super(Test_TaskQueue_update_where, self).setUp()
+        self.taskqueue.save_many(
+            {'name': str(i), 'group': 'alpha', 'errcode': 2,
+             'state': 'failed' if i % 2 else 'ready'} for i in range(6))
+        self.taskqueue.save_many(
+            {'name': str(i), 'group': 'beta', 'state': 'failed'}
+            for i in range(2))
+
+    def test_everything(self):
+        self.assertEqual(self.taskqueue.update_where({}, {'priority': 3}), 8)
+        self.assertEqual(set(t['priority'] for t in self.taskqueue.tasks()),
+                         set([3]))
+
+    def test_group_and_state(self):
+        changed = self.taskqueue.update_where(
+            {'group': 'alpha', 'state': 'failed'},
+            {'state': 'ready', 'errcode': None})
+
+        self.assertEqual(changed, 3)
+        self.assertEqual(len(self.taskqueue.tasks('alpha', 'ready')), 6)
+        self.assertEqual(len(self.taskqueue.tasks('beta', 'failed')), 2)
+        self.assertEqual([t['errcode'] for t in
+                          self.taskqueue.tasks('alpha')], [2, None] * 3)
+        self.assertEqual(self.taskqueue.tasks('alpha')[0]['name'], '0')
+
+    def test_counts(self):
+        self.taskqueue.update_where({'state': ['ready', 'failed']},
+                                    {'state': 'cancelled'})
+
+        self.assertEqual(self.taskqueue.check(), [])
+        self.assertEqual(dict(self.taskqueue.active_groups()['alpha']),
+                         {'cancelled': 6})
+
+    def test_older_than(self):
+        self.taskqueue.db.cur.execute(
+            'UPDATE Tasks SET updated_at = 0 WHERE "group" = \'beta\'')
+
+        self.assertEqual(self.taskqueue.update_where(
+            {'older_than': 3600}, {'state': 'cancelled'}), 2)
+
+    def test_ends_lease(self):
+        self.taskqueue.getnexttask('alpha')
+        self.taskqueue.update_where({'state': 'running'}, {'state': 'ready'})
+
+        self.assertEqual(self.taskqueue.db.cur.execute(
+            'SELECT COUNT(*) FROM Tasks WHERE lease_expires IS NOT NULL'
+            ).fetchone()[0], 0)
+
+    def test_no_group_changes(self):
+        with self.assertRaises(ValueError):
+            self.taskqueue.update_where({}, {'group': 'gamma'})
+
+
+class Test_TaskQueue_stats(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    the timers & counters so far (see Metrics), or {} if [metrics]
+    aren't enabled.
+    ----------
+    Args: []
+    '''
+    def setUp(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[metrics]\nenabled=yes\n'
+                        'export=__test/metrics.prom\n')
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE, use_lock=True)
+        self.taskqueue.__enter__()
+
+    def test_disabled(self):
+        make_config()
+        with stq.TaskQueue(CONFIG_FILE) as taskqueue:
+            taskqueue.save({'name': 'thing'})
+            self.assertEqual(taskqueue.stats(), {})
+            self.assertIsNone(taskqueue.db.metrics)
+
+    def test_timers(self):
+        self.taskqueue.save({'name': 'thing'})
+        self.taskqueue.getnexttask()
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask()
+
+        timers = self.taskqueue.stats()['timers']
+        self.assertEqual(timers['save']['calls'], 1)
+        self.assertEqual(timers['getnexttask']['calls'], 2)
+        self.assertEqual(timers['sql_claim']['calls'], 1)
+        self.assertEqual(timers['lock_wait']['calls'], 1)
+        self.assertGreaterEqual(timers['getnexttask']['seconds'],
+                                timers['getnexttask']['max'])
+
+    def test_prometheus(self):
+        self.taskqueue.save({'name': 'thing'})
+        text = self.taskqueue.prometheus()
+
+        self.assertIn('stq_calls_total{op="save"} 1\n', text)
+        self.assertIn('stq_tasks{group="none",state="ready"} 1\n', text)
+
+    def test_export_file(self):
+        self.taskqueue.save({'name': 'thing'})
+        self.taskqueue.export_metrics()
+
+        with open('__test/metrics.prom') as prom:
+            self.assertIn('stq_calls_total{op="save"} 1\n', prom.read())
+
+    def test_export_socket(self):
+        path = abspath('__test/metrics.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        try:
+            self.taskqueue.metrics_export = 'unix:' + path
+            self.taskqueue.export_metrics()
+            conn, _ = server.accept()
+            self.assertIn('stq_calls_total', conn.recv(65536))
+            conn.close()
+        finally:
+            server.close()
+
+
+class Test_TaskQueue_latency(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    per group, for tasks which finished in the last window seconds:
+    how many, how many a second, and p50/p95/p99 of how long they
+    waited in the queue & took to run.  (see TaskStore.latency)
+    ----------
+    Args: ['window']
+    '''
+    def done(self, group, wait, run, ago=10, state='finished'):
+        finished = time() - ago
+        return {'name': 'x', 'group': group, 'state': state,
+                'queued_at': finished - run - wait,
+                'claimed_at': finished - run,
+                'started_at': finished - run,
+                'finished_at': finished}
+
+    def test_claimed_at(self):
+        self.taskqueue.save({'name': 'thing'})
+        uid = self.taskqueue.getnexttask()['uid']
+
+        self.assertAlmostEqual(self.taskqueue.db.get(uid)['claimed_at'],
+                               time(), delta=5)
+
+    def test_empty(self):
+        self.assertEqual(self.taskqueue.latency(), [])
+
+    def test_percentiles(self):
+        self.taskqueue.save_many(self.done('alpha', i, 2 * i)
+                                 for i in range(1, 11))
+        self.taskqueue.save(self.done('beta', 1, 1, state='failed'))
+
+        alpha, beta = self.taskqueue.latency(600)
+
+        self.assertEqual(alpha['group'], 'alpha')
+        self.assertEqual(alpha['finished'], 10)
+        self.assertAlmostEqual(alpha['per_second'], 10 / 600.0)
+        self.assertAlmostEqual(alpha['wait']['p50'], 5, places=3)
+        self.assertAlmostEqual(alpha['wait']['p95'], 10, places=3)
+        self.assertAlmostEqual(alpha['run']['p50'], 10, places=3)
+        self.assertEqual(beta['failed'], 1)
+
+    def test_window(self):
+        self.taskqueue.save(self.done('alpha', 1, 1, ago=7200))
+        self.taskqueue.save(self.done('alpha', 1, 1))
+
+        self.assertEqual(self.taskqueue.latency(3600)[0]['finished'], 1)
+
+    def test_requeue_clears(self):
+        uid = self.taskqueue.save(self.done('alpha', 1, 1))['uid']
+        self.taskqueue.update_where({}, {'state': 'ready'})
+
+        self.assertEqual(self.taskqueue.latency(), [])
+        self.assertNotIn('started_at', self.taskqueue.db.get(uid))
+
+    def plan(self, sql, values):
+        return ' '.join(str(r[-1]) for r in self.taskqueue.db.cur.execute(
+            u'EXPLAIN QUERY PLAN ' + sql, values))
+
+    def test_uses_index(self):
+        store = stq.TaskStore
+
+        self.assertIn('Tasks_finished',
+                      self.plan(store._FINISHED_COUNTS, (0,)))
+        for _, expr in store.LATENCY_MEASURES:
+            self.assertIn('Tasks_finished', self.plan(
+                u'SELECT COUNT(*) ' + store._FINISHED_IN_GROUP.format(expr),
+                (0, 'x')))
+
+
+class Test_TaskQueue_dedup(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    add needed fields if they're not there, and then save to the
+    database.  If the same uuid is already there, then update it.
+    If data has a dedup_key which an unfinished task already has,
+    then that task is returned instead (see TaskStore.save for
+    on_duplicate).
+    ----------
+    Args: ['data', 'on_duplicate']
+    '''
+    def test_skip(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k'})
+        again = self.taskqueue.save({'name': 'b', 'dedup_key': 'k'})
+
+        self.assertEqual(again['uid'], first['uid'])
+        self.assertEqual(again['name'], 'a')
+        self.assertEqual(len(self.taskqueue.tasks()), 1)
+
+    def test_merge(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k',
+                                     'group': 'alpha', 'state': 'new'})
+        again = self.taskqueue.save({'name': 'b', 'dedup_key': 'k',
+                                     'priority': 5, 'queued_at': 0},
+                                    on_duplicate='merge')
+
+        self.assertEqual(again['uid'], first['uid'])
+        self.assertEqual((again['name'], again['priority']), ('b', 5))
+        self.assertEqual((again['state'], again['group']), ('new', 'alpha'))
+        self.assertNotEqual(again['queued_at'], 0)
+
+    def test_after_finished(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k'})
+        self.taskqueue.save({'uid': first['uid'], 'state': 'finished'})
+        again = self.taskqueue.save({'name': 'b', 'dedup_key': 'k'})
+
+        self.assertNotEqual(again['uid'], first['uid'])
+        self.assertEqual(len(self.taskqueue.tasks()), 2)
+
+    def test_save_many(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k0'})
+        uids = self.taskqueue.save_many(
+            {'name': str(i), 'dedup_key': 'k{0}'.format(i % 3)}
+            for i in range(6))
+
+        self.assertEqual(len(self.taskqueue.tasks()), 3)
+        self.assertEqual(uids[0], first['uid'])
+        self.assertEqual(uids[1:3], uids[4:6])
+        self.assertEqual(uids[3], first['uid'])
+
+    def test_requeue(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k',
+                                     'state': 'failed'})
+        self.taskqueue.save({'name': 'b', 'dedup_key': 'k'})
+
+        self.assertEqual(self.taskqueue.update_where(
+            {'state': 'failed'}, {'state': 'ready'}), 0)
+        self.assertEqual(self.taskqueue.get(first['uid'])[0]['state'],
+                         'failed')
+
+    def test_unfinish(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k',
+                                     'state': 'failed'})
+        again = self.taskqueue.save({'name': 'b', 'dedup_key': 'k'})
+
+        saved = self.taskqueue.save({'uid': first['uid'], 'state': 'ready',
+                                     'priority': 3}, on_duplicate='merge')
+
+        self.assertEqual(saved['uid'], again['uid'])
+        self.assertEqual(saved['priority'], 3)
+        self.assertEqual(self.taskqueue.get(first['uid'])[0]['state'],
+                         'failed')
+
+    def test_add_key(self):
+        first = self.taskqueue.save({'name': 'a', 'dedup_key': 'k'})
+        other = self.taskqueue.save({'name': 'b'})
+
+        saved = self.taskqueue.save({'uid': other['uid'], 'dedup_key': 'k'})
+
+        self.assertEqual(saved['uid'], first['uid'])
+        self.assertNotIn('dedup_key', self.taskqueue.get(other['uid'])[0])
+
+    def test_uses_index(self):
+        plan = self.taskqueue.db.cur.execute(
+            u'EXPLAIN QUERY PLAN ' + stq.TaskStore._FIND_DUPLICATE,
+            ('k', 'x')).fetchall()
+
+        self.assertIn('Tasks_dedup', ' '.join(str(row[-1]) for row in plan))
+
+
+class Test_TaskQueue_dependencies(BaseCaseClass_TaskQueue):
+    ''' tasks with depends_on wait (as 'new') until those tasks have
+        finished, and then become ready '''
+
+    def finish(self, uid):
+        self.taskqueue.save({'uid': uid, 'state': 'finished'})
+
+    def states(self, *uids):
+        return [self.taskqueue.get(uid)[0]['state'] for uid in uids]
+
+    def pipeline(self):
+        return self.taskqueue.save_many([
+            {'uid': 'a', 'name': 'a'},
+            {'uid': 'b', 'name': 'b', 'depends_on': ['a']},
+            {'uid': 'c', 'name': 'c', 'depends_on': ['a', 'b']}])
+
+    def test_pipeline(self):
+        self.pipeline()
+        self.assertEqual(self.states('a', 'b', 'c'), ['ready', 'new', 'new'])
+
+        self.finish('a')
+        self.assertEqual(self.states('b', 'c'), ['ready', 'new'])
+
+        self.finish('b')
+        self.assertEqual(self.states('c'), ['ready'])
+        self.assertEqual(self.taskqueue.db.cur.execute(
+            'SELECT COUNT(*) FROM TaskDeps').fetchone()[0], 0)
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_any_order(self):
+        self.taskqueue.save({'uid': 'b', 'name': 'b', 'depends_on': ['a']})
+        self.taskqueue.save({'uid': 'a', 'name': 'a'})
+
+        self.assertEqual(self.taskqueue.getnexttask()['uid'], 'a')
+        self.finish('a')
+        self.assertEqual(self.states('b'), ['ready'])
+
+    def test_already_finished(self):
+        self.taskqueue.save({'uid': 'a', 'name': 'a', 'state': 'finished'})
+        self.taskqueue.save({'uid': 'b', 'name': 'b', 'depends_on': ['a']})
+
+        self.assertEqual(self.states('b'), ['ready'])
+
+    def test_finished_later(self):
+        self.taskqueue.save({'uid': 'b', 'name': 'b', 'depends_on': ['a']})
+        self.taskqueue.save({'uid': 'a', 'name': 'a', 'state': 'finished'})
+
+        self.assertEqual(self.states('b'), ['ready'])
+        self.taskqueue.save_many([
+            {'uid': 'd', 'name': 'd', 'depends_on': ['c']},
+            {'uid': 'c', 'name': 'c', 'state': 'finished'}])
+        self.assertEqual(self.states('d'), ['ready'])
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_archived(self):
+        self.taskqueue.save({'uid': 'a', 'name': 'a', 'state': 'finished'})
+        self.taskqueue.save({'uid': 'x', 'name': 'x', 'state': 'failed'})
+        self.assertEqual(self.taskqueue.archive(rows=0), 2)
+
+        self.taskqueue.save({'uid': 'b', 'name': 'b', 'depends_on': ['a']})
+        self.taskqueue.save({'uid': 'c', 'name': 'c', 'depends_on': ['x']})
+        self.assertEqual(self.states('b', 'c'), ['ready', 'new'])
+
+    def test_update_where(self):
+        self.pipeline()
+        self.taskqueue.update_where({'state': 'ready'},
+                                    {'state': 'finished'})
+
+        self.assertEqual(self.states('b', 'c'), ['ready', 'new'])
+
+    def test_reset(self):
+        self.pipeline()
+
+        self.assertEqual(self.taskqueue.update_where(
+            {}, {'state': 'ready'}), 3)
+        self.assertEqual(self.states('a', 'b', 'c'), ['ready', 'new', 'new'])
+
+    def test_no_cascade(self):
+        self.pipeline()
+        self.taskqueue.save({'uid': 'a', 'state': 'failed'})
+
+        self.assertEqual(self.states('b', 'c'), ['new', 'new'])
+
+
+class Test_TaskQueue_dependencies_cascade(BaseCaseClass_TaskQueue):
+    ''' with [dependencies] cascade_failures=yes, tasks waiting for a task
+        which fails fail too (and so on) '''
+
+    def setUp(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[dependencies]\ncascade_failures=yes\n')
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE)
+        self.taskqueue.__enter__()
+
+    def test_not_a_group(self):
+        self.assertNotIn('dependencies', self.taskqueue.config.groups())
+
+    def test_cascade(self):
+        self.taskqueue.save_many([
+            {'uid': 'a', 'name': 'a'},
+            {'uid': 'b', 'name': 'b', 'depends_on': ['a']},
+            {'uid': 'c', 'name': 'c', 'depends_on': ['b']},
+            {'uid': 'd', 'name': 'd'}])
+        self.taskqueue.save({'uid': 'a', 'state': 'failed', 'errcode': 1})
+
+        tasks = dict((t['uid'], t) for t in self.taskqueue.tasks())
+        self.assertEqual([tasks[uid]['state'] for uid in 'abcd'],
+                         ['failed'] * 3 + ['ready'])
+        self.assertEqual([tasks[uid]['errcode'] for uid in 'abc'],
+                         [1, stq.ERR_DEPENDENCY_FAILED,
+                          stq.ERR_DEPENDENCY_FAILED])
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_requeue(self):
+        self.taskqueue.save_many([
+            {'uid': 'a', 'name': 'a'},
+            {'uid': 'b', 'name': 'b', 'depends_on': ['a']},
+            {'uid': 'c', 'name': 'c', 'depends_on': ['b']}])
+        self.taskqueue.save({'uid': 'a', 'state': 'failed', 'errcode': 1})
+
+        self.assertEqual(self.taskqueue.update_where(
+            {'state': 'failed'}, {'state': 'ready'}), 3)
+        states = lambda: [self.taskqueue.get(uid)[0]['state']
+                          for uid in 'abc']
+        self.assertEqual(states(), ['ready', 'new', 'new'])
+        self.assertEqual(self.taskqueue.getnexttasks(3)[0]['uid'], 'a')
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask()
+
+        self.taskqueue.save({'uid': 'a', 'state': 'finished'})
+        self.assertEqual(states(), ['finished', 'ready', 'new'])
+        self.assertEqual(self.taskqueue.check(), [])
+
+    def test_already_failed(self):
+        self.taskqueue.save({'uid': 'a', 'name': 'a', 'state': 'cancelled'})
+        self.taskqueue.save({'uid': 'b', 'name': 'b', 'depends_on': ['a']})
+
+        self.assertEqual(self.taskqueue.get('b')[0]['state'], 'cancelled')
+
+
+class Test_TaskQueue_shards(BaseCaseClass_TaskQueue):
+    ''' groups with shard=name in their config are kept in their own
+        database file, and everything else works across all of them '''
+
+    def setUp(self):
+        make_config()
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[alpha]\nlimit=5\nshard=backups\n'
+                        '[beta]\nlimit=5\nshard=backups\n'
+                        '[gamma]\nlimit=5\nshard=updates\n'
+                        '[delta]\nlimit=5\n')
+        self.taskqueue = stq.TaskQueue(CONFIG_FILE)
+        self.taskqueue.__enter__()
+
+    def fill(self):
+        return self.taskqueue.save_many(
+            {'name': str(i), 'group': group}
+            for i, group in enumerate(['alpha', 'gamma', 'delta', 'beta'] * 2))
+
+    def test_files(self):
+        self.assertEqual(self.taskqueue.shards.keys(),
+                         ['', 'backups', 'updates'])
+        self.assertTrue(exists('__test/TaskQueue-backups.db'))
+        self.assertTrue(exists('__test/TaskQueue-updates.db'))
+
+    def test_save(self):
+        task = self.taskqueue.save({'name': 'a', 'group': 'gamma'})
+
+        self.assertTrue(self.taskqueue.shards['updates'].get(task['uid']))
+        self.assertIsNone(self.taskqueue.db.get(task['uid']))
+        self.assertEqual(self.taskqueue.get(task['uid'])[0]['name'], 'a')
+
+    def test_save_many(self):
+        uids = self.fill()
+
+        self.assertEqual([self.taskqueue.get(uid)[0]['name'] for uid in uids],
+                         [str(i) for i in range(8)])
+        self.assertEqual(len(self.taskqueue.shards['backups'].find()), 4)
+        self.assertEqual(len(self.taskqueue.tasks()), 8)
+        self.assertEqual(len(self.taskqueue.tasks('beta')), 2)
+        self.assertEqual(
+            dict((g, dict(c)) for g, c in
+                 self.taskqueue.active_groups().items()),
+            dict((g, {'ready': 2}) for g in ('alpha', 'beta', 'gamma',
+                                             'delta')))
+
+    def test_getnexttask(self):
+        self.fill()
+        groups = [self.taskqueue.getnexttask()['group'] for _ in range(8)]
+
+        self.assertEqual(sorted(groups), sorted(['alpha', 'gamma', 'delta',
+                                                 'beta'] * 2))
+        with self.assertRaises(stq.NoAvailableTasks):
+            self.taskqueue.getnexttask()
+
+    def test_getnexttasks(self):
+        self.fill()
+
+        self.assertEqual(len(self.taskqueue.getnexttasks(6)), 6)
+        self.assertEqual(len(self.taskqueue.getnexttasks(6)), 2)
+
+    def test_update_where(self):
+        self.fill()
+
+        self.assertEqual(self.taskqueue.update_where(
+            {}, {'state': 'cancelled'}), 8)
+        self.assertEqual(self.taskqueue.update_where(
+            {'group': 'gamma'}, {'state': 'ready'}), 2)
+
+    def test_itertasks(self):
+        self.fill()
+
+        self.assertEqual(len(list(self.taskqueue.itertasks())), 8)
+        self.assertEqual(len(list(self.taskqueue.itertasks(limit=3))), 3)
+
+    def test_archive(self):
+        self.taskqueue.save_many({'name': str(i), 'group': group,
+                                  'state': 'finished'}
+                                 for i, group in enumerate(['alpha', 'delta']))
+
+        self.assertEqual(self.taskqueue.archive(rows=0), 2)
+        self.assertTrue(exists('__test/TaskArchive-backups.db'))
+        self.assertEqual(len(self.taskqueue.archived()), 2)
+        self.assertEqual(len(self.taskqueue.archived('alpha')), 1)
+
+    def test_change_shard(self):
+        task = self.taskqueue.save({'name': 'a', 'group': 'alpha'})
+        task['group'] = 'gamma'
+
+        with self.assertRaises(ValueError):
+            self.taskqueue.save(task)
+        with self.assertRaises(ValueError):
+            self.taskqueue.save_many([task])
+
+        task['group'] = 'beta'
+        self.taskqueue.save(task)
+        self.assertEqual([(t['group'], t['state'])
+                          for t in self.taskqueue.tasks()],
+                         [('beta', 'ready')])
+
+    def test_list_of_groups(self):
+        task = self.taskqueue.save({'name': 'a', 'group': ['alpha', 'beta']})
+        self.assertEqual(len(self.taskqueue.tasks('beta')), 1)
+
+        with self.assertRaises(ValueError):
+            self.taskqueue.save({'name': 'b', 'group': ['alpha', 'gamma']})
+        with self.assertRaises(ValueError):
+            self.taskqueue.save_many([{'name': 'c'},
+                                      {'name': 'd', 'group': ['delta',
+                                                              'beta']}])
+        self.assertEqual([t['uid'] for t in self.taskqueue.tasks()],
+                         [task['uid']])
+
+    def test_depends_on(self):
+        self.taskqueue.save({'uid': 'a', 'name': 'a', 'group': 'alpha'})
+        self.taskqueue.save_many([
+            {'uid': 'b', 'name': 'b', 'group': 'beta', 'depends_on': ['a']},
+            {'uid': 'c', 'name': 'c', 'group': 'alpha',
+             'depends_on': ['a', 'b']}])
+
+        with self.assertRaises(ValueError):
+            self.taskqueue.save({'name': 'd', 'group': 'gamma',
+                                 'depends_on': ['a']})
+        with self.assertRaises(ValueError):
+            self.taskqueue.save_many([
+                {'uid': 'e', 'name': 'e', 'group': 'gamma'},
+                {'name': 'f', 'group': 'delta', 'depends_on': ['e']}])
+        with self.assertRaises(ValueError):
+            self.taskqueue.save({'name': 'g', 'group': 'alpha',
+                                 'depends_on': ['nowhere']})
+
+        self.assertEqual(sorted(t['uid'] for t in self.taskqueue.tasks()),
+                         ['a', 'b', 'c'])
+
+    def test_transaction(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.taskqueue.transaction():
+                self.taskqueue.save({'name': 'a', 'group': 'gamma'})
+                self.taskqueue.save({'name': 'b', 'group': 'alpha'})
+                self.taskqueue.save({'name': 'c', 'group': 'delta'})
+                1 / 0
+
+        self.assertEqual(self.taskqueue.tasks(), [])
+
+    def test_bad_name(self):
+        with open(CONFIG_FILE, 'a') as tfile:
+            tfile.write('[epsilon]\nshard=../elsewhere\n')
+
+        with self.assertRaises(stq.InvalidConfigFile):
+            stq.TaskQueue(CONFIG_FILE)
+
 
 class Test_TaskQueue_save(BaseCaseClass_TaskQueue):
     ''' Method docstring:
@@ -414,6 +1832,51 @@ class Test_TaskQueue_save(BaseCaseClass_TaskQueue):
             self.taskqueue.save(0)
 
 
+class Test_TaskQueue_save_many(BaseCaseClass_TaskQueue):
+    ''' Method docstring:
+    save lots of tasks (a list, generator, etc) at once.  Each task
+    gets the same defaults as with save(), and they are written in
+    transactions of chunk_size tasks.  Returns the list of uids.
+    ----------
+    Args: ['tasks', 'chunk_size']
+    '''
+    def test_empty(self):
+        self.assertEqual(self.taskqueue.save_many([]), [])
+
+    def test_generator(self):
+        uids = self.taskqueue.save_many(
+            ({'name': str(i), 'group': ['alpha', 'beta'][i % 2]}
+             for i in range(5)), chunk_size=2)
+
+        self.assertEqual(len(uids), 5)
+        self.assertEqual([t['uid'] for t in self.taskqueue.tasks()], uids)
+        self.assertEqual(self.taskqueue.active_groups(),
+                         {'alpha': {'ready': 3}, 'beta': {'ready': 2}})
+
+    def test_defaults(self):
+        uid, = self.taskqueue.save_many([{'name': 'a', 'stdout': 'a.log'}])
+
+        task = self.taskqueue.get(uid)[0]
+        self.assertEqual(task['state'], 'ready')
+        self.assertEqual(task['group'], 'none')
+        self.assertEqual(task['stdout'], abspath('__test/a.log'))
+
+    def test_existing_and_repeated(self):
+        sent = self.taskqueue.save({'name': 'a', 'other': 'stuff'})
+
+        self.taskqueue.save_many([
+            {'uid': sent['uid'], 'state': 'failed'},
+            {'uid': 'new', 'name': 'b', 'group': ['alpha', 'beta']},
+            {'uid': 'new', 'group': 'alpha'}])
+
+        self.assertDictContainsSubset(
+            {'name': 'a', 'other': 'stuff', 'state': 'failed'},
+            self.taskqueue.get(sent['uid'])[0])
+        self.assertDictContainsSubset(
+            {'name': 'b', 'group': 'alpha'}, self.taskqueue.get('new')[0])
+        self.assertEqual(self.taskqueue.check(), [])
+
+
 class Test_TaskQueue_get(BaseCaseClass_TaskQueue):
     ''' Method docstring:
     None
@@ -430,5 +1893,380 @@ class Test_TaskQueue_get(BaseCaseClass_TaskQueue):
         self.taskqueue.get(0)
 
 
+
+################################################################################
+#
+# AsyncTaskQueue
+#
+################################################################################
+
+@unittest.skipIf(stq.asyncio is None, 'needs asyncio (or trollius)')
+class Test_AsyncTaskQueue(BaseCase):
+    ''' Module docstring:
+    TaskQueue for asyncio code.  save, save_many, get, tasks & getnexttask
+    return futures (so 'await' them, or 'yield From(...)' with trollius)
+    rather than blocking the event loop.
+    ----------
+    Methods:
+    save, save_many, get, tasks, getnexttask, close
+    ----------
+    '''
+    def setUp(self):
+        make_config()
+        self.loop = stq.asyncio.new_event_loop()
+        self.taskqueue = stq.AsyncTaskQueue(CONFIG_FILE, self.loop)
+
+    def tearDown(self):
+        self.wait(self.taskqueue.close())
+        self.loop.close()
+        remove_config()
+
+    def wait(self, *futures):
+        return self.loop.run_until_complete(
+            stq.asyncio.gather(*futures, loop=self.loop,
+                               return_exceptions=True))
+
+    def test_save_get(self):
+        task, = self.wait(self.taskqueue.save({'name': 'thing'}))
+        got, = self.wait(self.taskqueue.get(task['uid']))
+
+        self.assertEqual(got[0]['name'], 'thing')
+        self.assertEqual(got[0]['state'], 'ready')
+
+    def test_many_saves(self):
+        saved = self.wait(*[self.taskqueue.save({'name': str(i)})
+                           for i in range(50)])
+        saved.extend(self.wait(self.taskqueue.save_many(
+            {'name': str(i)} for i in range(50)))[0])
+
+        self.assertEqual(len(saved), 100)
+        self.assertEqual(len(self.wait(self.taskqueue.tasks())[0]), 100)
+
+    def test_one_bad_save(self):
+        results = self.wait(self.taskqueue.save({'name': 'good'}),
+                           self.taskqueue.save(0),
+                           self.taskqueue.save({'name': 'also good'}))
+
+        self.assertIsInstance(results[1], TypeError)
+        self.assertEqual(len(self.wait(self.taskqueue.tasks())[0]), 2)
+
+    def test_getnexttask(self):
+        self.assertIsInstance(self.wait(self.taskqueue.getnexttask())[0],
+                              stq.NoAvailableTasks)
+
+        self.wait(self.taskqueue.save({'name': 'thing'}))
+        task, = self.wait(self.taskqueue.getnexttask())
+        self.assertEqual(task['name'], 'thing')
+        self.assertEqual(task['state'], 'running')
+
+
+################################################################################
+#
+# run_tasks.py
+#
+################################################################################
+
+RUNNER_CONFIG = '__test/runner.conf'
+RUNNER_DEFAULTS = CONFIG_DEFAULTS + \
+'''
+[FILES]
+STQ_Config=__test/runner.conf
+
+[task_defaults]
+stdout=__test/tasks.log
+stderr=__test/tasks.log
+
+[commands]
+true=/bin/true
+false=/bin/false
+sleep=/bin/sleep
+
+[runner]
+workers=3
+poll_min=0.1
+poll_max=0.5
+
+[none]
+limit=3
+
+'''
+
+class BaseCaseClass_WorkerPool(BaseCase):
+    ''' Module docstring:
+    Runs up to [runner] workers= tasks at the same time, as child processes
+    of this one, all sharing one task queue connection.
+    ----------
+    Methods:
+    load_config, fill, wait, renew, reap, stop, run, serve
+    ----------
+    '''
+    extra_config = ''
+
+    def setUp(self):
+        make_config()
+        stq.Config(CONFIG_FILE)
+        with open(RUNNER_CONFIG, 'w') as tfile:
+            tfile.write(RUNNER_DEFAULTS + self.extra_config)
+
+        # (the pool takes over these signals, and prints a lot)
+        self.signals = dict((num, signal.getsignal(num)) for num in
+                            (signal.SIGCHLD, signal.SIGTERM, signal.SIGHUP))
+        # (at the fd level, as [callables] workers get a copy of stdout)
+        sys.stdout.flush()
+        self.stdout = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+    def tearDown(self):
+        sys.stdout.flush()
+        os.dup2(self.stdout, 1)
+        os.close(self.stdout)
+        signal.set_wakeup_fd(-1)
+        for num, handler in self.signals.items():
+            signal.signal(num, handler)
+        remove_config()
+
+    def make_pool(self):
+        pool = run_tasks.WorkerPool(RUNNER_CONFIG)
+
+        def close():
+            if pool.runner.callablepool:
+                pool.runner.callablepool.close()
+            pool.runner.TQ().close()
+            os.close(pool.wakeup)
+        self.addCleanup(close)
+        return pool
+
+    def save(self, *tasks):
+        with stq.TaskQueue(RUNNER_CONFIG) as tq:
+            return tq.save_many(tasks)
+
+    def results(self, uids):
+        with stq.TaskQueue(RUNNER_CONFIG) as tq:
+            return [tq.get(uid)[0] for uid in uids]
+
+
+class Test_WorkerPool_run(BaseCaseClass_WorkerPool):
+    ''' Method docstring:
+    keep all the slots full until there's nothing left to do.
+    Returns 0 if everything got done, or 1 if it's stopped because
+    the groups are too busy (or it was told to stop).
+    ----------
+    Args: []
+    '''
+    def test_commands(self):
+        uids = self.save({'command': 'true'}, {'command': 'false'},
+                         {'command': 'true'}, {'command': 'nope'})
+
+        self.assertEqual(self.make_pool().run(), 0)
+
+        tasks = self.results(uids)
+        self.assertEqual([t['state'] for t in tasks],
+                         ['finished', 'failed', 'finished', 'failed'])
+        self.assertEqual([t.get('errcode') for t in tasks],
+                         [None, 1, None, stq.ERR_UNDEFINED_COMMAND])
+        self.assertTrue(all(t['finished_at'] >= t['started_at']
+                            for t in tasks[:3]))
+
+    def test_nothing_to_do(self):
+        self.assertEqual(self.make_pool().run(), 0)
+
+    def test_bad_tasks(self):
+        uids = self.save({'name': 'no command'},
+                         {'command': 'true', 'stdout': '/nonexistent/out.log',
+                          'stderr': '/nonexistent/out.log'},
+                         {'command': 'true'}, {'command': 'true'})
+
+        self.assertEqual(self.make_pool().run(), 0)
+
+        tasks = self.results(uids)
+        self.assertEqual([t['state'] for t in tasks],
+                         ['failed', 'failed', 'finished', 'finished'])
+        self.assertEqual([t.get('errcode') for t in tasks[:2]],
+                         [stq.ERR_UNDEFINED_COMMAND,
+                          stq.ERR_SOMETHING_UNKNOWN])
+        # (the third was claimed along with them, and given back)
+        self.assertEqual([t['attempts'] for t in tasks], [1, 1, 2, 1])
+
+    def test_too_busy(self):
+        uids = self.save({'command': 'true', 'group': 'full'})
+        with stq.TaskQueue(RUNNER_CONFIG) as tq:
+            tq.save({'command': 'true', 'group': 'full', 'state': 'running'})
+
+        self.assertEqual(self.make_pool().run(), 1)
+        self.assertEqual(self.results(uids)[0]['state'], 'ready')
+
+
+class Test_TaskRunner_run(BaseCaseClass_WorkerPool):
+    ''' Method docstring:
+    actually run a task.  Note: This DOES NOT fork and daemonise!
+    running this directly will run the task and block until done.
+    ----------
+    Args: []
+    '''
+    extra_config = '[leases]\ntime=0.3\n'
+
+    def run_task(self, lease):
+        uids = self.save({'command': 'sleep', 'command_args': ['0.5']})
+        runner = run_tasks.TaskRunner(RUNNER_CONFIG)
+        self.addCleanup(lambda: runner.TQ().close())
+
+        task = runner.TQ().getnexttask(lease=lease)
+        self.assertEqual(runner.for_task(task).run(), True)
+        return self.results(uids)[0]
+
+    def test_without_lease(self):
+        task = self.run_task(lease=False)
+        self.assertEqual(task['state'], 'finished')
+        self.assertEqual(task['attempts'], 1)
+
+    def test_renews_lease(self):
+        task = self.run_task(lease=True)
+        self.assertEqual(task['state'], 'finished')
+        self.assertNotIn('lease_expires', task)
+
+
+class Test_WorkerPool_serve(BaseCaseClass_WorkerPool):
+    ''' Method docstring:
+    like run, but keep going forever (until SIGTERM), checking for
+    new tasks every poll_min seconds, backing off to every poll_max
+    seconds while there's nothing to do.
+    ----------
+    Args: []
+    '''
+    def serve(self):
+        ''' start a WorkerPool.serve() in a child process '''
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_tasks.WorkerPool(RUNNER_CONFIG).serve()
+            finally:
+                os._exit(code)
+        return pid
+
+    def wait_for(self, uids, state, key='state', timeout=10):
+        ''' wait until all the tasks are in state, and have key '''
+        until = time() + timeout
+        while time() < until:
+            tasks = self.results(uids)
+            if all(t['state'] == state and key in t for t in tasks):
+                return tasks
+            sleep(0.1)
+        self.fail('tasks never got to ' + state)
+
+    def test_sigterm_releases(self):
+        uids = self.save({'command': 'sleep', 'command_args': ['30']},
+                         {'command': 'sleep', 'command_args': ['30']})
+        pid = self.serve()
+
+        # (the pid is saved just after the task is claimed as running)
+        running = self.wait_for(uids, 'running', 'pid')
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        tasks = self.results(uids)
+        self.assertEqual([t['state'] for t in tasks], ['ready', 'ready'])
+        self.assertEqual([t.get('pid') for t in tasks], [None, None])
+        for task in running:
+            with self.assertRaises(OSError):
+                os.kill(task['pid'], 0)
+
+    def test_no_command(self):
+        pid = self.serve()
+        try:
+            uids = self.save({'name': 'no command'}, {'command': 'true'})
+            self.wait_for(uids[:1], 'failed')
+            self.wait_for(uids[1:], 'finished')
+            self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def test_keeps_going(self):
+        pid = self.serve()
+        try:
+            sleep(0.3)
+            uids = self.save({'command': 'true'})
+            self.wait_for(uids, 'finished')
+            self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
+RUNNER_JOBS = '''
+import os
+import sys
+
+def double(task):
+    print 'doubling', task['n']
+    return {'n': task['n'] * 2}
+
+def boom(task):
+    raise ValueError('boom')
+
+def bye(task):
+    sys.exit(3)
+
+def crash(task):
+    os._exit(9)
+'''
+
+class Test_WorkerPool_callables(BaseCaseClass_WorkerPool):
+    ''' [callables] tasks run as python functions in pre-forked workers '''
+
+    extra_config = ('[callables]\n'
+                    'double=runner_jobs:double\n'
+                    'boom=runner_jobs:boom\n'
+                    'bye=runner_jobs:bye\n'
+                    'crash=runner_jobs:crash\n'
+                    'missing=no_such_module:thing\n')
+
+    def setUp(self):
+        super(Test_WorkerPool_callables, self).setUp()
+        with open('__test/runner_jobs.py', 'w') as tfile:
+            tfile.write(RUNNER_JOBS)
+
+    def test_results(self):
+        uids = self.save(*[{'command': 'double', 'n': n} for n in range(6)])
+
+        self.assertEqual(self.make_pool().run(), 0)
+
+        tasks = self.results(uids)
+        self.assertEqual([t['state'] for t in tasks], ['finished'] * 6)
+        self.assertEqual([t['result'] for t in tasks],
+                         [{'n': n * 2} for n in range(6)])
+        # (the same pre-forked workers each time)
+        self.assertLessEqual(len(set(t['pid'] for t in tasks)), 3)
+        with open('__test/tasks.log') as log:
+            self.assertIn('doubling 5', log.read())
+
+    def test_any_case(self):
+        uids = self.save({'command': 'Double', 'n': 2})
+
+        self.assertEqual(self.make_pool().run(), 0)
+        self.assertEqual(self.results(uids)[0]['result'], {'n': 4})
+
+    def test_failures(self):
+        uids = self.save({'command': 'boom'}, {'command': 'bye'},
+                         {'command': 'crash'}, {'command': 'missing'},
+                         {'command': 'double', 'n': 1})
+
+        self.assertEqual(self.make_pool().run(), 0)
+
+        tasks = self.results(uids)
+        self.assertEqual([t['state'] for t in tasks],
+                         ['failed'] * 4 + ['finished'])
+        self.assertEqual([t.get('errcode') for t in tasks],
+                         [1, 3, 9, stq.ERR_COULD_NOT_RUN, None])
+        self.assertEqual(tasks[-1]['result'], {'n': 2})
+        with open('__test/tasks.log') as log:
+            self.assertIn('ValueError: boom', log.read())
+
+
 if __name__ == '__main__':
     unittest.main()